@@ -4,10 +4,10 @@ import sys
 import os
 
 from charmhelpers.core.host import service_pause, service_resume
-from charmhelpers.core.hookenv import action_fail
+from charmhelpers.core.hookenv import action_fail, action_set
 from charmhelpers.core.unitdata import HookData, kv
 
-from hooks.keystone_utils import services, assess_status
+from hooks.keystone_utils import services, assess_status, ssl_sync_status
 from hooks.keystone_hooks import CONFIGS
 
 
@@ -39,9 +39,23 @@ def resume(args):
     assess_status(CONFIGS)
 
 
+def ssl_sync_status_action(args):
+    """Report which peers have applied the certs last synced by this unit."""
+    with HookData()():
+        status = ssl_sync_status()
+    if status is None:
+        raise Exception("Not the ssl-cert-master, no sync status to report.")
+    action_set({'digest': status['digest'] or '',
+                'synced': ','.join(status['synced']),
+                'pending': ','.join(status['pending']),
+                'converged': bool(status['digest'] and
+                                  not status['pending'])})
+
+
 # A dictionary of all the defined actions to callables (which take
 # parsed arguments).
-ACTIONS = {"pause": pause, "resume": resume}
+ACTIONS = {"pause": pause, "resume": resume,
+           "ssl-sync-status": ssl_sync_status_action}
 
 
 def main(args):
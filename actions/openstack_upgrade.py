@@ -8,6 +8,11 @@ from charmhelpers.contrib.openstack.utils import (
     do_action_openstack_upgrade,
 )
 
+from charmhelpers.core.hookenv import (
+    flush_log,
+    flush_relation_writes,
+)
+
 from keystone_hooks import (
     CONFIGS,
 )
@@ -31,6 +36,8 @@ def openstack_upgrade():
     if (do_action_openstack_upgrade('keystone',
                                     do_openstack_upgrade,
                                     CONFIGS)):
+        flush_relation_writes()
+        flush_log()
         os.execl('./hooks/config-changed-postupgrade', '')
 
 if __name__ == '__main__':
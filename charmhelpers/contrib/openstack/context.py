@@ -207,6 +207,10 @@ class OSContextGenerator(object):
     related = False
     complete = False
     missing_data = []
+    # Generators whose evaluation has effects beyond computing the context
+    # set this so they are re-run for every config file they serve, rather
+    # than once per OSConfigRenderer.write_all() pass.
+    side_effects = False
 
     def __call__(self):
         raise NotImplementedError
@@ -14,12 +14,18 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with charm-helpers.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
+import inspect
+import json
 import os
+import shutil
 
 import six
 
 from charmhelpers.fetch import apt_install, apt_update
+from charmhelpers.core.host import write_file_atomic
 from charmhelpers.core.hookenv import (
+    charm_dir,
     log,
     ERROR,
     INFO
@@ -28,10 +34,12 @@ from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
 
 try:
     from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import FileSystemBytecodeCache
 except ImportError:
     apt_update(fatal=True)
     apt_install('python-jinja2', fatal=True)
     from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
+    from jinja2 import FileSystemBytecodeCache
 
 
 class OSConfigException(Exception):
@@ -84,6 +92,28 @@ def get_loader(templates_dir, os_release):
     return ChoiceLoader(loaders)
 
 
+def template_cache_dir():
+    """
+    Default directory for compiled templates, kept in the charm directory so
+    that it persists between hooks. None when not running in a hook.
+    """
+    if charm_dir():
+        return os.path.join(charm_dir(), '.template-cache')
+    return None
+
+
+def _context_memo_key(context):
+    """
+    Key for the result of a context generator in a write_all() memo: plain
+    functions by themselves and generator objects by their class and
+    attributes, as templates are often registered with separate but equal
+    instances of a generator.
+    """
+    if inspect.isroutine(context) or not hasattr(context, '__dict__'):
+        return context
+    return (type(context), repr(sorted(vars(context).items())))
+
+
 class OSConfigTemplate(object):
     """
     Associates a config file template with a list of context generators.
@@ -99,10 +129,22 @@ class OSConfigTemplate(object):
 
         self._complete_contexts = []
 
-    def context(self):
+    def context(self, memo=None):
+        """
+        Merge the contexts of all generators. If memo is a dict, results of
+        generators without side effects are looked up in and saved to it so
+        that a generator shared between templates, or generators of the same
+        class and configuration, are only evaluated once.
+        """
         ctxt = {}
         for context in self.contexts:
-            _ctxt = context()
+            if memo is None or getattr(context, 'side_effects', False):
+                _ctxt = context()
+            else:
+                key = _context_memo_key(context)
+                if key not in memo:
+                    memo[key] = context()
+                _ctxt = memo[key]
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -193,8 +235,21 @@ class OSConfigRenderer(object):
     of generators.  When a template is rendered and written, all context
     generates are called in a chain to generate the context dictionary
     passed to the jinja2 template. See context.py for more info.
+
+    **Fingerprinting**
+
+    A fingerprint of the context each config file was last written with is
+    kept, and write() leaves a file untouched if its context has not changed
+    since. Code which changes state a template depends on without it being
+    reflected in the context should call invalidate().
+
+    **Template cache**
+
+    Compiled templates are cached on disk under cache_dir, one directory per
+    release, so templates are only parsed again when their source changes.
+    Charms should call clear_template_cache() on upgrade-charm.
     """
-    def __init__(self, templates_dir, openstack_release):
+    def __init__(self, templates_dir, openstack_release, cache_dir=None):
         if not os.path.isdir(templates_dir):
             log('Could not locate templates dir %s' % templates_dir,
                 level=ERROR)
@@ -202,8 +257,12 @@ class OSConfigRenderer(object):
 
         self.templates_dir = templates_dir
         self.openstack_release = openstack_release
+        self.cache_dir = cache_dir or template_cache_dir()
         self.templates = {}
         self._tmpl_env = None
+        self._fingerprints = {}
+        # Context generator results for the write_all() pass in progress.
+        self._context_memo = None
 
         if None in [Environment, ChoiceLoader, FileSystemLoader]:
             # if this code is running, the object is created pre-install hook.
@@ -218,12 +277,37 @@ class OSConfigRenderer(object):
         """
         self.templates[config_file] = OSConfigTemplate(config_file=config_file,
                                                        contexts=contexts)
+        self.invalidate(config_file)
         log('Registered config file: %s' % config_file, level=INFO)
 
     def _get_tmpl_env(self):
         if not self._tmpl_env:
             loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            self._tmpl_env = Environment(loader=loader,
+                                         bytecode_cache=self._bytecode_cache())
+
+    def _bytecode_cache(self):
+        if not self.cache_dir:
+            return None
+        # Bytecode is looked up by template name and path and checked
+        # against the template source, so edited templates are recompiled.
+        cache_dir = os.path.join(self.cache_dir, self.openstack_release)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+        except OSError as e:
+            log('Not caching compiled templates, could not create %s: %s' %
+                (cache_dir, e), level=INFO)
+            return None
+        return FileSystemBytecodeCache(cache_dir)
+
+    def clear_template_cache(self):
+        """
+        Remove all compiled templates, eg. when the charm is upgraded.
+        """
+        self._tmpl_env = None
+        if self.cache_dir:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -235,8 +319,9 @@ class OSConfigRenderer(object):
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
-        ctxt = self.templates[config_file].context()
+        return self._render(config_file, self.templates[config_file].context())
 
+    def _render(self, config_file, ctxt):
         _tmpl = os.path.basename(config_file)
         try:
             template = self._get_template(_tmpl)
@@ -259,23 +344,66 @@ class OSConfigRenderer(object):
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        The file is replaced atomically and only if the rendered contents
+        differ from what it already holds.
+
+        :returns: True if the contents of config_file changed.
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
 
-        _out = self.render(config_file)
-
-        with open(config_file, 'wb') as out:
-            out.write(_out)
-
-        log('Wrote template %s.' % config_file, level=INFO)
+        ctxt = self.templates[config_file].context(memo=self._context_memo)
+        fingerprint = self._fingerprint(ctxt)
+        if (self._fingerprints.get(config_file) == fingerprint and
+                os.path.exists(config_file)):
+            log('Context unchanged, not rewriting %s.' % config_file,
+                level=INFO)
+            return False
+
+        _out = self._render(config_file, ctxt)
+        changed = write_file_atomic(config_file, _out)
+        self._fingerprints[config_file] = fingerprint
+        if changed:
+            log('Wrote template %s.' % config_file, level=INFO)
+        else:
+            log('Rendered %s unchanged, not rewriting.' % config_file,
+                level=INFO)
+        return changed
+
+    def _fingerprint(self, ctxt):
+        # Values which are not JSON serializable are compared by repr, at
+        # worst causing an unneeded re-render.
+        data = json.dumps([self.openstack_release, ctxt], sort_keys=True,
+                          default=repr)
+        return hashlib.sha256(data.encode('UTF-8')).hexdigest()
+
+    def invalidate(self, config_file=None):
+        """
+        Forget the context config_file, or every config file if None, was
+        last written with so that the next write() renders it again.
+        """
+        if config_file is None:
+            self._fingerprints.clear()
+        else:
+            self._fingerprints.pop(config_file, None)
 
     def write_all(self):
         """
         Write out all registered config files.
+
+        Each context generator is evaluated at most once for the pass, unless
+        it declares side effects.
+
+        :returns: list of the config files whose contents changed.
         """
-        [self.write(k) for k in six.iterkeys(self.templates)]
+        self._context_memo = {}
+        try:
+            return [k for k in list(six.iterkeys(self.templates))
+                    if self.write(k)]
+        finally:
+            self._context_memo = None
 
     def set_release(self, openstack_release):
         """
@@ -284,6 +412,7 @@ class OSConfigRenderer(object):
         """
         self._tmpl_env = None
         self.openstack_release = openstack_release
+        self.invalidate()
         self._get_tmpl_env()
 
     def complete_contexts(self):
@@ -257,12 +257,15 @@ def peer_store_and_set(relation_id=None, peer_relation_name='cluster',
                  relation_settings=relation_settings,
                  **kwargs)
     if is_relation_made(peer_relation_name):
+        key_prefix = relation_id or current_relation_id()
+        peer_settings = {}
         for key, value in six.iteritems(dict(list(kwargs.items()) +
                                              list(relation_settings.items()))):
-            key_prefix = relation_id or current_relation_id()
-            peer_store(key_prefix + delimiter + key,
-                       value,
-                       relation_name=peer_relation_name)
+            peer_settings[key_prefix + delimiter + key] = value
+        # Store all keys with a single write rather than one per key.
+        cluster_rid = relation_ids(peer_relation_name)[0]
+        relation_set(relation_id=cluster_rid,
+                     relation_settings=peer_settings)
     else:
         if peer_store_fatal:
             raise ValueError('Unable to detect '
@@ -65,6 +65,7 @@ import os
 import pwd
 
 from copy import copy
+from multiprocessing.pool import ThreadPool
 from subprocess import check_call, check_output
 
 from charmhelpers.core.host import (
@@ -238,12 +239,16 @@ def run_as_user(user, cmd, gid=None):
     return check_output(cmd, preexec_fn=_run_as_user(user, gid), cwd='/')
 
 
-def collect_authed_hosts(peer_interface):
+def collect_authed_hosts(peer_interface, units=None):
     '''Iterate through the units on peer interface to find all that
-    have the calling host in its authorized hosts list'''
+    have the calling host in its authorized hosts list, only considering
+    those in units if given'''
     hosts = []
     for r_id in (relation_ids(peer_interface) or []):
         for unit in related_units(r_id):
+            if units is not None and unit not in units:
+                continue
+
             private_addr = relation_get('private-address',
                                         rid=r_id, unit=unit)
             authed_hosts = relation_get('ssh_authorized_hosts',
@@ -299,15 +304,78 @@ def sync_to_peer(host, user, paths=None, verbose=False, cmd=None, gid=None,
             sync_path_to_host(p, host, user, verbose, cmd, gid, fatal)
 
 
+def sync_paths_to_host(paths, host, user, verbose=False, cmd=None, gid=None):
+    """Sync paths to an specific peer host with a single unison run
+
+    A single path is synced as the unison root, as sync_path_to_host()
+    does. Several are synced relative to the deepest directory containing
+    all of them. Raises if the operation fails.
+    """
+    cmd = cmd or copy(BASE_CMD)
+    if not verbose:
+        cmd.append('-silent')
+
+    # removing trailing slash from directory paths, unison
+    # doesn't like these.
+    paths = [p.rstrip('/') for p in paths]
+    if len(paths) == 1:
+        root = paths[0]
+        cmd = cmd + [root, 'ssh://%s@%s/%s' % (user, host, root)]
+    else:
+        # Common directory of the parents, so that no path is the root.
+        root = os.path.dirname(os.path.commonprefix(
+            [os.path.dirname(p) + '/' for p in paths]))
+        cmd = cmd + [root, 'ssh://%s@%s/%s' % (user, host, root)]
+        for path in paths:
+            cmd += ['-path', os.path.relpath(path, root)]
+
+    log('Syncing local paths %s to %s@%s' % (', '.join(paths), user, host))
+    run_as_user(user, cmd, gid)
+
+
 def sync_to_peers(peer_interface, user, paths=None, verbose=False, cmd=None,
-                  gid=None, fatal=False):
+                  gid=None, fatal=False, workers=None, units=None):
     """Sync all hosts to an specific path
 
     The type of group is integer, it allows user has permissions to
     operate a directory have a different group id with the user id.
 
+    If workers is set, up to that many hosts are synced at once, each with a
+    single unison run for all paths, and a dict mapping each host to the
+    exception syncing it raised, or None, is returned.
+
+    If units is given only those peers are synced.
+
     Propagates exception if any operation fails and fatal=True.
     """
-    if paths:
-        for host in collect_authed_hosts(peer_interface):
+    if not paths:
+        return
+
+    hosts = collect_authed_hosts(peer_interface, units)
+    if not workers:
+        for host in hosts:
             sync_to_peer(host, user, paths, verbose, cmd, gid, fatal)
+        return
+
+    def _sync(host):
+        try:
+            sync_paths_to_host(paths, host, user, verbose, cmd, gid)
+        except Exception as e:
+            log('Error syncing remote files to %s: %s' % (host, e),
+                level=ERROR)
+            return e
+
+    results = {}
+    if hosts:
+        pool = ThreadPool(min(workers, len(hosts)))
+        try:
+            results = dict(zip(hosts, pool.map(_sync, hosts)))
+        finally:
+            pool.close()
+            pool.join()
+
+    failed = [host for host in hosts if results[host] is not None]
+    if failed and fatal:
+        raise results[failed[0]]
+
+    return results
@@ -21,6 +21,8 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 from __future__ import print_function
+import atexit as py_atexit
+from collections import OrderedDict
 import copy
 from distutils.version import LooseVersion
 from functools import wraps
@@ -32,6 +34,8 @@ import subprocess
 import sys
 import errno
 import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 from subprocess import CalledProcessError
 
 import six
@@ -45,9 +49,115 @@ ERROR = "ERROR"
 WARNING = "WARNING"
 INFO = "INFO"
 DEBUG = "DEBUG"
+LOG_LEVELS = [DEBUG, INFO, WARNING, ERROR, CRITICAL]
 MARKER = object()
 
-cache = {}
+# RelationSnapshot serving relation reads for this hook, see
+# relation_snapshot().
+_relation_snapshot = None
+# Pending relation settings by relation id, see buffer_relation_writes().
+_relation_set_buffer = None
+# Messages below this level are dropped, see buffer_log().
+_log_threshold = None
+# (level, message) pairs waiting to be written, see buffer_log().
+_log_buffer = None
+_log_lock = threading.Lock()
+# Upper bound on the size of a batch of messages passed to juju-log, which
+# takes them as a single argument.
+LOG_BATCH_SIZE = 64 * 1024
+
+
+class Cache(object):
+    """Results of @cached functions for the duration of a hook.
+
+    Each function has its own namespace keyed on its arguments. Entries
+    carry tags naming what they depend on, eg. the settings of a unit on a
+    relation. Tags are added with cache_tag() while a function runs and are
+    inherited by any cached function calling it, so invalidate(tag) drops
+    exactly the entries which depend on tag.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self._computing = threading.local()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.namespaces = {}
+            self.tagged = {}
+            self.hits = {}
+            self.misses = {}
+
+    def _stack(self):
+        stack = getattr(self._computing, 'stack', None)
+        if stack is None:
+            stack = self._computing.stack = []
+        return stack
+
+    def tag(self, *tags):
+        """Record that the entries being computed depend on tags"""
+        for pending in self._stack():
+            pending.update(tags)
+
+    def get(self, func, key):
+        """Cached result of func for key, raising KeyError if there is
+        none"""
+        with self.lock:
+            value, tags = self.namespaces[func][key]
+            self.hits[func] = self.hits.get(func, 0) + 1
+        self.tag(*tags)
+        return value
+
+    def compute(self, func, key, args, kwargs):
+        """Call func and cache the result under key"""
+        tags = set()
+        stack = self._stack()
+        stack.append(tags)
+        try:
+            value = func(*args, **kwargs)
+        finally:
+            stack.pop()
+        with self.lock:
+            self.misses[func] = self.misses.get(func, 0) + 1
+            self.namespaces.setdefault(func, {})[key] = (value, tags)
+            for tag in tags:
+                self.tagged.setdefault(tag, set()).add((func, key))
+        return value
+
+    def invalidate(self, *tags):
+        """Drop every entry depending on any of tags"""
+        with self.lock:
+            for tag in tags:
+                for func, key in self.tagged.pop(tag, ()):
+                    self.namespaces.get(func, {}).pop(key, None)
+
+    def flush(self, substring):
+        """Drop every entry whose function or arguments mention
+        substring"""
+        with self.lock:
+            flushed = set()
+            for func, entries in self.namespaces.items():
+                for key in list(entries):
+                    if substring in str((func, key)):
+                        del entries[key]
+                        flushed.add((func, key))
+            for tag, entries in list(self.tagged.items()):
+                entries -= flushed
+                if not entries:
+                    del self.tagged[tag]
+
+    def report(self):
+        """Log hit and miss counts for each cached function"""
+        funcs = sorted(set(self.hits) | set(self.misses),
+                       key=lambda f: f.__name__)
+        for func in funcs:
+            log("Cache {}: {} hits, {} misses".format(
+                func.__name__, self.hits.get(func, 0),
+                self.misses.get(func, 0)), level=DEBUG)
+
+
+cache = Cache()
 
 
 def cached(func):
@@ -65,37 +175,61 @@ def cached(func):
     """
     @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = str((func, args, kwargs))
+        key = (args, tuple(sorted(kwargs.items())))
         try:
-            return cache[key]
+            hash(key)
+        except TypeError:
+            # Unhashable arguments, eg. lists, fall back to their repr.
+            key = str(key)
+        try:
+            return cache.get(func, key)
         except KeyError:
             pass  # Drop out of the exception handler scope.
-        res = func(*args, **kwargs)
-        cache[key] = res
-        return res
+        return cache.compute(func, key, args, kwargs)
     wrapper._wrapped = func
     return wrapper
 
 
+def cache_tag(*tags):
+    """Declare that the result of the cached function being run depends on
+    tags, see cache_invalidate()"""
+    cache.tag(*tags)
+
+
+def cache_invalidate(*tags):
+    """Drop cached results depending on any of tags"""
+    cache.invalidate(*tags)
+
+
+def log_cache_stats():
+    """Log cache hit and miss counts, eg. with atexit(log_cache_stats)"""
+    cache.report()
+
+
 def flush(key):
     """Flushes any entries from function cache where the
     key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    cache.flush(key)
 
 
 def log(message, level=None):
     """Write a message to the juju log"""
+    if not isinstance(message, six.string_types):
+        message = repr(message)
+    if _log_threshold is not None and level in LOG_LEVELS:
+        if LOG_LEVELS.index(level) < LOG_LEVELS.index(_log_threshold):
+            return
+    if _log_buffer is not None:
+        with _log_lock:
+            _log_buffer.append((level, message))
+        return
+    _juju_log(message, level)
+
+
+def _juju_log(message, level=None):
     command = ['juju-log']
     if level:
         command += ['-l', level]
-    if not isinstance(message, six.string_types):
-        message = repr(message)
     command += [message]
     # Missing juju-log should not cause failures in unit tests
     # Send log output to stderr
@@ -111,6 +245,42 @@ def log(message, level=None):
             raise
 
 
+def buffer_log(level=None):
+    """Buffer log messages for the rest of the hook.
+
+    Messages below level are dropped without running juju-log. The rest are
+    held back and written in order by flush_log(), one juju-log call for each
+    run of messages at the same level. The buffer is flushed when the hook
+    completes, whether or not it succeeds, and when the process exits.
+    """
+    global _log_threshold, _log_buffer
+    _log_threshold = level
+    if _log_buffer is None:
+        _log_buffer = []
+        py_atexit.register(flush_log)
+
+
+def flush_log():
+    """Write out messages buffered by log()"""
+    with _log_lock:
+        if not _log_buffer:
+            return
+        messages = list(_log_buffer)
+        del _log_buffer[:]
+
+    batch = []
+    size = 0
+    for i, (level, message) in enumerate(messages):
+        batch.append(message)
+        size += len(message)
+        following = messages[i + 1] if i + 1 < len(messages) else None
+        if (following is None or following[0] != level or
+                size + len(following[1]) > LOG_BATCH_SIZE):
+            _juju_log('\n'.join(batch), level)
+            batch = []
+            size = 0
+
+
 class Serializable(UserDict):
     """Wrapper, an object that can be serialized to yaml or json"""
 
@@ -331,6 +501,7 @@ class Config(dict):
 @cached
 def config(scope=None):
     """Juju charm configuration"""
+    cache_tag(('config',))
     config_cmd_line = ['config-get']
     if scope is not None:
         config_cmd_line.append(scope)
@@ -345,9 +516,31 @@ def config(scope=None):
         return None
 
 
-@cached
 def relation_get(attribute=None, unit=None, rid=None):
     """Get relation information"""
+    pending = _pending_relation_settings(unit=unit, rid=rid)
+    if attribute and attribute in pending:
+        return pending[attribute]
+    settings = _relation_get(attribute=attribute, unit=unit, rid=rid)
+    if pending and not attribute:
+        settings = _merge_relation_settings(settings, pending)
+    return settings
+
+
+def _relation_settings_tag(rid=None, unit=None):
+    """Cache tag for the settings of unit on relation rid"""
+    return ('relation-settings', rid or relation_id(), unit or remote_unit())
+
+
+@cached
+def _relation_get(attribute=None, unit=None, rid=None):
+    cache_tag(_relation_settings_tag(rid, unit))
+    if _relation_snapshot is not None:
+        settings = _relation_snapshot.get(unit=unit, rid=rid)
+        if settings is not None:
+            if attribute:
+                return settings.get(attribute)
+            return settings
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
@@ -365,14 +558,41 @@ def relation_get(attribute=None, unit=None, rid=None):
         raise
 
 
+def _merge_relation_settings(settings, changes):
+    """Return a copy of settings with changes applied, None unsetting a
+    key as relation-set does"""
+    settings = dict(settings or {})
+    for key, value in changes.items():
+        if value is None:
+            settings.pop(key, None)
+        else:
+            settings[key] = value
+    return settings
+
+
+def _pending_relation_settings(unit=None, rid=None):
+    """Buffered writes which a relation_get for unit on rid should see"""
+    if _relation_set_buffer is None:
+        return {}
+    if (unit or remote_unit()) != local_unit():
+        return {}
+    return _relation_set_buffer.get(rid or relation_id(), {})
+
+
+@cached
+def _relation_set_accepts_file():
+    # --file was introduced in Juju 1.23.2.
+    return "--file" in subprocess.check_output(
+        ['relation-set', '--help'], universal_newlines=True)
+
+
 def relation_set(relation_id=None, relation_settings=None, **kwargs):
-    """Set relation information for the current unit"""
+    """Set relation information for the current unit.
+
+    If writes are being buffered, see buffer_relation_writes(), the settings
+    are only recorded and written when the hook completes.
+    """
     relation_settings = relation_settings if relation_settings else {}
-    relation_cmd_line = ['relation-set']
-    accepts_file = "--file" in subprocess.check_output(
-        relation_cmd_line + ["--help"], universal_newlines=True)
-    if relation_id is not None:
-        relation_cmd_line.extend(('-r', relation_id))
     settings = relation_settings.copy()
     settings.update(kwargs)
     for key, value in settings.items():
@@ -380,11 +600,26 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
         # sites pass in things like dicts or numbers.
         if value is not None:
             settings[key] = "{}".format(value)
-    if accepts_file:
-        # --file was introduced in Juju 1.23.2. Use it by default if
-        # available, since otherwise we'll break if the relation data is
-        # too big. Ideally we should tell relation-set to read the data from
-        # stdin, but that feature is broken in 1.23.2: Bug #1454678.
+    if _relation_set_buffer is not None:
+        _buffer_relation_settings(relation_id, settings)
+        return
+    _relation_set(relation_id, settings)
+
+
+def _buffer_relation_settings(relid, settings):
+    relid = relid or relation_id()
+    _relation_set_buffer.setdefault(relid, {}).update(settings)
+
+
+def _relation_set(relid, settings):
+    relation_cmd_line = ['relation-set']
+    if relid is not None:
+        relation_cmd_line.extend(('-r', relid))
+    if _relation_set_accepts_file():
+        # Use --file by default if available, since otherwise we'll break if
+        # the relation data is too big. Ideally we should tell relation-set
+        # to read the data from stdin, but that feature is broken in 1.23.2:
+        # Bug #1454678.
         with tempfile.NamedTemporaryFile(delete=False) as settings_file:
             settings_file.write(yaml.safe_dump(settings).encode("utf-8"))
         subprocess.check_call(
@@ -397,8 +632,49 @@ def relation_set(relation_id=None, relation_settings=None, **kwargs):
             else:
                 relation_cmd_line.append('{}={}'.format(key, value))
         subprocess.check_call(relation_cmd_line)
-    # Flush cache of any relation-gets for local unit
-    flush(local_unit())
+    if _relation_snapshot is not None:
+        _relation_snapshot.update(relid, settings)
+    # Drop cached relation-gets of the local unit's settings
+    cache_invalidate(_relation_settings_tag(relid, local_unit()))
+
+
+def buffer_relation_writes():
+    """Buffer relation_set calls for the rest of the hook.
+
+    Writes are merged per relation and written with a single relation-set
+    per relation when the hook completes, leaving out settings which already
+    hold the value being set. relation_get of the local unit sees buffered
+    writes. Nothing is written if the hook fails, as Juju would discard the
+    settings in that case anyway. Charms opt in at hook start, eg::
+
+        atstart(buffer_relation_writes)
+
+    Once flushed, writes are no longer buffered, so that atexit callbacks
+    running after the flush still have their settings written.
+    """
+    global _relation_set_buffer
+    if _relation_set_buffer is None:
+        _relation_set_buffer = OrderedDict()
+        atexit(flush_relation_writes)
+
+
+def flush_relation_writes():
+    """Write out relation settings buffered by relation_set and stop
+    buffering"""
+    global _relation_set_buffer
+    buffered, _relation_set_buffer = _relation_set_buffer, None
+    if not buffered:
+        return
+    written = 0
+    for relid, pending in buffered.items():
+        current = _relation_get(unit=local_unit(), rid=relid) or {}
+        changed = dict((k, v) for k, v in pending.items()
+                       if current.get(k) != v)
+        if changed:
+            _relation_set(relid, changed)
+            written += 1
+    log("Flushed buffered relation settings: {} of {} relations "
+        "changed".format(written, len(buffered)), level=DEBUG)
 
 
 def relation_clear(r_id=None):
@@ -416,6 +692,11 @@ def relation_clear(r_id=None):
 def relation_ids(reltype=None):
     """A list of relation_ids"""
     reltype = reltype or relation_type()
+    cache_tag(('relation-ids', reltype))
+    if _relation_snapshot is not None:
+        relids = _relation_snapshot.relation_ids(reltype)
+        if relids is not None:
+            return relids
     relid_cmd_line = ['relation-ids', '--format=json']
     if reltype is not None:
         relid_cmd_line.append(reltype)
@@ -428,6 +709,11 @@ def relation_ids(reltype=None):
 def related_units(relid=None):
     """A list of related units"""
     relid = relid or relation_id()
+    cache_tag(('relation-units', relid))
+    if _relation_snapshot is not None:
+        units = _relation_snapshot.related_units(relid)
+        if units is not None:
+            return units
     units_cmd_line = ['relation-list', '--format=json']
     if relid is not None:
         units_cmd_line.extend(('-r', relid))
@@ -471,6 +757,115 @@ def relations_of_type(reltype=None):
     return relation_data
 
 
+class RelationSnapshot(object):
+    """Every relation id, unit and their settings visible to the hook.
+
+    Relation data seen by a hook does not change while it runs, other than
+    through the hook's own relation_set calls which are applied to the
+    snapshot, so once loaded reads are served from memory. The snapshot is
+    loaded by the first read of relation settings, so hooks which never read
+    any do not pay for it. Anything not in the snapshot is left to the
+    relation tools.
+    """
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.loaded = False
+        self.lock = threading.Lock()
+        self.ids = {}
+        self.units = {}
+        self.settings = {}
+        # Number of relation tool calls made to load the snapshot and
+        # avoided by serving reads from it.
+        self.calls = 0
+        self.saved = 0
+
+    def load(self, workers=None):
+        """Load all relations, running the relation tools in parallel.
+
+        Reads made while loading, including those made by the load itself,
+        are left to the relation tools.
+        """
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+
+        pool = ThreadPool(workers or self.workers)
+        try:
+            reltypes = relation_types()
+            self.ids = dict(zip(reltypes,
+                                pool.map(relation_ids._wrapped, reltypes)))
+            relids = [r for reltype in reltypes for r in self.ids[reltype]]
+            self.units = dict(zip(relids,
+                                  pool.map(related_units._wrapped, relids)))
+            keys = [(relid, unit) for relid in relids
+                    for unit in self.units[relid] + [local_unit()]]
+            self.settings = dict(zip(keys, pool.map(
+                lambda k: _relation_get._wrapped(rid=k[0], unit=k[1]), keys)))
+        finally:
+            pool.close()
+            pool.join()
+        self.calls = len(reltypes) + len(relids) + len(keys)
+
+    def _served(self, value):
+        self.saved += 1
+        return copy.copy(value)
+
+    def relation_ids(self, reltype):
+        if reltype in self.ids:
+            return self._served(self.ids[reltype])
+
+    def related_units(self, relid):
+        if relid in self.units:
+            return self._served(self.units[relid])
+
+    def get(self, unit=None, rid=None):
+        """Settings of unit on relation rid, defaulting to the remote unit
+        and relation of the current hook, or None if not known"""
+        self.load()
+        key = (rid or relation_id(), unit or remote_unit())
+        settings = self.settings.get(key)
+        if settings is not None:
+            return self._served(settings)
+
+    def update(self, relid, settings):
+        """Apply relation settings set by the local unit"""
+        key = (relid or relation_id(), local_unit())
+        if key not in self.settings:
+            return
+        current = self.settings[key] = dict(self.settings[key] or {})
+        for k, v in settings.items():
+            if v is None:
+                current.pop(k, None)
+            else:
+                current[k] = v
+
+    def report(self):
+        if not self.loaded:
+            log("Relation snapshot: not loaded", level=DEBUG)
+            return
+        log("Relation snapshot: {} relation tool calls to load, {} "
+            "avoided".format(self.calls, self.saved), level=DEBUG)
+
+
+def relation_snapshot(workers=8):
+    """Serve relation reads for the rest of the hook from a snapshot.
+
+    On the first read of relation settings all relation ids, units and
+    settings are loaded in one pass with up to workers relation tool calls in
+    parallel. The number of calls saved is logged when the hook completes.
+    Charms opt in at hook start, eg::
+
+        atstart(relation_snapshot)
+    """
+    global _relation_snapshot
+    snapshot = RelationSnapshot(workers)
+    _relation_snapshot = snapshot
+    atexit(snapshot.report)
+    return snapshot
+
+
 @cached
 def metadata():
     """Get the current charm metadata.yaml contents as a python object"""
@@ -710,18 +1105,21 @@ class Hooks(object):
 
     def execute(self, args):
         """Execute a registered hook based on args[0]"""
-        _run_atstart()
-        hook_name = os.path.basename(args[0])
-        if hook_name in self._hooks:
-            try:
-                self._hooks[hook_name]()
-            except SystemExit as x:
-                if x.code is None or x.code == 0:
-                    _run_atexit()
-                raise
-            _run_atexit()
-        else:
-            raise UnregisteredHookError(hook_name)
+        try:
+            _run_atstart()
+            hook_name = os.path.basename(args[0])
+            if hook_name in self._hooks:
+                try:
+                    self._hooks[hook_name]()
+                except SystemExit as x:
+                    if x.code is None or x.code == 0:
+                        _run_atexit()
+                    raise
+                _run_atexit()
+            else:
+                raise UnregisteredHookError(hook_name)
+        finally:
+            flush_log()
 
     def hook(self, *hook_names):
         """Decorator, registering them as hooks"""
@@ -30,14 +30,34 @@ import random
 import string
 import subprocess
 import hashlib
+import tempfile
+import time
 from contextlib import contextmanager
 from collections import OrderedDict
 
 import six
 
+from . import hookenv
+from . import unitdata
 from .hookenv import log
 from .fstab import Fstab
 
+# Content hashes computed by file_hash() for this hook, by (path, hash_type),
+# along with the stat fingerprint of the file they were computed from.
+_file_hashes = {}
+# Files modified less than this many seconds before they were hashed may be
+# modified again without their mtime changing, so their hashes are not kept.
+FILE_HASH_MTIME_SLACK = 1
+# Services to restart when the hook completes, see defer_restarts(). Maps
+# service names to 'restart' or 'stopstart'; None while not deferring.
+_deferred_restarts = None
+_restart_order = []
+# Callbacks run around the deferred restarts, see defer_restarts().
+_restart_callbacks = (None, None)
+DEFERRED_RESTARTS_KEY = 'host.deferred-restarts'
+# Storage holding the queue of deferred restarts, see _restart_db().
+_restart_storage = None
+
 
 def service_start(service_name):
     """Start a system service"""
@@ -294,12 +314,79 @@ def write_file(path, content, owner='root', group='root', perms=0o444):
     log("Writing file {} {}:{} {:o}".format(path, owner, group, perms))
     uid = pwd.getpwnam(owner).pw_uid
     gid = grp.getgrnam(group).gr_gid
+    invalidate_file_hash(path)
     with open(path, 'wb') as target:
         os.fchown(target.fileno(), uid, gid)
         os.fchmod(target.fileno(), perms)
         target.write(content)
 
 
+def write_file_atomic(path, content, owner=None, group=None, perms=None):
+    """Replace the contents of a file atomically, if they differ.
+
+    content is compared with what path holds and nothing is written if they
+    match. Otherwise content is written to a temporary file next to path,
+    synced to disk and renamed over path, so readers never see a partially
+    written file. Ownership and permissions default to those of the existing
+    file, or root:root 0644 for a new one, and are corrected in place if
+    they differ. If path is a symlink the file it points to is replaced,
+    leaving the link in place.
+
+    :returns: True if the contents of path changed, False otherwise.
+    """
+    if isinstance(content, six.text_type):
+        content = content.encode('UTF-8')
+    if os.path.islink(path):
+        invalidate_file_hash(path)
+        path = os.path.realpath(path)
+    try:
+        current = os.stat(path)
+    except OSError:
+        current = None
+    uid = pwd.getpwnam(owner).pw_uid if owner else None
+    gid = grp.getgrnam(group).gr_gid if group else None
+    if current is not None:
+        uid = current.st_uid if uid is None else uid
+        gid = current.st_gid if gid is None else gid
+        perms = (current.st_mode & 0o7777) if perms is None else perms
+        with open(path, 'rb') as existing:
+            unchanged = existing.read() == content
+        if unchanged:
+            if (current.st_uid, current.st_gid) != (uid, gid):
+                os.chown(path, uid, gid)
+            if current.st_mode & 0o7777 != perms:
+                os.chmod(path, perms)
+            return False
+    else:
+        uid = 0 if uid is None else uid
+        gid = 0 if gid is None else gid
+        perms = 0o644 if perms is None else perms
+
+    log("Writing file {} {}:{} {:o}".format(path, uid, gid, perms))
+    invalidate_file_hash(path)
+    dirname = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=dirname,
+                                    prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as target:
+            os.fchown(target.fileno(), uid, gid)
+            os.fchmod(target.fileno(), perms)
+            target.write(content)
+            target.flush()
+            os.fsync(target.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    # Make the rename itself durable.
+    dir_fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return True
+
+
 def fstab_remove(mp):
     """Remove the given mountpoint entry from /etc/fstab"""
     return Fstab.remove_by_mountpoint(mp)
@@ -364,16 +451,40 @@ def fstab_mount(mountpoint):
 def file_hash(path, hash_type='md5'):
     """Generate a hash checksum of the contents of 'path' or None if not found.
 
+    Hashes are remembered for the rest of the hook and reused while the
+    inode, size and mtime of the file are unchanged.
+
     :param str hash_type: Any hash alrgorithm supported by :mod:`hashlib`,
                           such as md5, sha1, sha256, sha512, etc.
     """
-    if os.path.exists(path):
-        h = getattr(hashlib, hash_type)()
-        with open(path, 'rb') as source:
-            h.update(source.read())
-        return h.hexdigest()
-    else:
+    try:
+        st = os.stat(path)
+    except OSError:
         return None
+    fingerprint = (st.st_ino, st.st_size,
+                   getattr(st, 'st_mtime_ns', st.st_mtime))
+    cached = _file_hashes.get((path, hash_type))
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+
+    hashed_at = time.time()
+    h = getattr(hashlib, hash_type)()
+    with open(path, 'rb') as source:
+        h.update(source.read())
+    if hashed_at - st.st_mtime > FILE_HASH_MTIME_SLACK:
+        _file_hashes[(path, hash_type)] = (fingerprint, h.hexdigest())
+    return h.hexdigest()
+
+
+def invalidate_file_hash(path=None):
+    """Forget hashes file_hash() has computed for path, or for all files if
+    path is None. Called by the writers in this module; code modifying files
+    by other means within a hook may need to call it."""
+    if path is None:
+        _file_hashes.clear()
+        return
+    for key in [k for k in _file_hashes if k[0] == path]:
+        del _file_hashes[key]
 
 
 def path_hash(path):
@@ -410,7 +521,7 @@ class ChecksumError(ValueError):
     pass
 
 
-def restart_on_change(restart_map, stopstart=False):
+def restart_on_change(restart_map, stopstart=False, reload_map=None):
     """Restart services based on configuration files changing
 
     This function is used a decorator, for example::
@@ -428,16 +539,37 @@ def restart_on_change(restart_map, stopstart=False):
     restarted if any file matching the pattern got changed, created
     or removed. Standard wildcards are supported, see documentation
     for the 'glob' module for more information.
+
+    reload_map has the same form as restart_map and lists, for each path,
+    the services which only need a reload when it changes, eg. apache2 for
+    its site configuration. Reloads fall back to a restart if they fail,
+    and a service which also needs a restart because of another change is
+    only restarted.
     """
+    reload_map = reload_map or {}
+
     def wrap(f):
         def wrapped_f(*args, **kwargs):
             checksums = {path: path_hash(path) for path in restart_map}
             f(*args, **kwargs)
             restarts = []
+            reloads = []
             for path in restart_map:
                 if path_hash(path) != checksums[path]:
-                    restarts += restart_map[path]
+                    for service_name in restart_map[path]:
+                        if service_name in reload_map.get(path, []):
+                            reloads.append(service_name)
+                        else:
+                            restarts.append(service_name)
             services_list = list(OrderedDict.fromkeys(restarts))
+            reload_list = [s for s in OrderedDict.fromkeys(reloads)
+                           if s not in services_list]
+            if _deferred_restarts is not None:
+                for service_name in services_list:
+                    queue_restart(service_name, stopstart=stopstart)
+                for service_name in reload_list:
+                    queue_reload(service_name)
+                return
             if not stopstart:
                 for service_name in services_list:
                     service('restart', service_name)
@@ -445,10 +577,127 @@ def restart_on_change(restart_map, stopstart=False):
                 for action in ['stop', 'start']:
                     for service_name in services_list:
                         service(action, service_name)
+            for service_name in reload_list:
+                service_reload(service_name, restart_on_failure=True)
         return wrapped_f
     return wrap
 
 
+# Deferred actions, each superseding those before it.
+DEFERRED_ACTIONS = ['reload', 'restart', 'stopstart']
+
+
+def defer_restarts(order=None, pre_restart=None, post_restart=None):
+    """Defer service restarts to the end of the hook.
+
+    Restarts and reloads requested by restart_on_change, queue_restart() or
+    queue_reload() are queued, each service once however many times it is
+    requested, and run when the hook completes. A restart replaces a
+    reload, and a stop/start replaces a restart. Services listed in order
+    are handled in that order, before any others.
+
+    The queue is saved as it changes, in a store of its own next to the
+    unit's kv store, so restarts queued by a hook which fails are run by the
+    next hook to call defer_restarts().
+
+    If there is anything to restart or stop/start, rather than only reload,
+    pre_restart and post_restart are called with the list of those services
+    before and after running the queue, eg. to coordinate restarts with
+    other units. If pre_restart returns False only the reloads are run and
+    the rest stays queued for a later hook. If post_restart raises, the
+    whole queue is kept and run again by the next hook.
+    """
+    global _deferred_restarts, _restart_order, _restart_callbacks
+    _restart_order = list(order or [])
+    _restart_callbacks = (pre_restart, post_restart)
+    if _deferred_restarts is None:
+        _deferred_restarts = OrderedDict(
+            _restart_db().get(DEFERRED_RESTARTS_KEY) or [])
+        hookenv.atexit(run_deferred_restarts)
+
+
+def queue_restart(service_name, stopstart=False):
+    """Restart a service, or stop and start it if stopstart is set, when the
+    hook completes, or straight away if restarts are not being deferred."""
+    if _deferred_restarts is None:
+        if stopstart:
+            service('stop', service_name)
+            return service('start', service_name)
+        return service('restart', service_name)
+
+    _queue_action(service_name, 'stopstart' if stopstart else 'restart')
+
+
+def queue_reload(service_name):
+    """Reload a service, falling back to a restart, when the hook completes
+    or straight away if restarts are not being deferred."""
+    if _deferred_restarts is None:
+        return service_reload(service_name, restart_on_failure=True)
+
+    _queue_action(service_name, 'reload')
+
+
+def _queue_action(service_name, action):
+    queued = _deferred_restarts.get(service_name)
+    if (queued is None or
+            DEFERRED_ACTIONS.index(action) > DEFERRED_ACTIONS.index(queued)):
+        _deferred_restarts[service_name] = action
+        _save_deferred_restarts()
+
+
+def _restart_db():
+    """Storage for the deferred restart queue. It is kept apart from
+    unitdata.kv() as committing the queue there would also commit whatever
+    else the hook has set so far, even if the hook goes on to fail."""
+    global _restart_storage
+    if _restart_storage is None:
+        _restart_storage = unitdata.Storage(os.path.join(
+            os.environ.get('CHARM_DIR', ''), '.deferred-restarts.db'))
+    return _restart_storage
+
+
+def _save_deferred_restarts():
+    db = _restart_db()
+    db.set(DEFERRED_RESTARTS_KEY, list(_deferred_restarts.items()))
+    db.flush()
+
+
+def run_deferred_restarts():
+    """Run the queued restarts, see defer_restarts()"""
+    if not _deferred_restarts:
+        return
+    ordered = sorted(_deferred_restarts,
+                     key=lambda s: (_restart_order.index(s)
+                                    if s in _restart_order
+                                    else len(_restart_order)))
+    restarts = [s for s in ordered if _deferred_restarts[s] != 'reload']
+    pre_restart, post_restart = _restart_callbacks
+    if restarts and pre_restart and pre_restart(restarts) is False:
+        log("Holding back deferred restarts: {}".format(', '.join(restarts)))
+        ordered = [s for s in ordered if s not in restarts]
+        restarts = []
+    if not ordered:
+        return
+    stopstart = [s for s in ordered if _deferred_restarts[s] == 'stopstart']
+    log("Running deferred restarts: {}".format(', '.join(
+        '{} {}'.format(_deferred_restarts[s], s) for s in ordered)))
+    for service_name in reversed(stopstart):
+        service('stop', service_name)
+    for service_name in ordered:
+        action = _deferred_restarts[service_name]
+        if action == 'stopstart':
+            service('start', service_name)
+        elif action == 'reload':
+            service_reload(service_name, restart_on_failure=True)
+        else:
+            service('restart', service_name)
+    if restarts and post_restart:
+        post_restart(restarts)
+    for service_name in ordered:
+        del _deferred_restarts[service_name]
+    _save_deferred_restarts()
+
+
 def lsb_release():
     """Return /etc/lsb-release in a dict"""
     d = {}
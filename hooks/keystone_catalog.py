@@ -0,0 +1,290 @@
+#!/usr/bin/python
+import hashlib
+import hmac
+
+from collections import (
+    OrderedDict,
+    namedtuple,
+)
+from functools import partial
+from itertools import groupby
+from multiprocessing.pool import ThreadPool
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    INFO,
+)
+
+# Upper bound on the API requests made, and certificates generated,
+# concurrently. Both run on the one pool returned by worker_pool().
+MAX_WORKERS = 4
+_worker_pool = None
+
+
+def worker_pool():
+    """The pool of MAX_WORKERS threads shared by everything the hook runs
+    concurrently"""
+    global _worker_pool
+    if _worker_pool is None:
+        _worker_pool = ThreadPool(MAX_WORKERS)
+    return _worker_pool
+
+
+CatalogAction = namedtuple('CatalogAction', ['action', 'kind', 'name',
+                                             'params'])
+
+
+class UnresolvedNameError(Exception):
+    """A name the catalog refers to does not exist in keystone"""
+
+    def __init__(self, kind, name):
+        super(UnresolvedNameError, self).__init__(
+            'Could not resolve %s_id for %s %s' % (kind, kind, name))
+        self.kind = kind
+        self.name = name
+
+
+def password_digest(password, key):
+    """Digest used to remember which password was last set for a user.
+
+    Keyed with a secret kept alongside the digests so that they cannot be
+    checked against guessed passwords without it.
+    """
+    return hmac.new(key, password, hashlib.sha256).hexdigest()
+
+
+class KeystoneCatalog(object):
+    """Desired state of everything the charm manages in keystone.
+
+    Requests are only recorded here, nothing is sent to keystone until the
+    catalog is reconciled. Adding the same entry twice is harmless; for users
+    and endpoints the last request wins.
+    """
+
+    def __init__(self):
+        self.tenants = OrderedDict()
+        self.roles = OrderedDict()
+        self.services = OrderedDict()
+        self.users = OrderedDict()
+        self.grants = OrderedDict()
+        self.endpoints = OrderedDict()
+        self.removed_services = OrderedDict()
+
+    def add_tenant(self, name, description=None):
+        self.tenants.setdefault(name, description)
+
+    def add_role(self, name):
+        self.roles.setdefault(name, None)
+
+    def add_service(self, name, service_type, description):
+        self.services.setdefault(name, (service_type, description))
+
+    def add_user(self, name, password, tenant):
+        self.users[name] = (password, tenant)
+
+    def add_grant(self, user, role, tenant):
+        self.grants.setdefault((user, role, tenant), None)
+
+    def add_endpoint(self, service, region, publicurl, adminurl, internalurl):
+        self.endpoints[(service, region)] = {'publicurl': publicurl,
+                                             'adminurl': adminurl,
+                                             'internalurl': internalurl}
+
+    def remove_service(self, name, service_type):
+        self.removed_services.setdefault((name, service_type), None)
+
+    def update(self, other):
+        """Add every request recorded in other to this catalog"""
+        for name, description in other.tenants.items():
+            self.add_tenant(name, description)
+        for name in other.roles:
+            self.add_role(name)
+        for name, (service_type, description) in other.services.items():
+            self.add_service(name, service_type, description)
+        for name, (password, tenant) in other.users.items():
+            self.add_user(name, password, tenant)
+        for grant in other.grants:
+            self.add_grant(*grant)
+        for (service, region), urls in other.endpoints.items():
+            self.add_endpoint(service, region, **urls)
+        for removed in other.removed_services:
+            self.remove_service(*removed)
+
+
+class CatalogPlan(object):
+    """Ordered set of changes needed to bring keystone in line with a
+    KeystoneCatalog, as computed by reconcile().
+    """
+
+    def __init__(self, key):
+        self.actions = []
+        # Key of the password digests, see password_digest().
+        self.key = key
+
+    def __len__(self):
+        return len(self.actions)
+
+    def __str__(self):
+        if not self.actions:
+            return 'Keystone catalog is up to date'
+
+        lines = ['Keystone catalog changes (%d):' % len(self.actions)]
+        for action in self.actions:
+            # NOTE: params are not logged since they may contain passwords.
+            lines.append('  %s %s %s' % (action.action, action.kind,
+                                         action.name))
+        return '\n'.join(lines)
+
+    def add(self, action, kind, name, **params):
+        self.actions.append(CatalogAction(action, kind, name, params))
+
+    def apply(self, manager, passwords=None, dry_run=False):
+        """Make the changes in this plan through manager.
+
+        Names are resolved to ids as each action is applied so that entries
+        created earlier in the plan can be referred to. passwords is updated
+        with the digest of every password set.
+
+        Actions of the same action and kind never depend on each other, so
+        each run of them is applied concurrently on worker_pool(), the
+        threads sharing manager's client, one run after the other.
+        """
+        if passwords is None:
+            passwords = {}
+
+        if dry_run:
+            for action in self.actions:
+                log("Dry run - not applying: %s %s %s" %
+                    (action.action, action.kind, action.name), level=INFO)
+            return
+
+        apply = partial(self._apply_action, manager, passwords)
+        for _, actions in groupby(self.actions,
+                                  key=lambda a: (a.action, a.kind)):
+            actions = list(actions)
+            if len(actions) == 1:
+                apply(actions[0])
+                continue
+
+            worker_pool().map(apply, actions)
+
+    def _apply_action(self, manager, passwords, action):
+        apply = getattr(self, '_%s_%s' % (action.action, action.kind))
+        apply(manager, action.name, passwords=passwords, **action.params)
+        log("Applied: %s %s %s" % (action.action, action.kind, action.name),
+            level=DEBUG)
+
+    def _resolve(self, manager, collection, name):
+        resolve = getattr(manager, 'resolve_%s_id' % collection)
+        _id = resolve(name)
+        if _id is None:
+            # NOTE: raised rather than error_out() since this may run in a
+            # pool thread, the exception is re-raised by apply().
+            raise UnresolvedNameError(collection, name)
+
+        return _id
+
+    def _create_tenant(self, manager, name, passwords, description):
+        manager.create_tenant(name, description=description)
+
+    def _create_role(self, manager, name, passwords):
+        manager.create_role(name)
+
+    def _create_service(self, manager, name, passwords, service_type,
+                        description):
+        manager.create_service(name, service_type, description)
+
+    def _delete_service(self, manager, name, passwords, service_id):
+        manager.delete_service(service_id)
+
+    def _create_user(self, manager, name, passwords, password, tenant):
+        tenant_id = self._resolve(manager, 'tenant', tenant)
+        manager.create_user(name, password, 'juju@localhost', tenant_id)
+        passwords[name] = password_digest(password, self.key)
+
+    def _update_user(self, manager, name, passwords, password):
+        user_id = self._resolve(manager, 'user', name)
+        manager.update_user_password(user_id, password)
+        passwords[name] = password_digest(password, self.key)
+
+    def _create_grant(self, manager, name, passwords):
+        user, role, tenant = name
+        # NOTE(adam_g): Keystone client requires id's for add_user_role, not
+        # names
+        manager.add_user_role(self._resolve(manager, 'user', user),
+                              self._resolve(manager, 'role', role),
+                              self._resolve(manager, 'tenant', tenant))
+
+    def _create_endpoint(self, manager, name, passwords, **urls):
+        service, region = name
+        service_id = self._resolve(manager, 'service', service)
+        manager.create_endpoint(region, service_id, **urls)
+
+    def _update_endpoint(self, manager, name, passwords, endpoint_id,
+                         **urls):
+        service, region = name
+        service_id = self._resolve(manager, 'service', service)
+        manager.update_endpoint(endpoint_id, region, service_id, **urls)
+
+
+def reconcile(manager, catalog, passwords=None, key=''):
+    """Compute the plan which brings keystone in line with catalog.
+
+    Current state is read through manager, so each collection is listed at
+    most once per hook however many requests the catalog holds. passwords
+    maps user names to the digest, keyed with key, of the password last set
+    by the charm; existing users are only updated if their password has
+    changed.
+    """
+    if passwords is None:
+        passwords = {}
+
+    # Actions are planned in the order they must be applied: everything a
+    # later action refers to by name is created first.
+    plan = CatalogPlan(key)
+    for name, description in catalog.tenants.items():
+        if manager.resolve_tenant_id(name) is None:
+            plan.add('create', 'tenant', name, description=description)
+
+    for name in catalog.roles:
+        if manager.resolve_role_id(name) is None:
+            plan.add('create', 'role', name)
+
+    for name, (service_type, description) in catalog.services.items():
+        if manager.resolve_service_id(name) is None:
+            plan.add('create', 'service', name, service_type=service_type,
+                     description=description)
+
+    for (name, service_type) in catalog.removed_services:
+        service_id = manager.resolve_service_id(name, service_type)
+        if service_id is not None:
+            plan.add('delete', 'service', name, service_id=service_id)
+
+    for name, (password, tenant) in catalog.users.items():
+        if manager.resolve_user_id(name) is None:
+            plan.add('create', 'user', name, password=password, tenant=tenant)
+        elif passwords.get(name) != password_digest(password, key):
+            plan.add('update', 'user', name, password=password)
+
+    for (user, role, tenant) in catalog.grants:
+        user_id = manager.resolve_user_id(user)
+        role_id = manager.resolve_role_id(role)
+        tenant_id = manager.resolve_tenant_id(tenant)
+        if (None in [user_id, role_id, tenant_id] or
+                role_id not in manager.roles_for_user(user_id, tenant_id)):
+            plan.add('create', 'grant', (user, role, tenant))
+
+    for (service, region), urls in catalog.endpoints.items():
+        service_id = manager.resolve_service_id(service)
+        endpoint = None
+        if service_id is not None:
+            endpoint = manager.find_endpoint(service_id, region)
+
+        if endpoint is None:
+            plan.add('create', 'endpoint', (service, region), **urls)
+        elif any(endpoint.get(k) != v for k, v in urls.items()):
+            plan.add('update', 'endpoint', (service, region),
+                     endpoint_id=endpoint['id'], **urls)
+
+    return plan
@@ -1,4 +1,3 @@
-import hashlib
 import os
 
 from base64 import b64decode
@@ -6,7 +5,7 @@ from base64 import b64decode
 from charmhelpers.core.host import (
     mkdir,
     write_file,
-    service_restart,
+    queue_restart,
 )
 
 from charmhelpers.contrib.openstack import context
@@ -49,7 +48,8 @@ class ApacheSSLContext(context.ApacheSSLContext):
         # late import to work around circular dependency
         from keystone_utils import (
             determine_ports,
-            update_hash_from_path,
+            manifest_changes,
+            scan_manifest,
         )
 
         ssl_paths = [CA_CERT_PATH,
@@ -57,19 +57,13 @@ class ApacheSSLContext(context.ApacheSSLContext):
                                   self.service_namespace)]
 
         self.external_ports = determine_ports()
-        before = hashlib.sha256()
-        for path in ssl_paths:
-            update_hash_from_path(before, path)
-
+        before = scan_manifest(ssl_paths)
         ret = super(ApacheSSLContext, self).__call__()
-
-        after = hashlib.sha256()
-        for path in ssl_paths:
-            update_hash_from_path(after, path)
+        after = scan_manifest(ssl_paths, before)
 
         # Ensure that apache2 is restarted if these change
-        if before.hexdigest() != after.hexdigest():
-            service_restart('apache2')
+        if manifest_changes(before, after):
+            queue_restart('apache2')
 
         return ret
 
@@ -154,9 +148,18 @@ class HAProxyContext(context.HAProxyContext):
         specific to this charm.
         Also used to extend nova.conf context with correct api_listening_ports
         '''
-        from keystone_utils import api_port
+        from keystone_utils import api_port, draining_units
         ctxt = super(HAProxyContext, self).__call__()
 
+        # Peers restarting in a rolling restart are left out, as long as
+        # other backends remain.
+        draining = [unit.replace('/', '-') for unit in draining_units()]
+        for frontend in ctxt.get('frontends', {}).values():
+            backends = frontend['backends']
+            if set(backends) - set(draining):
+                for unit in draining:
+                    backends.pop(unit, None)
+
         # determine which port api processes should bind to, depending
         # on existence of haproxy + apache frontends
         listen_ports = {}
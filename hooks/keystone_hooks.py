@@ -1,6 +1,5 @@
 #!/usr/bin/python
 import hashlib
-import json
 import os
 import sys
 
@@ -11,10 +10,15 @@ from charmhelpers.contrib import unison
 from charmhelpers.core.hookenv import (
     Hooks,
     UnregisteredHookError,
+    atexit,
+    atstart,
+    buffer_log,
+    buffer_relation_writes,
     config,
     is_relation_made,
     log,
     local_unit,
+    log_cache_stats,
     DEBUG,
     INFO,
     WARNING,
@@ -23,11 +27,13 @@ from charmhelpers.core.hookenv import (
     relation_ids,
     relation_set,
     related_units,
+    relation_snapshot,
     unit_get,
     status_set,
 )
 
 from charmhelpers.core.host import (
+    defer_restarts,
     mkdir,
     restart_on_change,
 )
@@ -36,6 +42,8 @@ from charmhelpers.core.strutils import (
     bool_from_string,
 )
 
+from charmhelpers.core.unitdata import kv
+
 from charmhelpers.fetch import (
     apt_install, apt_update,
     filter_installed_packages
@@ -55,20 +63,26 @@ from keystone_utils import (
     do_openstack_upgrade_reexec,
     ensure_initial_admin,
     get_admin_passwd,
+    get_requested_catalog,
     git_install,
     migrate_database,
     save_script_rc,
     synchronize_ca_if_changed,
     register_configs,
     restart_map,
+    reload_map,
     services,
+    claim_restart_slot,
+    check_restarted,
+    update_restart_slots,
     CLUSTER_RES,
     KEYSTONE_CONF,
     SSH_USER,
+    SSL_SYNC_PAYLOAD_TRANSPORTS,
     setup_ipv6,
     send_notifications,
     check_peer_actions,
-    get_ssl_sync_request_units,
+    ssl_sync_required_units,
     is_ssl_cert_master,
     is_db_ready,
     clear_ssl_synced_units,
@@ -116,6 +130,33 @@ hooks = Hooks()
 CONFIGS = register_configs()
 
 
+def commit_unit_data():
+    """Commit the changes a hook made to the unit's kv store"""
+    kv().flush()
+
+
+# Batch charm logging into a few juju-log calls per hook. Messages are kept
+# at every level, the model's logging-config decides which ones are shown.
+atstart(buffer_log)
+# Most hooks walk every identity-service and cluster relation, so load all
+# relation data up front rather than one relation tool call at a time.
+atstart(relation_snapshot)
+# Nested restart_on_change decorators would otherwise restart the same
+# services several times per hook; keystone goes first so that apache2 and
+# haproxy come back in front of a running service.
+atstart(defer_restarts, ['keystone', 'apache2', 'haproxy'],
+        pre_restart=claim_restart_slot, post_restart=check_restarted)
+# Settings are published key by key, write them out once per relation. As
+# atexit callbacks run in reverse order, registering this after
+# defer_restarts writes relation settings before services are restarted.
+atstart(buffer_relation_writes)
+atexit(log_cache_stats)
+# Registered at import, ahead of the callbacks the atstart callbacks above
+# add, so kv changes are committed last and only once the hook and its
+# deferred restarts have succeeded. A failed hook leaves the store as it was.
+atexit(commit_unit_data)
+
+
 @hooks.hook('install.real')
 def install():
     status_set('maintenance', 'Executing pre-install')
@@ -133,7 +174,7 @@ def install():
 
 
 @hooks.hook('config-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), reload_map=reload_map())
 @synchronize_ca_if_changed(fatal=True)
 def config_changed():
     if config('prefer-ipv6'):
@@ -161,7 +202,7 @@ def config_changed():
 
 
 @hooks.hook('config-changed-postupgrade')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), reload_map=reload_map())
 @synchronize_ca_if_changed(fatal=True)
 def config_changed_postupgrade():
     # Ensure ssl dir exists and is unison-accessible
@@ -260,7 +301,9 @@ def update_all_identity_relation_units(check_db_ready=True):
         return
 
     if is_elected_leader(CLUSTER_RES):
-        ensure_initial_admin(config)
+        # Reconcile everything requested by related services in one batch so
+        # that identity_changed() below finds keystone up to date.
+        ensure_initial_admin(config, catalog=get_requested_catalog())
 
     log('Firing identity_changed hook for all related services.')
     for rid in relation_ids('identity-service'):
@@ -301,7 +344,7 @@ def leader_init_db_if_ready(use_current_context=False):
 
 
 @hooks.hook('shared-db-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), reload_map=reload_map())
 @synchronize_ca_if_changed()
 def db_changed():
     if 'shared-db' not in CONFIGS.complete_contexts():
@@ -312,7 +355,7 @@ def db_changed():
 
 
 @hooks.hook('pgsql-db-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), reload_map=reload_map())
 @synchronize_ca_if_changed()
 def pgsql_db_changed():
     if 'pgsql-db' not in CONFIGS.complete_contexts():
@@ -323,7 +366,7 @@ def pgsql_db_changed():
 
 
 @hooks.hook('identity-service-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), reload_map=reload_map())
 @synchronize_ca_if_changed()
 def identity_changed(relation_id=None, remote_unit=None):
     CONFIGS.write_all()
@@ -416,13 +459,23 @@ def send_ssl_sync_request():
         relation_set(relation_id=rid, relation_settings=settings)
 
 
-@hooks.hook('cluster-relation-joined')
-def cluster_joined():
+def ensure_ssl_sync_access():
+    """Exchange ssh keys with peers for unison, unless certs are synced as
+    a payload through juju in which case only the sync user is needed."""
+    if config('ssl-sync-transport') in SSL_SYNC_PAYLOAD_TRANSPORTS:
+        unison.ensure_user(user=SSH_USER, group='juju_keystone')
+        return
+
     unison.ssh_authorized_peers(user=SSH_USER,
                                 group='juju_keystone',
                                 peer_interface='cluster',
                                 ensure_local_user=True)
 
+
+@hooks.hook('cluster-relation-joined')
+def cluster_joined():
+    ensure_ssl_sync_access()
+
     settings = {}
 
     for addr_type in ADDRESS_TYPES:
@@ -442,13 +495,10 @@ def cluster_joined():
 
 @hooks.hook('cluster-relation-changed',
             'cluster-relation-departed')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map(), stopstart=True, reload_map=reload_map())
 @update_certs_if_available
 def cluster_changed():
-    unison.ssh_authorized_peers(user=SSH_USER,
-                                group='juju_keystone',
-                                peer_interface='cluster',
-                                ensure_local_user=True)
+    ensure_ssl_sync_access()
     # NOTE(jamespage) re-echo passwords for peer storage
     echo_whitelist = ['_passwd', 'identity-service:', 'ssl-cert-master',
                       'db-initialised', 'ssl-cert-available-updates']
@@ -460,17 +510,9 @@ def cluster_changed():
     initialise_pki()
 
     # Figure out if we need to mandate a sync
-    units = get_ssl_sync_request_units()
-    synced_units = relation_get(attribute='ssl-synced-units',
-                                unit=local_unit())
-    diff = None
-    if synced_units:
-        synced_units = json.loads(synced_units)
-        diff = set(units).symmetric_difference(set(synced_units))
-
-    if units and (not synced_units or diff):
-        log("New peers joined and need syncing - %s" %
-            (', '.join(units)), level=DEBUG)
+    units = ssl_sync_required_units()
+    if units:
+        log("Peers need syncing - %s" % (', '.join(units)), level=DEBUG)
         update_all_identity_relation_units_force_sync()
     else:
         update_all_identity_relation_units()
@@ -485,9 +527,19 @@ def cluster_changed():
     else:
         CONFIGS.write_all()
 
+    update_restart_slots(CONFIGS)
+
 
 @hooks.hook('leader-settings-changed')
+@restart_on_change(restart_map(), stopstart=True, reload_map=reload_map())
+@update_certs_if_available
 def leader_settings_changed():
+    if config('ssl-sync-transport') == 'leader':
+        # Flags arrive with the sync payload, there is no restart trigger.
+        check_peer_actions(force=True)
+
+    update_restart_slots(CONFIGS)
+
     log('Firing identity_changed hook for all related services.')
     for rid in relation_ids('identity-service'):
             for unit in related_units(rid):
@@ -556,7 +608,7 @@ def ha_joined(relation_id=None):
 
 
 @hooks.hook('ha-relation-changed')
-@restart_on_change(restart_map())
+@restart_on_change(restart_map(), reload_map=reload_map())
 @synchronize_ca_if_changed()
 def ha_changed():
     CONFIGS.write_all()
@@ -600,15 +652,14 @@ def configure_https():
 
 
 @hooks.hook('upgrade-charm')
-@restart_on_change(restart_map(), stopstart=True)
+@restart_on_change(restart_map(), stopstart=True, reload_map=reload_map())
 @synchronize_ca_if_changed()
 def upgrade_charm():
     status_set('maintenance', 'Installing apt packages')
     apt_install(filter_installed_packages(determine_packages()))
-    unison.ssh_authorized_peers(user=SSH_USER,
-                                group='juju_keystone',
-                                peer_interface='cluster',
-                                ensure_local_user=True)
+    # Templates shipped with the new charm are compiled afresh
+    CONFIGS.clear_template_cache()
+    ensure_ssl_sync_access()
 
     ensure_ssl_dirs()
 
@@ -5,6 +5,7 @@ import shutil
 import subprocess
 import tarfile
 import tempfile
+import threading
 
 from charmhelpers.core.hookenv import (
     log,
@@ -272,6 +273,9 @@ class JujuCA(object):
         self.root_ca_dir = root_ca_dir
         self.user = user
         self.group = group
+        # openssl ca updates the CA's serial and index files so signing must
+        # be serialised, keys may be generated concurrently.
+        self._sign_lock = threading.Lock()
         update_bundle(CA_BUNDLE, self.get_ca_bundle())
 
     def _sign_csr(self, csr, service, common_name):
@@ -291,9 +295,11 @@ class JujuCA(object):
         cmd = ['openssl', 'req', '-sha1', '-newkey', 'rsa', '-nodes',
                '-keyout', key, '-out', csr, '-subj', subj]
         subprocess.check_call(cmd)
-        crt = self._sign_csr(csr, service, common_name)
-        cmd = ['chown', '-R', '%s.%s' % (self.user, self.group), self.ca_dir]
-        subprocess.check_call(cmd)
+        with self._sign_lock:
+            crt = self._sign_csr(csr, service, common_name)
+            cmd = ['chown', '-R', '%s.%s' % (self.user, self.group),
+                   self.ca_dir]
+            subprocess.check_call(cmd)
         log('Signed new CSR, crt @ %s' % crt, level=DEBUG)
         return crt, key
 
@@ -2,21 +2,28 @@
 import glob
 import grp
 import hashlib
+import httplib
 import json
 import os
 import pwd
 import re
 import shutil
+import socket
 import subprocess
 import tarfile
+import tempfile
 import threading
 import time
+import urllib2
 import urlparse
 import uuid
+import zlib
 
 from itertools import chain
-from base64 import b64encode
+from StringIO import StringIO
+from base64 import b64decode, b64encode
 from collections import OrderedDict
+from contextlib import contextmanager
 from copy import deepcopy
 
 from charmhelpers.contrib.hahelpers.cluster import(
@@ -71,7 +78,12 @@ from charmhelpers.core.decorators import (
 from charmhelpers.core.hookenv import (
     charm_dir,
     config,
+    flush_log,
+    flush_relation_writes,
+    is_leader,
     is_relation_made,
+    leader_get,
+    leader_set,
     log,
     local_unit,
     relation_get,
@@ -80,6 +92,7 @@ from charmhelpers.core.hookenv import (
     relation_ids,
     related_units,
     DEBUG,
+    ERROR,
     INFO,
     WARNING,
     status_get,
@@ -104,6 +117,8 @@ from charmhelpers.core.host import (
     pwgen,
     lsb_release,
     write_file,
+    file_hash,
+    FILE_HASH_MTIME_SLACK,
 )
 
 from charmhelpers.contrib.peerstorage import (
@@ -117,6 +132,12 @@ from charmhelpers.core.templating import render
 import keystone_context
 import keystone_ssl as ssl
 
+from keystone_catalog import (
+    KeystoneCatalog,
+    reconcile,
+    worker_pool,
+)
+
 from charmhelpers.core.unitdata import (
     HookData,
     kv,
@@ -183,7 +204,45 @@ CLUSTER_RES = 'grp_ks_vips'
 SSH_USER = 'juju_keystone'
 CA_CERT_PATH = '/usr/local/share/ca-certificates/keystone_juju_ca_cert.crt'
 SSL_SYNC_SEMAPHORE = threading.Semaphore()
+# Seconds to wait for the keystone API to answer after it is (re)started,
+# and the longest pause between two probes.
+KEYSTONE_READY_TIMEOUT = 60
+KEYSTONE_READY_MAX_DELAY = 2
+# Cluster relation settings of a unit asking for a rolling restart slot and
+# of the slot holders it has taken out of haproxy, and the leader setting of
+# the slots granted, see claim_restart_slot().
+RESTART_REQUEST_KEY = 'restart-request'
+RESTART_DRAINED_KEY = 'restart-drained'
+RESTART_SLOTS_KEY = 'restart-slots'
+# Upper bound on peers synced concurrently by unison_sync().
+UNISON_SYNC_WORKERS = 4
+# kv keys of the digests of the passwords last set for catalog users and of
+# the secret they are keyed with, see apply_catalog().
+CATALOG_PASSWORDS_KEY = 'catalog-passwords'
+CATALOG_PASSWORDS_KEY_KEY = 'catalog-passwords-key'
+# kv key of the manifest of SSL_DIRS, see ssl_manifest().
+SSL_MANIFEST_KEY = 'ssl-manifest'
+# kv key of the files last staged for peers by the sync master, see
+# stage_paths_for_sync().
+SSL_SYNC_STAGED_KEY = 'ssl-sync-staged'
+# kv and cluster relation key of the digest of the last sync archive a peer
+# applied.
+SSL_APPLIED_DIGEST_KEY = 'ssl-applied-digest'
+# Member of the sync archive describing its content.
+SSL_SYNC_MANIFEST_MEMBER = 'juju-ssl-sync-manifest.json'
+# Values of ssl-sync-transport which publish the sync archive as a payload
+# rather than copying it to peers with unison, see publish_sync_payload().
+SSL_SYNC_PAYLOAD_TRANSPORTS = ['relation', 'leader']
+SSL_SYNC_PAYLOAD_KEY = 'ssl-sync-payload'
+SSL_SYNC_CHUNK_PREFIX = 'ssl-sync-chunk-'
+# Bytes of the sync archive held by each payload chunk, before compression.
+SSL_SYNC_CHUNK_SIZE = 48 * 1024
 SSL_DIRS = [SSL_DIR, APACHE_SSL_DIR, CA_CERT_PATH]
+# Context generators serving more than one config file are shared so that
+# CONFIGS.write_all() only evaluates them once.
+HAPROXY_CONTEXT = keystone_context.HAProxyContext()
+APACHE_SSL_CONTEXT = keystone_context.ApacheSSLContext()
+
 BASE_RESOURCE_MAP = OrderedDict([
     (KEYSTONE_CONF, {
         'services': BASE_SERVICES,
@@ -191,7 +250,7 @@ BASE_RESOURCE_MAP = OrderedDict([
                      context.SharedDBContext(ssl_dir=KEYSTONE_CONF_DIR),
                      context.PostgresqlDBContext(),
                      context.SyslogContext(),
-                     keystone_context.HAProxyContext(),
+                     HAPROXY_CONTEXT,
                      context.BindHostContext(),
                      context.WorkerConfigContext()],
     }),
@@ -201,16 +260,21 @@ BASE_RESOURCE_MAP = OrderedDict([
     }),
     (HAPROXY_CONF, {
         'contexts': [context.HAProxyContext(singlenode_mode=True),
-                     keystone_context.HAProxyContext()],
+                     HAPROXY_CONTEXT],
         'services': ['haproxy'],
+        # Soft reload, the old haproxy finishes serving open connections
+        'reload': ['haproxy'],
     }),
     (APACHE_CONF, {
-        'contexts': [keystone_context.ApacheSSLContext()],
+        'contexts': [APACHE_SSL_CONTEXT],
         'services': ['apache2'],
+        # Graceful reload
+        'reload': ['apache2'],
     }),
     (APACHE_24_CONF, {
-        'contexts': [keystone_context.ApacheSSLContext()],
+        'contexts': [APACHE_SSL_CONTEXT],
         'services': ['apache2'],
+        'reload': ['apache2'],
     }),
 ])
 
@@ -297,6 +361,10 @@ valid_services = {
     },
 }
 
+# the minimum settings needed per endpoint requested over identity-service
+ENDPOINT_SETTINGS = frozenset(['service', 'region', 'public_url', 'admin_url',
+                               'internal_url'])
+
 # The interface is said to be satisfied if anyone of the interfaces in the
 # list has a complete context.
 REQUIRED_INTERFACES = {
@@ -351,6 +419,13 @@ def restart_map():
                         if v['services']])
 
 
+def reload_map():
+    """Services which only need reloading when a config file changes"""
+    return OrderedDict([(cfg, v['reload'])
+                        for cfg, v in resource_map().iteritems()
+                        if v.get('reload')])
+
+
 def services():
     """Returns a list of (unique) services associated with this charm"""
     return list(set(chain(*restart_map().values())))
@@ -392,6 +467,11 @@ def save_script_rc():
 def do_openstack_upgrade_reexec(configs):
     do_openstack_upgrade(configs)
     log("Re-execing hook to pickup upgraded packages", level=INFO)
+    # The exec skips atexit callbacks, so write out the relation settings
+    # and log messages buffered so far, such as db-initialised, before
+    # replacing the process.
+    flush_relation_writes()
+    flush_log()
     os.execl('./hooks/config-changed-postupgrade', '')
 
 
@@ -446,9 +526,216 @@ def migrate_database():
     cmd = ['sudo', '-u', 'keystone', 'keystone-manage', 'db_sync']
     subprocess.check_output(cmd)
     service_start('keystone')
-    time.sleep(10)
+    waited = wait_for_keystone_ready()
+    log('Keystone ready %.1fs after database migration.' % waited,
+        level=INFO)
     peer_store('db-initialised', 'True')
 
+
+class KeystoneNotReadyError(Exception):
+    """Keystone did not answer in time, see wait_for_keystone_ready()"""
+    pass
+
+
+def wait_for_keystone_ready(endpoint=None, timeout=KEYSTONE_READY_TIMEOUT):
+    """Wait for the keystone API at endpoint to answer.
+
+    endpoint defaults to get_local_endpoint(). Each probe connects to the
+    API port and then fetches the version document, bypassing any proxy set
+    in the environment; probes back off exponentially until timeout seconds
+    have passed, when KeystoneNotReadyError is raised.
+
+    Returns the number of seconds waited.
+    """
+    if endpoint is None:
+        endpoint = get_local_endpoint()
+
+    # The probe targets this unit, never send it through http(s)_proxy.
+    opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+
+    url = urlparse.urlparse(endpoint)
+    port = url.port or (443 if url.scheme == 'https' else 80)
+    start = time.time()
+    delay = 0.1
+    while True:
+        remaining = start + timeout - time.time()
+        probe_timeout = max(1, min(remaining, 5))
+        try:
+            socket.create_connection((url.hostname, port),
+                                     timeout=probe_timeout).close()
+            opener.open(endpoint, timeout=probe_timeout).close()
+            break
+        except urllib2.HTTPError as e:
+            # Any answer short of a server error means keystone is serving.
+            if e.code < 500:
+                break
+            reason = e
+        except (socket.error, urllib2.URLError, httplib.HTTPException) as e:
+            reason = e
+
+        remaining = start + timeout - time.time()
+        if remaining <= 0:
+            raise KeystoneNotReadyError('Keystone at %s not ready after %ds: '
+                                        '%s' % (endpoint, timeout, reason))
+
+        log('Keystone at %s not ready yet: %s' % (endpoint, reason),
+            level=DEBUG)
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, KEYSTONE_READY_MAX_DELAY)
+
+    return time.time() - start
+
+
+def rolling_restart_peers():
+    """The cluster relation id and peer units taking part in rolling
+    restarts, or (None, []) if they are disabled or the unit has no peers"""
+    if not config('rolling-restart-concurrency'):
+        return None, []
+
+    for rid in relation_ids('cluster'):
+        units = related_units(rid)
+        if units:
+            return rid, units
+    return None, []
+
+
+def restart_slots():
+    """Units holding a rolling restart slot, mapped to the request they were
+    granted it for"""
+    slots = leader_get(RESTART_SLOTS_KEY)
+    return json.loads(slots) if slots else {}
+
+
+def grant_restart_slots():
+    """Hand out rolling restart slots, if this unit is the leader.
+
+    A slot is released when its holder clears its request or leaves the
+    cluster. Free slots go to the units asking for one in order of unit
+    number, so that at most rolling-restart-concurrency units restart at
+    the same time while the others keep serving behind the VIP.
+
+    :returns: the slots now granted.
+    """
+    slots = restart_slots()
+    if not is_leader():
+        return slots
+
+    requests = {}
+    rid, peers = rolling_restart_peers()
+    for unit in ([local_unit()] + peers if rid else []):
+        request = relation_get(RESTART_REQUEST_KEY, unit=unit, rid=rid)
+        if request:
+            requests[unit] = request
+
+    granted = dict((unit, request) for unit, request in slots.items()
+                   if requests.get(unit) == request)
+    waiting = sorted((unit for unit in requests if unit not in granted),
+                     key=lambda u: int(u.split('/')[-1]))
+    free = max(config('rolling-restart-concurrency') - len(granted), 0)
+    for unit in waiting[:free]:
+        granted[unit] = requests[unit]
+
+    if granted != slots:
+        log('Rolling restart slots granted to: %s' %
+            (', '.join(sorted(granted)) or 'none'), level=INFO)
+        leader_set({RESTART_SLOTS_KEY:
+                    json.dumps(granted, sort_keys=True) if granted else None})
+    return granted
+
+
+def draining_units():
+    """Peers holding a rolling restart slot, which are left out of haproxy
+    backends while they restart"""
+    if not rolling_restart_peers()[0]:
+        return []
+    return [unit for unit in restart_slots() if unit != local_unit()]
+
+
+def update_restart_slots(configs):
+    """Take part in rolling restarts after peer or leader settings change.
+
+    The leader grants slots. Every unit then leaves the units holding one
+    out of its haproxy backends, and tells them so on the cluster relation
+    once the configuration is written, see claim_restart_slot().
+    """
+    rid, _ = rolling_restart_peers()
+    if not rid:
+        return
+
+    slots = grant_restart_slots()
+    configs.write(HAPROXY_CONF)
+    unit = local_unit()
+    drained = ' '.join(sorted('%s=%s' % (u, request)
+                              for u, request in slots.items() if u != unit))
+    if drained != (relation_get(RESTART_DRAINED_KEY, unit=unit,
+                                rid=rid) or ''):
+        relation_set(relation_id=rid,
+                     relation_settings={RESTART_DRAINED_KEY: drained or None})
+
+
+def claim_restart_slot(services):
+    """Claim a rolling restart slot before restarting services.
+
+    Run by defer_restarts() before any restart, reloads need no slot. The
+    unit asks the leader for a slot on the cluster relation, and restarts
+    are held back for a later hook until one is granted and every peer has
+    drained the unit, ie. taken it out of its haproxy backends.
+
+    :returns: False to hold the restarts back, True to go ahead.
+    """
+    rid, peers = rolling_restart_peers()
+    if not peers:
+        return True
+
+    unit = local_unit()
+    request = relation_get(RESTART_REQUEST_KEY, unit=unit, rid=rid)
+    if not request:
+        request = '%.6f' % time.time()
+        relation_set(relation_id=rid,
+                     relation_settings={RESTART_REQUEST_KEY: request})
+
+    if grant_restart_slots().get(unit) != request:
+        log('Rolling restart of %s: waiting for a slot' %
+            ', '.join(services), level=INFO)
+        return False
+
+    token = '%s=%s' % (unit, request)
+    draining = [peer for peer in peers
+                if token not in (relation_get(RESTART_DRAINED_KEY, unit=peer,
+                                              rid=rid) or '').split()]
+    if draining:
+        log('Rolling restart of %s: waiting for %s to drain this unit' %
+            (', '.join(services), ', '.join(draining)), level=INFO)
+        return False
+
+    log('Rolling restart of %s: slot granted' % ', '.join(services),
+        level=INFO)
+    return True
+
+
+def check_restarted(services):
+    """Release the rolling restart slot once keystone answers again.
+
+    If keystone does not come back the hook fails, keeping the slot so that
+    no other unit restarts, and the restarts stay queued to be retried.
+    """
+    rid, peers = rolling_restart_peers()
+    if not peers:
+        return
+
+    if 'keystone' in services:
+        try:
+            waited = wait_for_keystone_ready()
+        except KeystoneNotReadyError as e:
+            log('Keystone not healthy after restart, keeping the rolling '
+                'restart slot: %s' % e, level=ERROR)
+            raise
+        log('Keystone healthy %.1fs after restart' % waited, level=INFO)
+
+    relation_set(relation_id=rid,
+                 relation_settings={RESTART_REQUEST_KEY: None})
+    grant_restart_slots()
+
 # OLD
 
 
@@ -505,171 +792,124 @@ def get_admin_token():
     error_out('Could not find admin_token line in %s' % KEYSTONE_CONF)
 
 
-def is_service_present(service_name, service_type):
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    service_id = manager.resolve_service_id(service_name, service_type)
-    return service_id is not None
-
-
-def delete_service_entry(service_name, service_type):
-    """ Delete a service from keystone"""
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    service_id = manager.resolve_service_id(service_name, service_type)
-    if service_id:
-        manager.api.services.delete(service_id)
-        log("Deleted service entry '%s'" % service_name, level=DEBUG)
+def get_manager():
+    """Return the KeystoneManager shared by all helpers for this hook.
 
-
-def create_service_entry(service_name, service_type, service_desc, owner=None):
-    """ Add a new service entry to keystone if one does not already exist """
+    The manager, its client and its keep-alive connections to the local
+    endpoint are created on first use, which is also the only time the admin
+    token is read from keystone.conf.
+    """
+    # NOTE: ks client may not be installed at module import time.
     import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    for service in [s._info for s in manager.api.services.list()]:
-        if service['name'] == service_name:
-            log("Service entry for '%s' already exists." % service_name,
-                level=DEBUG)
-            return
+    if not manager.MANAGER_SINGLETON:
+        if manager.client_v3 and os_release('keystone') >= 'kilo':
+            # Resolve names with filtered v3 queries rather than listing
+            # every user and project.
+            manager_class = manager.KeystoneManager3
+        else:
+            manager_class = manager.KeystoneManager
 
-    manager.api.services.create(name=service_name,
-                                service_type=service_type,
-                                description=service_desc)
-    log("Created new service entry '%s'" % service_name, level=DEBUG)
+        manager.MANAGER_SINGLETON.append(
+            manager_class(endpoint=get_local_endpoint(),
+                          token=get_admin_token()))
 
+    return manager.MANAGER_SINGLETON[0]
 
-def create_endpoint_template(region, service, publicurl, adminurl,
-                             internalurl):
-    """ Create a new endpoint template for service if one does not already
-        exist matching name *and* region """
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    service_id = manager.resolve_service_id(service)
-    for ep in [e._info for e in manager.api.endpoints.list()]:
-        if ep['service_id'] == service_id and ep['region'] == region:
-            log("Endpoint template already exists for '%s' in '%s'"
-                % (service, region))
-
-            up_to_date = True
-            for k in ['publicurl', 'adminurl', 'internalurl']:
-                if ep.get(k) != locals()[k]:
-                    up_to_date = False
-
-            if up_to_date:
-                return
-            else:
-                # delete endpoint and recreate if endpoint urls need updating.
-                log("Updating endpoint template with new endpoint urls.")
-                manager.api.endpoints.delete(ep['id'])
 
-    manager.api.endpoints.create(region=region,
-                                 service_id=service_id,
-                                 publicurl=publicurl,
-                                 adminurl=adminurl,
-                                 internalurl=internalurl)
-    log("Created new endpoint template for '%s' in '%s'" % (region, service),
-        level=DEBUG)
+def apply_catalog(catalog, dry_run=False):
+    """Bring keystone in line with catalog, making only the API calls needed.
 
+    The password of an existing user is only set again when it differs from
+    the one the charm last set, going by the digest kept in kv. A password
+    changed outside the charm is therefore left as it is, not reset.
 
-def create_tenant(name):
-    """Creates a tenant if it does not already exist"""
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    tenants = [t._info for t in manager.api.tenants.list()]
-    if not tenants or name not in [t['name'] for t in tenants]:
-        manager.api.tenants.create(tenant_name=name,
-                                   description='Created by Juju')
-        log("Created new tenant: %s" % name, level=DEBUG)
+    Returns the CatalogPlan that was applied, or with dry_run that would have
+    been applied.
+    """
+    manager = get_manager()
+    db = kv()
+    key = db.get(CATALOG_PASSWORDS_KEY_KEY)
+    if not key:
+        # Digests kept under a previous key no longer match, so each user's
+        # password is set (to the same value) once more.
+        key = pwgen(length=64)
+        db.set(CATALOG_PASSWORDS_KEY_KEY, key)
+        db.set(CATALOG_PASSWORDS_KEY, {})
+
+    passwords = db.get(CATALOG_PASSWORDS_KEY) or {}
+    plan = reconcile(manager, catalog, passwords=passwords, key=key)
+    log(str(plan), level=DEBUG)
+    plan.apply(manager, passwords=passwords, dry_run=dry_run)
+    if plan and not dry_run:
+        db.set(CATALOG_PASSWORDS_KEY, passwords)
+
+    return plan
+
+
+@contextmanager
+def catalog_batch(catalog=None):
+    """Yield catalog to add requests to.
+
+    If no catalog is given a new one is yielded and applied on exit, so
+    helpers taking an optional catalog either take part in a larger batch or
+    update keystone straight away.
+    """
+    if catalog is not None:
+        yield catalog
         return
 
-    log("Tenant '%s' already exists." % name, level=DEBUG)
+    catalog = KeystoneCatalog()
+    yield catalog
+    apply_catalog(catalog)
 
 
-def user_exists(name):
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    users = [u._info for u in manager.api.users.list()]
-    if not users or name not in [u['name'] for u in users]:
-        return False
-
-    return True
+def is_service_present(service_name, service_type):
+    manager = get_manager()
+    service_id = manager.resolve_service_id(service_name, service_type)
+    return service_id is not None
 
 
-def create_user(name, password, tenant):
-    """Creates a user if it doesn't already exist, as a member of tenant"""
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    if user_exists(name):
-        log("A user named '%s' already exists" % name, level=DEBUG)
-        return
+def delete_service_entry(service_name, service_type, catalog=None):
+    """ Delete a service from keystone"""
+    with catalog_batch(catalog) as batch:
+        batch.remove_service(service_name, service_type)
 
-    tenant_id = manager.resolve_tenant_id(tenant)
-    if not tenant_id:
-        error_out('Could not resolve tenant_id for tenant %s' % tenant)
 
-    manager.api.users.create(name=name,
-                             password=password,
-                             email='juju@localhost',
-                             tenant_id=tenant_id)
-    log("Created new user '%s' tenant: %s" % (name, tenant_id),
-        level=DEBUG)
+def create_service_entry(service_name, service_type, service_desc, owner=None,
+                         catalog=None):
+    """ Add a new service entry to keystone if one does not already exist """
+    with catalog_batch(catalog) as batch:
+        batch.add_service(service_name, service_type, service_desc)
 
 
-def create_role(name, user=None, tenant=None):
-    """Creates a role if it doesn't already exist. grants role to user"""
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    roles = [r._info for r in manager.api.roles.list()]
-    if not roles or name not in [r['name'] for r in roles]:
-        manager.api.roles.create(name=name)
-        log("Created new role '%s'" % name, level=DEBUG)
-    else:
-        log("A role named '%s' already exists" % name, level=DEBUG)
+def create_endpoint_template(region, service, publicurl, adminurl,
+                             internalurl, catalog=None):
+    """ Create a new endpoint template for service if one does not already
+        exist matching name *and* region, otherwise update the existing
+        endpoint's urls in place """
+    with catalog_batch(catalog) as batch:
+        batch.add_endpoint(service, region, publicurl=publicurl,
+                           adminurl=adminurl, internalurl=internalurl)
 
-    if not user and not tenant:
-        return
 
-    # NOTE(adam_g): Keystone client requires id's for add_user_role, not names
-    user_id = manager.resolve_user_id(user)
-    role_id = manager.resolve_role_id(name)
-    tenant_id = manager.resolve_tenant_id(tenant)
+def create_tenant(name, catalog=None):
+    """Creates a tenant if it does not already exist"""
+    with catalog_batch(catalog) as batch:
+        batch.add_tenant(name, description='Created by Juju')
 
-    if None in [user_id, role_id, tenant_id]:
-        error_out("Could not resolve [%s, %s, %s]" %
-                  (user_id, role_id, tenant_id))
 
-    grant_role(user, name, tenant)
+def create_role(name, user=None, tenant=None, catalog=None):
+    """Creates a role if it doesn't already exist. grants role to user"""
+    with catalog_batch(catalog) as batch:
+        batch.add_role(name)
+        if user or tenant:
+            batch.add_grant(user, name, tenant)
 
 
-def grant_role(user, role, tenant):
+def grant_role(user, role, tenant, catalog=None):
     """Grant user and tenant a specific role"""
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    log("Granting user '%s' role '%s' on tenant '%s'" %
-        (user, role, tenant))
-    user_id = manager.resolve_user_id(user)
-    role_id = manager.resolve_role_id(role)
-    tenant_id = manager.resolve_tenant_id(tenant)
-
-    cur_roles = manager.api.roles.roles_for_user(user_id, tenant_id)
-    if not cur_roles or role_id not in [r.id for r in cur_roles]:
-        manager.api.roles.add_user_role(user=user_id,
-                                        role=role_id,
-                                        tenant=tenant_id)
-        log("Granted user '%s' role '%s' on tenant '%s'" %
-            (user, role, tenant), level=DEBUG)
-    else:
-        log("User '%s' already has role '%s' on tenant '%s'" %
-            (user, role, tenant), level=DEBUG)
+    with catalog_batch(catalog) as batch:
+        batch.add_grant(user, role, tenant)
 
 
 def store_admin_passwd(passwd):
@@ -708,7 +948,7 @@ def get_admin_passwd():
     return passwd
 
 
-def ensure_initial_admin(config):
+def ensure_initial_admin(config, catalog=None):
     # Allow retry on fail since leader may not be ready yet.
     # NOTE(hopem): ks client may not be installed at module import time so we
     # use this wrapped approach instead.
@@ -719,6 +959,9 @@ def ensure_initial_admin(config):
         from keystoneclient.exceptions import (ClientException as
                                                InternalServerError)
 
+    # Don't spend the retries below on a keystone that is still starting.
+    wait_for_keystone_ready()
+
     @retry_on_exception(3, base_delay=3, exc_type=InternalServerError)
     def _ensure_initial_admin(config):
         """Ensures the minimum admin stuff exists in whatever database we're
@@ -729,29 +972,37 @@ def ensure_initial_admin(config):
         the admin tenant, user, role, service entry and endpoint across every
         datastore we might use.
 
+        Any requests already in catalog are reconciled in the same batch.
+
         TODO: Possibly migrate data from one backend to another after it
         changes?
         """
-        create_tenant("admin")
-        create_tenant(config("service-tenant"))
-        # User is managed by ldap backend when using ldap identity
-        if not (config('identity-backend') ==
-                'ldap' and config('ldap-readonly')):
-            passwd = get_admin_passwd()
-            if passwd:
-                create_user_credentials(config('admin-user'), 'admin', passwd,
-                                        new_roles=[config('admin-role')])
-
-        create_service_entry("keystone", "identity",
-                             "Keystone Identity Service")
-
-        for region in config('region').split():
-            create_keystone_endpoint(public_ip=resolve_address(PUBLIC),
-                                     service_port=config("service-port"),
-                                     internal_ip=resolve_address(INTERNAL),
-                                     admin_ip=resolve_address(ADMIN),
-                                     auth_port=config("admin-port"),
-                                     region=region)
+        with catalog_batch() as batch:
+            create_tenant("admin", catalog=batch)
+            create_tenant(config("service-tenant"), catalog=batch)
+            # User is managed by ldap backend when using ldap identity
+            if not (config('identity-backend') ==
+                    'ldap' and config('ldap-readonly')):
+                passwd = get_admin_passwd()
+                if passwd:
+                    create_user_credentials(config('admin-user'), 'admin',
+                                            passwd,
+                                            new_roles=[config('admin-role')],
+                                            catalog=batch)
+
+            create_service_entry("keystone", "identity",
+                                 "Keystone Identity Service", catalog=batch)
+
+            for region in config('region').split():
+                create_keystone_endpoint(public_ip=resolve_address(PUBLIC),
+                                         service_port=config("service-port"),
+                                         internal_ip=resolve_address(INTERNAL),
+                                         admin_ip=resolve_address(ADMIN),
+                                         auth_port=config("admin-port"),
+                                         region=region, catalog=batch)
+
+            if catalog is not None:
+                batch.update(catalog)
 
     return _ensure_initial_admin(config)
 
@@ -766,26 +1017,13 @@ def endpoint_url(ip, port):
 
 
 def create_keystone_endpoint(public_ip, service_port,
-                             internal_ip, admin_ip, auth_port, region):
+                             internal_ip, admin_ip, auth_port, region,
+                             catalog=None):
     create_endpoint_template(region, "keystone",
                              endpoint_url(public_ip, service_port),
                              endpoint_url(admin_ip, auth_port),
-                             endpoint_url(internal_ip, service_port))
-
-
-def update_user_password(username, password):
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    log("Updating password for user '%s'" % username)
-
-    user_id = manager.resolve_user_id(username)
-    if user_id is None:
-        error_out("Could not resolve user id for '%s'" % username)
-
-    manager.api.users.update_password(user=user_id, password=password)
-    log("Successfully updated password for user '%s'" %
-        username)
+                             endpoint_url(internal_ip, service_port),
+                             catalog=catalog)
 
 
 def load_stored_passwords(path=SERVICE_PASSWD_PATH):
@@ -863,13 +1101,14 @@ def ensure_permissions(path, user=None, group=None, perms=None, recurse=False,
                                recurse=recurse, maxdepth=maxdepth - 1)
 
 
-def check_peer_actions():
+def check_peer_actions(force=False):
     """Honour service action requests from sync master.
 
     Check for service action request flags, perform the action then delete the
-    flag.
+    flag. Unless force is True flags are only honoured once the master has
+    sent a restart-services-trigger.
     """
-    restart = relation_get(attribute='restart-services-trigger')
+    restart = force or relation_get(attribute='restart-services-trigger')
     if restart and os.path.isdir(SYNC_FLAGS_DIR):
         for flagfile in glob.glob(os.path.join(SYNC_FLAGS_DIR, '*')):
             flag = os.path.basename(flagfile)
@@ -940,14 +1179,15 @@ def create_peer_actions(actions):
 
 
 @retry_on_exception(3, base_delay=2, exc_type=subprocess.CalledProcessError)
-def unison_sync(paths_to_sync):
+def unison_sync(paths_to_sync, units=None):
     """Do unison sync and retry a few times if it fails since peers may not be
-    ready for sync.
+    ready for sync. If units is given only those peers are synced.
 
     Returns list of synced units or None if one or more peers was not synced.
     """
-    log('Synchronizing CA (%s) to all peers.' % (', '.join(paths_to_sync)),
-        level=INFO)
+    log('Synchronizing CA (%s) to %s.' %
+        (', '.join(paths_to_sync),
+         'all peers' if units is None else ', '.join(units)), level=INFO)
     keystone_gid = grp.getgrnam('keystone').gr_gid
 
     # NOTE(dosaboy): This will sync to all peers who have already provided
@@ -955,16 +1195,66 @@ def unison_sync(paths_to_sync):
     # they will be silently ignored.
     unison.sync_to_peers(peer_interface='cluster', paths=paths_to_sync,
                          user=SSH_USER, verbose=True, gid=keystone_gid,
-                         fatal=True)
+                         fatal=True, workers=UNISON_SYNC_WORKERS, units=units)
 
     synced_units = peer_units()
-    if len(unison.collect_authed_hosts('cluster')) != len(synced_units):
+    targets = synced_units if units is None else units
+    if len(unison.collect_authed_hosts('cluster', units)) != len(targets):
         log("Not all peer units synced due to missing public keys", level=INFO)
         return None
     else:
         return synced_units
 
 
+def ssl_sync_status():
+    """Convergence of peers on the certs last staged by this unit.
+
+    Returns a dict of the digest staged, the peers which applied it and those
+    which have not (yet), or None if this unit is not the ssl-cert-master.
+    """
+    if not is_ssl_cert_master():
+        return None
+
+    digest = (kv().get(SSL_SYNC_STAGED_KEY) or {}).get('digest')
+    applied = peer_applied_digests()
+    synced = sorted(unit for unit, _digest in applied.items()
+                    if digest and _digest == digest)
+    return {'digest': digest, 'synced': synced,
+            'pending': sorted(set(applied) - set(synced))}
+
+
+def ssl_sync_required_units():
+    """Peers the ssl-cert-master needs to sync, none on other units.
+
+    Peers publishing the digest of the certs they applied need syncing if it
+    differs from the one last staged, others if they requested a sync which
+    has not been done yet.
+
+    NOTE: this must be called from cluster relation context.
+    """
+    status = ssl_sync_status()
+    if status is None:
+        log("Not ssl-cert-master - no peers to sync", level=DEBUG)
+        return []
+
+    log("SSL sync status: %s of %s peers have applied %s" %
+        (len(status['synced']), len(status['synced']) +
+         len(status['pending']), status['digest']), level=DEBUG)
+    requested = get_ssl_sync_request_units()
+    synced = relation_get(attribute='ssl-synced-units', unit=local_unit())
+    synced = json.loads(synced) if synced else []
+    units = []
+    for unit, digest in peer_applied_digests().items():
+        if digest:
+            if unit in status['pending']:
+                units.append(unit)
+        elif (unit.replace('/', '-') in requested and
+              unit.replace('/', '-') not in synced):
+            units.append(unit)
+
+    return sorted(units)
+
+
 def get_ssl_sync_request_units():
     """Get list of units that have requested to be synced.
 
@@ -1056,20 +1346,59 @@ def ensure_ssl_cert_master():
     return True
 
 
+def peer_applied_digests():
+    """Digests of the sync archives last applied by each peer"""
+    digests = {}
+    for rid in relation_ids('cluster'):
+        for unit in related_units(rid):
+            digests[unit] = relation_get(attribute=SSL_APPLIED_DIGEST_KEY,
+                                         rid=rid, unit=unit)
+    return digests
+
+
 def stage_paths_for_sync(paths):
+    """Pack the files under paths into SSL_SYNC_ARCHIVE for peers.
+
+    If every peer has applied the files staged last time only those which
+    changed since are packed, along with a manifest listing the removed ones,
+    otherwise every file is. Returns the digest of the staged files.
+    """
+    manifest = ssl_manifest()
+    files = dict((os.path.normpath(path), entry[3])
+                 for path, entry in manifest.items()
+                 if _path_under(path, paths))
+    digest = manifest_digest(manifest, paths)
+
+    db = kv()
+    staged = db.get(SSL_SYNC_STAGED_KEY) or {}
+    base = staged.get('digest')
+    applied = set(peer_applied_digests().values())
+    if not base or applied != set([base]):
+        base = None
+        staged = {'files': {}}
+
     shutil.rmtree(SYNC_DIR)
     ensure_ssl_dirs()
+    changed = [path for path in sorted(files)
+               if staged['files'].get(path) != files[path]]
+    removed = sorted(set(staged['files']) - set(files))
+    log("Staging %s of %s files for sync (%s removed)" %
+        (len(changed), len(files), len(removed)), level=DEBUG)
     with tarfile.open(SSL_SYNC_ARCHIVE, 'w') as fd:
-        for path in paths:
-            if os.path.exists(path):
-                log("Adding path '%s' sync tarball" % (path), level=DEBUG)
-                fd.add(path)
-            else:
-                log("Path '%s' does not exist - not adding to sync "
-                    "tarball" % (path), level=INFO)
-
+        # The manifest goes first so peers can stream the archive.
+        info = json.dumps({'digest': digest, 'base': base,
+                           'removed': removed})
+        member = tarfile.TarInfo(SSL_SYNC_MANIFEST_MEMBER)
+        member.size = len(info)
+        member.mtime = time.time()
+        fd.addfile(member, StringIO(info))
+        for path in changed:
+            fd.add(path, recursive=False)
+
+    db.set(SSL_SYNC_STAGED_KEY, {'digest': digest, 'files': files})
     ensure_permissions(SYNC_DIR, user=SSH_USER, group='keystone',
                        perms=0o755, recurse=True)
+    return digest
 
 
 def is_pki_enabled():
@@ -1110,18 +1439,21 @@ def update_certs_if_available(f):
             path = relation_get(attribute='ssl-cert-available-updates',
                                 rid=rid, unit=local_unit())
 
+        if (not (path and os.path.exists(path)) and
+                config('ssl-sync-transport') in SSL_SYNC_PAYLOAD_TRANSPORTS):
+            path = fetch_sync_payload()
+
         if path and os.path.exists(path):
             log("Updating certs from '%s'" % (path), level=DEBUG)
-            with tarfile.open(path) as fd:
-                files = ["/%s" % m.name for m in fd.getmembers()]
-                fd.extractall(path='/')
-
-            for syncfile in files:
-                ensure_permissions(syncfile, user='keystone', group='keystone',
-                                   perms=0o744, recurse=True)
-
-            # Mark as complete
+            digest = apply_sync_archive(path)
+            # Mark as complete, only once the certs are safely on disk.
             os.rename(path, "%s.complete" % (path))
+            _fsync_dir(os.path.dirname(path))
+            kv().set(SSL_APPLIED_DIGEST_KEY, digest)
+            for rid in relation_ids('cluster'):
+                relation_set(relation_id=rid,
+                             relation_settings={SSL_APPLIED_DIGEST_KEY:
+                                                digest})
         else:
             log("No cert updates available", level=DEBUG)
 
@@ -1130,6 +1462,228 @@ def update_certs_if_available(f):
     return _inner_update_certs_if_available
 
 
+def apply_sync_archive(path, user='keystone', group='keystone', perms=0o744):
+    """Install the files packed in a sync archive.
+
+    Members are streamed one at a time: each file is written next to its
+    target with its owner and mode already set, synced to disk and renamed
+    into place, so nothing is walked again afterwards. Files the archive
+    lists as removed are deleted. Once every directory changed has been
+    synced too the archive is fully applied.
+
+    An archive which only holds the changes since a digest other than the
+    one last applied is not applied at all; the master sends every file again
+    once it sees this unit's digest differs.
+
+    Returns the digest of the files now installed, or None if unknown.
+    """
+    applied = kv().get(SSL_APPLIED_DIGEST_KEY)
+    uid = pwd.getpwnam(user).pw_uid
+    gid = grp.getgrnam(group).gr_gid
+    info = None
+    dirs = set()
+    # NOTE: the manifest is the first member of the archive, archives staged
+    # by a master which predates manifests have none.
+    with tarfile.open(path, 'r|') as fd:
+        for member in fd:
+            if member.name == SSL_SYNC_MANIFEST_MEMBER:
+                info = json.load(fd.extractfile(member))
+                if info['base'] and info['base'] != applied:
+                    log("Sync archive holds changes since %s but %s was "
+                        "applied last - waiting for a full sync" %
+                        (info['base'], applied), level=WARNING)
+                    return applied
+                continue
+
+            target = os.path.join('/', member.name)
+            if member.isdir():
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                os.chown(target, uid, gid)
+                os.chmod(target, perms)
+            elif member.isfile():
+                _extract_member_atomic(fd, member, target, uid, gid, perms)
+                dirs.add(os.path.dirname(target))
+
+    for target in (info or {}).get('removed', []):
+        if os.path.exists(target):
+            log("Removing '%s' no longer synced" % (target), level=DEBUG)
+            os.unlink(target)
+            dirs.add(os.path.dirname(target))
+
+    for dirname in sorted(dirs):
+        _fsync_dir(dirname)
+
+    return info['digest'] if info else None
+
+
+def _extract_member_atomic(fd, member, target, uid, gid, perms):
+    dirname = os.path.dirname(target)
+    if not os.path.isdir(dirname):
+        mkdir(dirname, owner='keystone', group='keystone', perms=0o755)
+
+    tmpfd, tmppath = tempfile.mkstemp(dir=dirname,
+                                      prefix='.%s.' % os.path.basename(target))
+    try:
+        with os.fdopen(tmpfd, 'wb') as out:
+            shutil.copyfileobj(fd.extractfile(member), out)
+            os.fchown(out.fileno(), uid, gid)
+            os.fchmod(out.fileno(), perms)
+            out.flush()
+            os.fsync(out.fileno())
+        os.rename(tmppath, target)
+    except:
+        os.unlink(tmppath)
+        raise
+
+
+def _fsync_dir(path):
+    dirfd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+def publish_sync_payload(path, digest, flags, transport):
+    """Publish the sync archive at path to peers without ssh.
+
+    The archive is split in chunks which are compressed, base64 encoded and
+    published under a key derived from their content, so chunks peers already
+    have are not sent again. An index of the chunks, digest, peer action
+    flags, publishing unit and time goes along with them. With the 'leader'
+    transport they are published through leader settings, falling back to
+    the cluster relation if this unit is not the juju leader. Publishing
+    through leader settings clears any payload this unit left on the
+    relation. One left in leader settings cannot be cleared by a unit which
+    is no longer leader, so peers go by publish time, see
+    fetch_sync_payload().
+
+    Returns the settings to set on the cluster relation.
+    """
+    chunks = OrderedDict()
+    with open(path, 'rb') as fd:
+        block = fd.read(SSL_SYNC_CHUNK_SIZE)
+        while block:
+            key = SSL_SYNC_CHUNK_PREFIX + hashlib.sha256(block).hexdigest()
+            chunks[key] = b64encode(zlib.compress(block, 9))
+            block = fd.read(SSL_SYNC_CHUNK_SIZE)
+
+    if transport == 'leader' and not is_leader():
+        log("Not juju leader - publishing sync payload on the cluster "
+            "relation", level=INFO)
+        transport = 'relation'
+
+    relation = {}
+    for rid in relation_ids('cluster'):
+        relation = relation_get(rid=rid, unit=local_unit()) or {}
+    current = (leader_get() or {}) if transport == 'leader' else relation
+
+    settings = dict((key, chunk) for key, chunk in chunks.items()
+                    if current.get(key) != chunk)
+    settings.update(_clear_sync_payload(current, keep=chunks))
+    settings[SSL_SYNC_PAYLOAD_KEY] = json.dumps({'digest': digest,
+                                                 'chunks': list(chunks),
+                                                 'flags': flags,
+                                                 'publisher': local_unit(),
+                                                 'published': time.time()},
+                                                sort_keys=True)
+    log("Publishing sync payload of %s chunks (%s new) through %s" %
+        (len(chunks), len(settings) - 1, transport), level=DEBUG)
+    if transport == 'leader':
+        leader_set(settings)
+        return _clear_sync_payload(relation)
+
+    return settings
+
+
+def _clear_sync_payload(settings, keep=()):
+    """Settings unsetting the sync payload keys in settings, other than
+    the chunks in keep"""
+    return dict((key, None) for key in settings
+                if (key == SSL_SYNC_PAYLOAD_KEY or
+                    key.startswith(SSL_SYNC_CHUNK_PREFIX)) and
+                key not in keep)
+
+
+def _sync_payload_sources():
+    """Settings which may hold a sync payload, each with the unit they
+    belong to or None for leader settings"""
+    if config('ssl-sync-transport') == 'leader':
+        yield None, leader_get() or {}
+
+    for rid in relation_ids('cluster'):
+        for unit in related_units(rid):
+            yield unit, relation_get(rid=rid, unit=unit) or {}
+
+
+def fetch_sync_payload():
+    """Reassemble the sync archive published by the ssl-cert-master.
+
+    Only payloads published by the unit naming itself ssl-cert-master are
+    considered, or by any peer while none does, eg. once the master stepped
+    down with a final payload. The newest payload is used, unless one at
+    least as new has already been applied.
+
+    The archive is written to SSL_SYNC_ARCHIVE and the peer action flags
+    which came with it to SYNC_FLAGS_DIR. Returns the path of the archive,
+    or None if no payload other than the one last applied was found.
+    """
+    applied = kv().get(SSL_APPLIED_DIGEST_KEY)
+    sources = list(_sync_payload_sources())
+    masters = [unit for unit, settings in sources
+               if unit and settings.get('ssl-cert-master') == unit]
+    payloads = []
+    newest_applied = 0
+    for unit, settings in sources:
+        index = settings.get(SSL_SYNC_PAYLOAD_KEY)
+        if not index:
+            continue
+
+        index = json.loads(index)
+        publisher = index.get('publisher')
+        if unit and publisher != unit:
+            continue
+        if masters and publisher not in masters:
+            log("Ignoring sync payload from %s, not ssl-cert-master" %
+                (publisher), level=DEBUG)
+            continue
+        if index['digest'] == applied:
+            log("Sync payload %s already applied" % (applied), level=DEBUG)
+            newest_applied = max(newest_applied, index.get('published', 0))
+            continue
+        payloads.append((index, settings))
+
+    payloads = [payload for payload in payloads
+                if payload[0].get('published', 0) > newest_applied]
+    if not payloads:
+        return None
+
+    index, settings = max(payloads, key=lambda p: p[0]['published'])
+    blocks = []
+    for key in index['chunks']:
+        block = None
+        if settings.get(key):
+            block = zlib.decompress(b64decode(settings[key]))
+        if (block is None or
+                key != SSL_SYNC_CHUNK_PREFIX +
+                hashlib.sha256(block).hexdigest()):
+            log("Sync payload chunk %s missing or corrupt - not "
+                "applying payload %s" % (key, index['digest']),
+                level=WARNING)
+            return None
+        blocks.append(block)
+
+    ensure_ssl_dirs()
+    write_file(SSL_SYNC_ARCHIVE, content=''.join(blocks), owner=SSH_USER,
+               group='keystone', perms=0o644)
+    for flag in index['flags']:
+        write_file(os.path.join(SYNC_FLAGS_DIR, flag), content='',
+                   owner=SSH_USER, group='keystone', perms=0o744)
+
+    return SSL_SYNC_ARCHIVE
+
+
 def synchronize_ca(fatal=False):
     """Broadcast service credentials to peers.
 
@@ -1186,16 +1740,30 @@ def synchronize_ca(fatal=False):
     create_peer_actions(peer_actions)
 
     paths_to_sync = list(set(paths_to_sync))
-    stage_paths_for_sync(paths_to_sync)
-
-    hash1 = hashlib.sha256()
-    for path in paths_to_sync:
-        update_hash_from_path(hash1, path)
-
-    cluster_rel_settings = {'ssl-cert-available-updates': SSL_SYNC_ARCHIVE,
-                            'sync-hash': hash1.hexdigest()}
+    sync_hash = stage_paths_for_sync(paths_to_sync)
+    cluster_rel_settings = {'sync-hash': sync_hash}
+
+    transport = config('ssl-sync-transport')
+    if transport in SSL_SYNC_PAYLOAD_TRANSPORTS:
+        flags = sorted(os.listdir(SYNC_FLAGS_DIR))
+        cluster_rel_settings.update(
+            publish_sync_payload(SSL_SYNC_ARCHIVE, sync_hash, flags,
+                                 transport))
+        # Every peer reads the payload itself, none can be missed.
+        synced_units = peer_units()
+    else:
+        cluster_rel_settings['ssl-cert-available-updates'] = SSL_SYNC_ARCHIVE
+        # Peers which already applied these certs are not synced again.
+        units = [unit for unit, digest in peer_applied_digests().items()
+                 if digest != sync_hash]
+        if units:
+            synced_units = unison_sync([SSL_SYNC_ARCHIVE, SYNC_FLAGS_DIR],
+                                       units=units)
+        else:
+            log("All peers have applied %s - not syncing" % (sync_hash),
+                level=DEBUG)
+            synced_units = peer_units()
 
-    synced_units = unison_sync([SSL_SYNC_ARCHIVE, SYNC_FLAGS_DIR])
     if synced_units:
         # Format here needs to match that used when peers request sync
         synced_units = [u.replace('/', '-') for u in synced_units]
@@ -1223,21 +1791,83 @@ def clear_ssl_synced_units():
                      relation_settings={'ssl-synced-units': None})
 
 
-def update_hash_from_path(hash, path, recurse_depth=10):
-    """Recurse through path and update the provided hash for every file found.
+def scan_manifest(paths, previous=None, recurse_depth=10):
+    """Build a manifest of every file found under paths.
+
+    The manifest maps each file to [inode, size, mtime, sha256 digest].
+    Files whose inode, size and mtime match their entry in previous keep
+    that entry's digest instead of being read again.
     """
-    if not recurse_depth:
-        log("Max recursion depth (%s) reached for update_hash_from_path() at "
-            "path='%s' - not going any deeper" % (recurse_depth, path),
-            level=WARNING)
+    previous = previous or {}
+    manifest = {}
+    for path in paths:
+        _scan_manifest_path(path, previous, manifest, recurse_depth)
+    return manifest
+
+
+def _scan_manifest_path(path, previous, manifest, recurse_depth):
+    if os.path.isdir(path):
+        if not recurse_depth:
+            log("Max recursion depth reached for scan_manifest() at "
+                "path='%s' - not going any deeper" % (path), level=WARNING)
+            return
+        for p in glob.glob("%s/*" % path):
+            _scan_manifest_path(p, previous, manifest, recurse_depth - 1)
         return
 
-    for p in glob.glob("%s/*" % path):
-        if os.path.isdir(p):
-            update_hash_from_path(hash, p, recurse_depth=recurse_depth - 1)
-        else:
-            with open(p, 'r') as fd:
-                hash.update(fd.read())
+    try:
+        st = os.stat(path)
+    except OSError:
+        return
+    entry = previous.get(path)
+    if entry and list(entry[:3]) == [st.st_ino, st.st_size, st.st_mtime]:
+        manifest[path] = list(entry)
+        return
+
+    digest = file_hash(path, hash_type='sha256')
+    # A file modified as it is scanned may change again without its mtime
+    # changing, so leave out its inode to have it read again next time.
+    inode = st.st_ino
+    if time.time() - st.st_mtime <= FILE_HASH_MTIME_SLACK:
+        inode = None
+    manifest[path] = [inode, st.st_size, st.st_mtime, digest]
+
+
+def manifest_changes(before, after):
+    """Files added, modified or removed between two manifests"""
+    return sorted(path for path in set(before) | set(after)
+                  if (before.get(path) or [None] * 4)[3] !=
+                  (after.get(path) or [None] * 4)[3])
+
+
+def _path_under(path, paths):
+    path = os.path.normpath(path)
+    for p in paths:
+        p = os.path.normpath(p)
+        if path == p or path.startswith(p.rstrip('/') + '/'):
+            return True
+    return False
+
+
+def manifest_digest(manifest, paths=None):
+    """Digest of the content and names of the files in manifest, or only of
+    those under one of paths"""
+    digest = hashlib.sha256()
+    for path in sorted(manifest):
+        if paths is None or _path_under(path, paths):
+            digest.update(os.path.normpath(path))
+            digest.update(manifest[path][3])
+    return digest.hexdigest()
+
+
+def ssl_manifest():
+    """Manifest of SSL_DIRS, updating the one kept in kv"""
+    db = kv()
+    previous = db.get(SSL_MANIFEST_KEY)
+    manifest = scan_manifest(SSL_DIRS, previous)
+    if manifest != previous:
+        db.set(SSL_MANIFEST_KEY, manifest)
+    return manifest
 
 
 def synchronize_ca_if_changed(force=False, fatal=False):
@@ -1262,19 +1892,12 @@ def synchronize_ca_if_changed(force=False, fatal=False):
 
                 peer_settings = {}
                 if not force:
-                    hash1 = hashlib.sha256()
-                    for path in SSL_DIRS:
-                        update_hash_from_path(hash1, path)
-
+                    before = ssl_manifest()
                     ret = f(*args, **kwargs)
-
-                    hash2 = hashlib.sha256()
-                    for path in SSL_DIRS:
-                        update_hash_from_path(hash2, path)
-
-                    if hash1.hexdigest() != hash2.hexdigest():
-                        log("SSL certs have changed - syncing peers",
-                            level=DEBUG)
+                    changed = manifest_changes(before, ssl_manifest())
+                    if changed:
+                        log("SSL certs have changed - syncing peers: %s" %
+                            ', '.join(changed), level=DEBUG)
                         peer_settings = synchronize_ca(fatal=fatal)
                     else:
                         log("SSL certs have not changed - skipping sync",
@@ -1361,36 +1984,36 @@ def relation_list(rid):
         return result
 
 
-def create_user_credentials(user, tenant, passwd, new_roles=None, grants=None):
+def create_user_credentials(user, tenant, passwd, new_roles=None, grants=None,
+                            catalog=None):
     """Create user credentials.
 
     Optionally adds role grants to user and/or creates new roles.
     """
     log("Creating service credentials for '%s'" % user, level=DEBUG)
-    if user_exists(user):
-        log("User '%s' already exists - updating password" % (user),
-            level=DEBUG)
-        update_user_password(user, passwd)
-    else:
-        create_user(user, passwd, tenant)
+    with catalog_batch(catalog) as batch:
+        # An existing user has its password updated if it has changed.
+        batch.add_user(user, passwd, tenant)
 
-    if grants:
-        for role in grants:
-            grant_role(user, role, tenant)
-    else:
-        log("No role grants requested for user '%s'" % (user), level=DEBUG)
+        if grants:
+            for role in grants:
+                grant_role(user, role, tenant, catalog=batch)
+        else:
+            log("No role grants requested for user '%s'" % (user),
+                level=DEBUG)
 
-    if new_roles:
-        # Allow the remote service to request creation of any additional roles.
-        # Currently used by Swift and Ceilometer.
-        for role in new_roles:
-            log("Creating requested role '%s'" % role, level=DEBUG)
-            create_role(role, user, tenant)
+        if new_roles:
+            # Allow the remote service to request creation of any additional
+            # roles. Currently used by Swift and Ceilometer.
+            for role in new_roles:
+                log("Creating requested role '%s'" % role, level=DEBUG)
+                create_role(role, user, tenant, catalog=batch)
 
     return passwd
 
 
-def create_service_credentials(user, new_roles=None):
+def create_service_credentials(user, new_roles=None, catalog=None,
+                               password=None):
     """Create credentials for service with given username.
 
     Services are given a user under config('service-tenant') and are given the
@@ -1400,144 +2023,191 @@ def create_service_credentials(user, new_roles=None):
     if not tenant:
         raise Exception("No service tenant provided in config")
 
-    return create_user_credentials(user, tenant, get_service_password(user),
-                                   new_roles=new_roles,
-                                   grants=[config('admin-role')])
+    if password is None:
+        password = get_service_password(user)
 
+    return create_user_credentials(user, tenant, password,
+                                   new_roles=new_roles,
+                                   grants=[config('admin-role')],
+                                   catalog=catalog)
 
-def add_service_to_keystone(relation_id=None, remote_unit=None):
-    import manager
-    manager = manager.KeystoneManager(endpoint=get_local_endpoint(),
-                                      token=get_admin_token())
-    settings = relation_get(rid=relation_id, unit=remote_unit)
-    # the minimum settings needed per endpoint
-    single = set(['service', 'region', 'public_url', 'admin_url',
-                  'internal_url'])
-    https_cns = []
 
-    if https():
-        protocol = 'https'
-    else:
-        protocol = 'http'
+def get_requested_endpoints(settings):
+    """Return the endpoints advertised in identity-service settings.
 
-    if single.issubset(settings):
+    Each endpoint is a dict with at least 'service', 'region', 'public_url',
+    'admin_url' and 'internal_url'.
+    """
+    if ENDPOINT_SETTINGS.issubset(settings):
         # other end of relation advertised only one endpoint
-        if 'None' in settings.itervalues():
-            # Some backend services advertise no endpoint but require a
-            # hook execution to update auth strategy.
-            relation_data = {}
-            # Check if clustered and use vip + haproxy ports if so
-            relation_data["auth_host"] = resolve_address(ADMIN)
-            relation_data["service_host"] = resolve_address(PUBLIC)
-
-            relation_data["auth_protocol"] = protocol
-            relation_data["service_protocol"] = protocol
-            relation_data["auth_port"] = config('admin-port')
-            relation_data["service_port"] = config('service-port')
-            relation_data["region"] = config('region')
-
-            https_service_endpoints = config('https-service-endpoints')
-            if (https_service_endpoints and
-                    bool_from_string(https_service_endpoints)):
-                # Pass CA cert as client will need it to
-                # verify https connections
-                ca = get_ca(user=SSH_USER)
-                ca_bundle = ca.get_ca_bundle()
-                relation_data['https_keystone'] = 'True'
-                relation_data['ca_cert'] = b64encode(ca_bundle)
+        return [settings]
+
+    # assemble multiple endpoints from relation data. service name
+    # should be prepended to setting name, ie:
+    #  realtion-set ec2_service=$foo ec2_region=$foo ec2_public_url=$foo
+    #  relation-set nova_service=$foo nova_region=$foo nova_public_url=$foo
+    # Results in a dict that looks like:
+    # { 'ec2': {
+    #       'service': $foo
+    #       'region': $foo
+    #       'public_url': $foo
+    #   }
+    #   'nova': {
+    #       'service': $foo
+    #       'region': $foo
+    #       'public_url': $foo
+    #   }
+    # }
+    endpoints = {}
+    for k, v in settings.iteritems():
+        ep = k.split('_')[0]
+        x = '_'.join(k.split('_')[1:])
+        if ep not in endpoints:
+            endpoints[ep] = {}
+        endpoints[ep][x] = v
+
+    # weed out any unrelated relation stuff Juju might have added
+    # by ensuring each possible endpiont has appropriate fields
+    #  ['service', 'region', 'public_url', 'admin_url', 'internal_url']
+    return [endpoints[name] for name in endpoints
+            if ENDPOINT_SETTINGS.issubset(endpoints[name])]
 
+
+def is_auth_only_request(settings):
+    """Whether a single endpoint service advertised no endpoint.
+
+    Some backend services advertise no endpoint but require a hook execution
+    to update auth strategy.
+    """
+    return (ENDPOINT_SETTINGS.issubset(settings) and
+            'None' in settings.itervalues())
+
+
+def add_service_to_catalog(settings, catalog=None, existing_only=False):
+    """Request what a remote service needs from keystone.
+
+    With existing_only relation and peer data are left alone: invalid
+    services are skipped rather than reported and credentials are only
+    requested if a password is already stored for them.
+
+    Returns the service username the remote service is given credentials
+    for, or None if it needs none.
+    """
+    with catalog_batch(catalog) as batch:
+        if is_auth_only_request(settings):
             # Allow the remote service to request creation of any additional
             # roles. Currently used by Horizon
             for role in get_requested_roles(settings):
                 log("Creating requested role: %s" % role)
-                create_role(role)
+                create_role(role, catalog=batch)
 
-            peer_store_and_set(relation_id=relation_id, **relation_data)
-            return
-        else:
-            ensure_valid_service(settings['service'])
-            add_endpoint(region=settings['region'],
-                         service=settings['service'],
-                         publicurl=settings['public_url'],
-                         adminurl=settings['admin_url'],
-                         internalurl=settings['internal_url'])
-
-            # If an admin username prefix is provided, ensure all services use
-            # it.
-            service_username = settings['service']
-            prefix = config('service-admin-prefix')
-            if prefix:
-                service_username = "%s%s" % (prefix, service_username)
-
-            # NOTE(jamespage) internal IP for backwards compat for SSL certs
-            internal_cn = urlparse.urlparse(settings['internal_url']).hostname
-            https_cns.append(internal_cn)
-            public_cn = urlparse.urlparse(settings['public_url']).hostname
-            https_cns.append(public_cn)
-            https_cns.append(urlparse.urlparse(settings['admin_url']).hostname)
-    else:
-        # assemble multiple endpoints from relation data. service name
-        # should be prepended to setting name, ie:
-        #  realtion-set ec2_service=$foo ec2_region=$foo ec2_public_url=$foo
-        #  relation-set nova_service=$foo nova_region=$foo nova_public_url=$foo
-        # Results in a dict that looks like:
-        # { 'ec2': {
-        #       'service': $foo
-        #       'region': $foo
-        #       'public_url': $foo
-        #   }
-        #   'nova': {
-        #       'service': $foo
-        #       'region': $foo
-        #       'public_url': $foo
-        #   }
-        # }
-        endpoints = {}
-        for k, v in settings.iteritems():
-            ep = k.split('_')[0]
-            x = '_'.join(k.split('_')[1:])
-            if ep not in endpoints:
-                endpoints[ep] = {}
-            endpoints[ep][x] = v
+            return None
 
         services = []
-        https_cn = None
-        for ep in endpoints:
-            # weed out any unrelated relation stuff Juju might have added
-            # by ensuring each possible endpiont has appropriate fields
-            #  ['service', 'region', 'public_url', 'admin_url', 'internal_url']
-            if single.issubset(endpoints[ep]):
-                ep = endpoints[ep]
+        for ep in get_requested_endpoints(settings):
+            if existing_only and ep['service'] not in valid_services:
+                continue
+
+            if not existing_only:
                 ensure_valid_service(ep['service'])
-                add_endpoint(region=ep['region'], service=ep['service'],
-                             publicurl=ep['public_url'],
-                             adminurl=ep['admin_url'],
-                             internalurl=ep['internal_url'])
-                services.append(ep['service'])
-                # NOTE(jamespage) internal IP for backwards compat for
-                # SSL certs
-                internal_cn = urlparse.urlparse(ep['internal_url']).hostname
-                https_cns.append(internal_cn)
-                https_cns.append(urlparse.urlparse(ep['public_url']).hostname)
-                https_cns.append(urlparse.urlparse(ep['admin_url']).hostname)
+            add_endpoint(region=ep['region'], service=ep['service'],
+                         publicurl=ep['public_url'],
+                         adminurl=ep['admin_url'],
+                         internalurl=ep['internal_url'],
+                         catalog=batch)
+            services.append(ep['service'])
 
-        service_username = '_'.join(services)
+        if 'None' in settings.itervalues() or not services:
+            return None
 
+        service_username = '_'.join(services)
         # If an admin username prefix is provided, ensure all services use it.
         prefix = config('service-admin-prefix')
         if prefix:
             service_username = "%s%s" % (prefix, service_username)
 
-    if 'None' in settings.itervalues():
+        password = None
+        if existing_only:
+            password = peer_retrieve("{}_passwd".format(service_username))
+            if password is None:
+                return None
+
+        roles = get_requested_roles(settings)
+        create_service_credentials(service_username, new_roles=roles,
+                                   catalog=batch, password=password)
+
+    return service_username
+
+
+def get_requested_catalog():
+    """Return the catalog requested by every identity-service relation.
+
+    The roles, services and endpoints of every valid request are included.
+    Invalid services are skipped rather than reported, and service
+    credentials are only included once their password is stored in peer
+    data; add_service_to_keystone() creates them for the relation making
+    the request.
+    """
+    catalog = KeystoneCatalog()
+    for rid in relation_ids('identity-service'):
+        for unit in related_units(rid):
+            add_service_to_catalog(relation_get(rid=rid, unit=unit),
+                                   catalog=catalog, existing_only=True)
+
+    return catalog
+
+
+def add_service_to_keystone(relation_id=None, remote_unit=None):
+    manager = get_manager()
+    settings = relation_get(rid=relation_id, unit=remote_unit)
+    https_cns = []
+
+    if https():
+        protocol = 'https'
+    else:
+        protocol = 'http'
+
+    # Keystone is brought up to date in one batch before anything is
+    # published to the remote service.
+    service_username = add_service_to_catalog(settings)
+
+    if is_auth_only_request(settings):
+        relation_data = {}
+        # Check if clustered and use vip + haproxy ports if so
+        relation_data["auth_host"] = resolve_address(ADMIN)
+        relation_data["service_host"] = resolve_address(PUBLIC)
+
+        relation_data["auth_protocol"] = protocol
+        relation_data["service_protocol"] = protocol
+        relation_data["auth_port"] = config('admin-port')
+        relation_data["service_port"] = config('service-port')
+        relation_data["region"] = config('region')
+
+        https_service_endpoints = config('https-service-endpoints')
+        if (https_service_endpoints and
+                bool_from_string(https_service_endpoints)):
+            # Pass CA cert as client will need it to
+            # verify https connections
+            ca = get_ca(user=SSH_USER)
+            ca_bundle = ca.get_ca_bundle()
+            relation_data['https_keystone'] = 'True'
+            relation_data['ca_cert'] = b64encode(ca_bundle)
+
+        peer_store_and_set(relation_id=relation_id, **relation_data)
         return
 
     if not service_username:
         return
 
+    for ep in get_requested_endpoints(settings):
+        # NOTE(jamespage) internal IP for backwards compat for SSL certs
+        internal_cn = urlparse.urlparse(ep['internal_url']).hostname
+        https_cns.append(internal_cn)
+        https_cns.append(urlparse.urlparse(ep['public_url']).hostname)
+        https_cns.append(urlparse.urlparse(ep['admin_url']).hostname)
+
     token = get_admin_token()
-    roles = get_requested_roles(settings)
-    service_password = create_service_credentials(service_username,
-                                                  new_roles=roles)
+    service_password = get_service_password(service_username)
 
     # As of https://review.openstack.org/#change,4675, all nodes hosting
     # an endpoint(s) needs a service username and password assigned to
@@ -1572,9 +2242,9 @@ def add_service_to_keystone(relation_id=None, remote_unit=None):
     if https_service_endpoints and bool_from_string(https_service_endpoints):
         ca = get_ca(user=SSH_USER)
         # NOTE(jamespage) may have multiple cns to deal with to iterate
-        https_cns = set(https_cns)
-        for https_cn in https_cns:
-            cert, key = ca.get_cert_and_key(common_name=https_cn)
+        https_cns = sorted(set(https_cns))
+        for https_cn, (cert, key) in zip(https_cns,
+                                         get_certs_and_keys(ca, https_cns)):
             relation_data['ssl_cert_{}'.format(https_cn)] = b64encode(cert)
             relation_data['ssl_key_{}'.format(https_cn)] = b64encode(key)
 
@@ -1593,6 +2263,19 @@ def add_service_to_keystone(relation_id=None, remote_unit=None):
     relation_set(relation_id=relation_id, **filtered)
 
 
+def get_certs_and_keys(ca, common_names):
+    """Return the (cert, key) of each of common_names, in the same order.
+
+    Certificates which do not exist yet are generated concurrently, on the
+    pool catalog changes are applied with.
+    """
+    if len(common_names) < 2:
+        return [ca.get_cert_and_key(common_name=cn) for cn in common_names]
+
+    return worker_pool().map(lambda cn: ca.get_cert_and_key(common_name=cn),
+                             common_names)
+
+
 def ensure_valid_service(service):
     if service not in valid_services.keys():
         log("Invalid service requested: '%s'" % service)
@@ -1600,14 +2283,17 @@ def ensure_valid_service(service):
         return
 
 
-def add_endpoint(region, service, publicurl, adminurl, internalurl):
+def add_endpoint(region, service, publicurl, adminurl, internalurl,
+                 catalog=None):
     desc = valid_services[service]["desc"]
     service_type = valid_services[service]["type"]
-    create_service_entry(service, service_type, desc)
-    create_endpoint_template(region=region, service=service,
-                             publicurl=publicurl,
-                             adminurl=adminurl,
-                             internalurl=internalurl)
+    with catalog_batch(catalog) as batch:
+        create_service_entry(service, service_type, desc, catalog=batch)
+        create_endpoint_template(region=region, service=service,
+                                 publicurl=publicurl,
+                                 adminurl=adminurl,
+                                 internalurl=internalurl,
+                                 catalog=batch)
 
 
 def get_requested_roles(settings):
@@ -1,47 +1,405 @@
 #!/usr/bin/python
+import threading
+import urlparse
+
+from collections import OrderedDict
+
+from keystoneclient import exceptions
 from keystoneclient.v2_0 import client
 
+try:
+    from keystoneclient import session
+    from keystoneclient.auth import token_endpoint
+except ImportError:
+    # Backwards-compatibility for earlier versions of keystoneclient which
+    # have no session support.
+    session = None
+    token_endpoint = None
+
+try:
+    from keystoneclient.v3 import client as client_v3
+except ImportError:
+    client_v3 = None
+
+# Indexes maintained for every snapshotted collection, keyed by index name.
+SNAPSHOT_INDEXES = {
+    'name': lambda e: e.get('name'),
+    'name-type': lambda e: (e.get('name'), e.get('type')),
+    'type': lambda e: e.get('type'),
+    'service-region': lambda e: (e.get('service_id'), e.get('region')),
+}
+
+# Domain holding the users and projects managed through the v2 API.
+DEFAULT_DOMAIN = 'default'
+
+# Lookups KeystoneManager3 makes with server side filters, as (collection,
+# index) pairs.
+V3_QUERIES = [
+    ('users', 'name'),
+    ('tenants', 'name'),
+    ('services', 'type'),
+    ('services', 'name-type'),
+]
+
+# The KeystoneManager shared by the charm for the current hook, see
+# keystone_utils.get_manager().
+MANAGER_SINGLETON = []
+
+# Snapshots are shared by all managers talking to the same endpoint. Each hook
+# runs in its own process so a snapshot lives for a single hook execution.
+SNAPSHOTS = {}
+
+
+class KeystoneSnapshot(object):
+    """Hook-scoped copy of the keystone collections used by the charm.
+
+    Each collection is listed at most once and is then kept up to date by the
+    create/update/delete calls made through KeystoneManager, so resolving a
+    name (or name and type) to an id is a dict lookup.
+    """
+
+    def __init__(self):
+        self.collections = {}
+        # Ids of the entries of each loaded collection by index and key, in
+        # listing order; the first one is the match.
+        self.indexes = {}
+        self.grants = {}
+        # Results of single entry queries, keyed by (collection, index, key),
+        # for collections which are never listed in full, and the queries
+        # answered with each (collection, id).
+        self.lookups = {}
+        self.lookup_ids = {}
+        # Managers may be shared by the threads applying a catalog plan, so
+        # the snapshot is only read or changed with the lock held.
+        self.lock = threading.RLock()
+
+    def is_loaded(self, collection):
+        return collection in self.collections
+
+    def load(self, collection, entries):
+        """Replace the contents of collection and rebuild its indexes"""
+        with self.lock:
+            self.collections[collection] = OrderedDict()
+            self.indexes[collection] = {k: {} for k in SNAPSHOT_INDEXES}
+            for entry in entries:
+                self.add(collection, entry)
+
+    def add(self, collection, entry):
+        """Record a new or updated entry"""
+        with self.lock:
+            if not self.is_loaded(collection):
+                # Only answers queries, the collection is not listed.
+                for index, key in SNAPSHOT_INDEXES.items():
+                    lookup = (collection, index, key(entry))
+                    if self.lookups.get(lookup) is None:
+                        self.record(collection, index, key(entry),
+                                    entry['id'])
+                return
+
+            entries = self.collections[collection]
+            old = entries.get(entry['id'])
+            if old is not None:
+                self._unindex(collection, old)
+            entries[entry['id']] = entry
+            for index, key in SNAPSHOT_INDEXES.items():
+                self.indexes[collection][index].setdefault(
+                    key(entry), []).append(entry['id'])
+
+    def _unindex(self, collection, entry):
+        for index, key in SNAPSHOT_INDEXES.items():
+            ids = self.indexes[collection][index].get(key(entry), [])
+            if entry['id'] in ids:
+                ids.remove(entry['id'])
+
+    def remove(self, collection, entry_id):
+        """Forget entry_id"""
+        with self.lock:
+            for lookup in self.lookup_ids.pop((collection, entry_id), []):
+                if self.lookups.get(lookup) == entry_id:
+                    self.lookups[lookup] = None
+
+            if not self.is_loaded(collection):
+                return
+
+            entry = self.collections[collection].pop(entry_id, None)
+            if entry is not None:
+                self._unindex(collection, entry)
+
+    def find(self, collection, index, key):
+        with self.lock:
+            ids = self.indexes[collection][index].get(key)
+            return ids[0] if ids else None
+
+    def lookup(self, collection, index, key):
+        """Return (found, id) for a previously recorded query"""
+        with self.lock:
+            lookup = (collection, index, key)
+            return lookup in self.lookups, self.lookups.get(lookup)
+
+    def record(self, collection, index, key, entry_id):
+        with self.lock:
+            lookup = (collection, index, key)
+            self.lookups[lookup] = entry_id
+            if entry_id is not None:
+                self.lookup_ids.setdefault((collection, entry_id),
+                                           set()).add(lookup)
+
+    def get(self, collection, entry_id):
+        with self.lock:
+            return self.collections.get(collection, {}).get(entry_id)
+
+    def entries(self, collection):
+        with self.lock:
+            return list(self.collections[collection].values())
+
+    def invalidate(self, collection=None):
+        """Drop collection (or everything) so it is listed again on next use"""
+        with self.lock:
+            if collection is None:
+                self.collections.clear()
+                self.indexes.clear()
+                self.grants.clear()
+                self.lookups.clear()
+                self.lookup_ids.clear()
+            else:
+                self.collections.pop(collection, None)
+                self.indexes.pop(collection, None)
+                for lookup in self.lookups.keys():
+                    if lookup[0] == collection:
+                        del self.lookups[lookup]
+                for key in self.lookup_ids.keys():
+                    if key[0] == collection:
+                        del self.lookup_ids[key]
+
 
 class KeystoneManager(object):
 
     def __init__(self, endpoint, token):
-        self.api = client.Client(endpoint=endpoint, token=token)
+        self.endpoint = endpoint
+        self.token = token
+        self._api_v3 = None
+        if session and token_endpoint:
+            # A session keeps a pool of keep-alive connections to endpoint
+            # which is reused by every request made through this manager.
+            auth = token_endpoint.Token(endpoint, token)
+            self.session = session.Session(auth=auth)
+            self.api = client.Client(session=self.session)
+        else:
+            self.session = None
+            self.api = client.Client(endpoint=endpoint, token=token)
+
+        self.snapshot = SNAPSHOTS.setdefault(endpoint, KeystoneSnapshot())
+
+    @property
+    def api_v3(self):
+        """v3 client for the same keystone, or None if it is unavailable"""
+        if self._api_v3 is None and client_v3:
+            endpoint = urlparse.urljoin(self.endpoint, '/v3')
+            if self.session:
+                self._api_v3 = client_v3.Client(session=self.session,
+                                                endpoint_override=endpoint)
+            else:
+                self._api_v3 = client_v3.Client(endpoint=endpoint,
+                                                token=self.token)
+
+        return self._api_v3
+
+    def _load(self, collection):
+        """Ensure collection is in the snapshot, listing it if necessary"""
+        with self.snapshot.lock:
+            if not self.snapshot.is_loaded(collection):
+                resources = getattr(self.api, collection).list()
+                self.snapshot.load(collection, [r._info for r in resources])
+
+    def _find(self, collection, index, key):
+        self._load(collection)
+        return self.snapshot.find(collection, index, key)
 
     def resolve_tenant_id(self, name):
         """Find the tenant_id of a given tenant"""
-        tenants = [t._info for t in self.api.tenants.list()]
-        for t in tenants:
-            if name == t['name']:
-                return t['id']
+        return self._find('tenants', 'name', name)
 
     def resolve_role_id(self, name):
         """Find the role_id of a given role"""
-        roles = [r._info for r in self.api.roles.list()]
-        for r in roles:
-            if name == r['name']:
-                return r['id']
+        return self._find('roles', 'name', name)
 
     def resolve_user_id(self, name):
         """Find the user_id of a given user"""
-        users = [u._info for u in self.api.users.list()]
-        for u in users:
-            if name == u['name']:
-                return u['id']
+        return self._find('users', 'name', name)
 
     def resolve_service_id(self, name, service_type=None):
         """Find the service_id of a given service"""
-        services = [s._info for s in self.api.services.list()]
-        for s in services:
-            if service_type:
-                if name == s['name'] and service_type == s['type']:
-                    return s['id']
-            else:
-                if name == s['name']:
-                    return s['id']
+        if service_type:
+            return self._find('services', 'name-type', (name, service_type))
+
+        return self._find('services', 'name', name)
 
     def resolve_service_id_by_type(self, type):
         """Find the service_id of a given service"""
-        services = [s._info for s in self.api.services.list()]
-        for s in services:
-            if type == s['type']:
-                return s['id']
+        return self._find('services', 'type', type)
+
+    def create_tenant(self, name, description=None):
+        tenant = self.api.tenants.create(tenant_name=name,
+                                         description=description)
+        self.snapshot.add('tenants', tenant._info)
+        return tenant
+
+    def create_user(self, name, password, email, tenant_id):
+        user = self.api.users.create(name=name, password=password,
+                                     email=email, tenant_id=tenant_id)
+        self.snapshot.add('users', user._info)
+        return user
+
+    def update_user_password(self, user_id, password):
+        return self.api.users.update_password(user=user_id, password=password)
+
+    def create_role(self, name):
+        role = self.api.roles.create(name=name)
+        self.snapshot.add('roles', role._info)
+        return role
+
+    def roles_for_user(self, user_id, tenant_id):
+        """Return the set of role ids user_id holds on tenant_id"""
+        key = (user_id, tenant_id)
+        if key not in self.snapshot.grants:
+            roles = self.api.roles.roles_for_user(user_id, tenant_id)
+            self.snapshot.grants.setdefault(key,
+                                            set([r.id for r in roles or []]))
+
+        return self.snapshot.grants[key]
+
+    def add_user_role(self, user_id, role_id, tenant_id):
+        self.api.roles.add_user_role(user=user_id, role=role_id,
+                                     tenant=tenant_id)
+        self.roles_for_user(user_id, tenant_id).add(role_id)
+
+    def create_service(self, name, service_type, description):
+        service = self.api.services.create(name=name,
+                                           service_type=service_type,
+                                           description=description)
+        self.snapshot.add('services', service._info)
+        return service
+
+    def delete_service(self, service_id):
+        self.api.services.delete(service_id)
+        self.snapshot.remove('services', service_id)
+
+    def find_endpoint(self, service_id, region):
+        """Find the endpoint of service_id in region"""
+        endpoint_id = self._find('endpoints', 'service-region',
+                                 (service_id, region))
+        if endpoint_id is None:
+            return None
+
+        return self.snapshot.get('endpoints', endpoint_id)
+
+    def create_endpoint(self, region, service_id, publicurl, adminurl,
+                        internalurl):
+        endpoint = self.api.endpoints.create(region=region,
+                                             service_id=service_id,
+                                             publicurl=publicurl,
+                                             adminurl=adminurl,
+                                             internalurl=internalurl)
+        self.snapshot.add('endpoints', endpoint._info)
+        return endpoint
+
+    def update_endpoint(self, endpoint_id, region, service_id, publicurl,
+                        adminurl, internalurl):
+        """Point endpoint_id at new urls.
+
+        With the v3 API the url of each interface is updated in place so the
+        endpoint keeps its id. Otherwise the endpoint is replaced, creating
+        the new one before deleting the old so the service never drops out
+        of the catalog.
+        """
+        urls = {'public': publicurl, 'admin': adminurl,
+                'internal': internalurl}
+        if self._update_endpoint_v3(endpoint_id, service_id, urls):
+            entry = dict(self.snapshot.get('endpoints', endpoint_id) or
+                         {'id': endpoint_id, 'region': region,
+                          'service_id': service_id})
+            entry.update(publicurl=publicurl, adminurl=adminurl,
+                         internalurl=internalurl)
+            self.snapshot.add('endpoints', entry)
+            return entry
+
+        endpoint = self.create_endpoint(region, service_id, publicurl,
+                                        adminurl, internalurl)
+        self.delete_endpoint(endpoint_id)
+        return endpoint._info
+
+    def _update_endpoint_v3(self, endpoint_id, service_id, urls):
+        """Update the v3 endpoints backing v2 endpoint_id.
+
+        Returns False, having changed nothing, if the v3 API is unavailable
+        or the v3 endpoints do not map onto endpoint_id's interfaces.
+        """
+        if not self.api_v3:
+            return False
+
+        try:
+            endpoints = self.api_v3.endpoints.list(service=service_id)
+        except exceptions.ClientException:
+            return False
+
+        endpoints = [e for e in endpoints
+                     if getattr(e, 'legacy_endpoint_id', None) == endpoint_id]
+        if sorted(e.interface for e in endpoints) != sorted(urls):
+            return False
+
+        for e in endpoints:
+            if e.url != urls[e.interface]:
+                self.api_v3.endpoints.update(e, url=urls[e.interface])
+
+        return True
+
+    def delete_endpoint(self, endpoint_id):
+        self.api.endpoints.delete(endpoint_id)
+        self.snapshot.remove('endpoints', endpoint_id)
+
+
+class KeystoneManager3(KeystoneManager):
+    """KeystoneManager resolving names with filtered v3 queries.
+
+    Users and tenants (projects) are found one name at a time with server
+    side filters instead of listing the whole collection, which matters when
+    the identity backend is a large directory. Grants come from role
+    assignment queries. Everything else, including all writes, goes through
+    the v2 API as before.
+    """
+
+    def _query(self, collection, index, key):
+        """Return the v3 resources in collection matching key"""
+        if collection == 'users':
+            return self.api_v3.users.list(name=key, domain=DEFAULT_DOMAIN)
+        elif collection == 'tenants':
+            return self.api_v3.projects.list(name=key, domain=DEFAULT_DOMAIN)
+        elif index == 'type':
+            return self.api_v3.services.list(type=key)
+
+        return [s for s in self.api_v3.services.list(type=key[1])
+                if s.name == key[0]]
+
+    def _find(self, collection, index, key):
+        if ((collection, index) not in V3_QUERIES or
+                self.snapshot.is_loaded(collection)):
+            return super(KeystoneManager3, self)._find(collection, index, key)
+
+        found, _id = self.snapshot.lookup(collection, index, key)
+        if not found:
+            resources = self._query(collection, index, key)
+            _id = resources[0].id if resources else None
+            self.snapshot.record(collection, index, key, _id)
+
+        return _id
+
+    def roles_for_user(self, user_id, tenant_id):
+        """Return the set of role ids user_id holds on tenant_id"""
+        key = (user_id, tenant_id)
+        if key not in self.snapshot.grants:
+            assignments = self.api_v3.role_assignments.list(user=user_id,
+                                                            project=tenant_id)
+            self.snapshot.grants.setdefault(
+                key, set([a.role['id'] for a in assignments]))
+
+        return self.snapshot.grants[key]
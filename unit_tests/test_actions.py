@@ -98,6 +98,30 @@ class ResumeTestCase(CharmTestCase):
         self.kv().set.assert_called_with('unit-paused', False)
 
 
+class SSLSyncStatusTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(SSLSyncStatusTestCase, self).setUp(
+            actions.actions, ["action_set", "HookData", "ssl_sync_status"])
+
+    def test_reports_status(self):
+        """SSL sync status action reports pending peers."""
+        self.ssl_sync_status.return_value = {
+            'digest': 'd1', 'synced': ['keystone/1'],
+            'pending': ['keystone/2', 'keystone/3']}
+        actions.actions.ssl_sync_status_action([])
+        self.action_set.assert_called_with({
+            'digest': 'd1', 'synced': 'keystone/1',
+            'pending': 'keystone/2,keystone/3', 'converged': False})
+
+    def test_not_master(self):
+        """SSL sync status action fails on units other than the master."""
+        self.ssl_sync_status.return_value = None
+        self.assertRaises(Exception,
+                          actions.actions.ssl_sync_status_action, [])
+        self.assertFalse(self.action_set.called)
+
+
 class MainTestCase(CharmTestCase):
 
     def setUp(self):
@@ -13,6 +13,8 @@ from test_utils import (
 
 TO_PATCH = [
     'do_openstack_upgrade',
+    'flush_log',
+    'flush_relation_writes',
     'os',
 ]
 
@@ -40,6 +42,28 @@ class TestKeystoneUpgradeActions(CharmTestCase):
         self.os.execl.assert_called_with('./hooks/config-changed-postupgrade',
                                          '')
 
+    @patch.object(hooks, 'register_configs')
+    @patch('charmhelpers.contrib.openstack.utils.config')
+    @patch('charmhelpers.contrib.openstack.utils.action_set')
+    @patch('charmhelpers.contrib.openstack.utils.git_install_requested')
+    @patch('charmhelpers.contrib.openstack.utils.openstack_upgrade_available')
+    def test_openstack_upgrade_flushes_before_exec(self, upgrade_avail,
+                                                   git_requested, action_set,
+                                                   config, reg_configs):
+        git_requested.return_value = False
+        upgrade_avail.return_value = True
+        config.return_value = True
+        calls = []
+        self.flush_relation_writes.side_effect = \
+            lambda: calls.append('flush_relation_writes')
+        self.flush_log.side_effect = lambda: calls.append('flush_log')
+        self.os.execl.side_effect = lambda *args: calls.append('execl')
+
+        openstack_upgrade.openstack_upgrade()
+
+        self.assertEqual(calls,
+                         ['flush_relation_writes', 'flush_log', 'execl'])
+
     @patch.object(hooks, 'register_configs')
     @patch('charmhelpers.contrib.openstack.utils.config')
     @patch('charmhelpers.contrib.openstack.utils.action_set')
@@ -54,4 +78,6 @@ class TestKeystoneUpgradeActions(CharmTestCase):
         openstack_upgrade.openstack_upgrade()
 
         self.assertFalse(self.do_openstack_upgrade.called)
+        self.assertFalse(self.flush_relation_writes.called)
+        self.assertFalse(self.flush_log.called)
         self.assertFalse(self.os.execl.called)
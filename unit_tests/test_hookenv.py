@@ -0,0 +1,375 @@
+import os
+import yaml
+
+from mock import MagicMock, call, patch
+
+from charmhelpers.core import hookenv, host
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'local_unit',
+    'log',
+    'relation_id',
+    'relation_types',
+    'remote_unit',
+]
+
+
+class TestRelationSnapshot(CharmTestCase):
+
+    def setUp(self):
+        super(TestRelationSnapshot, self).setUp(hookenv, TO_PATCH)
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.addCleanup(setattr, hookenv, '_relation_snapshot', None)
+        self.local_unit.return_value = 'keystone/0'
+        self.relation_id.return_value = 'cluster:1'
+        self.remote_unit.return_value = 'keystone/1'
+        self.relation_types.return_value = ['cluster', 'identity-service']
+        self.ids = {'cluster': ['cluster:1'], 'identity-service': []}
+        self.units = {'cluster:1': ['keystone/1']}
+        self.settings = {('cluster:1', 'keystone/0'): {'a': '1'},
+                         ('cluster:1', 'keystone/1'): {'b': '2'}}
+        self.tools = []
+        for func, side_effect in [
+                (hookenv.relation_ids, self._relation_ids),
+                (hookenv.related_units, self._related_units),
+                (hookenv._relation_get, self._relation_get)]:
+            _patch = patch.object(func, '_wrapped', side_effect=side_effect)
+            _patch.start()
+            self.addCleanup(_patch.stop)
+
+    def _relation_ids(self, reltype=None):
+        self.tools.append(('relation-ids', reltype))
+        return self.ids[reltype]
+
+    def _related_units(self, relid=None):
+        self.tools.append(('relation-list', relid))
+        return self.units[relid]
+
+    def _relation_get(self, attribute=None, unit=None, rid=None):
+        self.tools.append(('relation-get', rid, unit))
+        return self.settings[(rid, unit)]
+
+    def test_load_on_first_settings_read(self):
+        snapshot = hookenv.relation_snapshot()
+        self.assertFalse(snapshot.loaded)
+        self.assertEqual(snapshot.relation_ids('cluster'), None)
+        self.assertEqual(snapshot.related_units('cluster:1'), None)
+        self.assertEqual(self.tools, [])
+
+        self.assertEqual(snapshot.get(), {'b': '2'})
+        self.assertTrue(snapshot.loaded)
+        self.assertEqual(len(self.tools), snapshot.calls)
+        self.assertEqual(snapshot.get(unit='keystone/0', rid='cluster:1'),
+                         {'a': '1'})
+        self.assertEqual(snapshot.relation_ids('cluster'), ['cluster:1'])
+        self.assertEqual(snapshot.related_units('cluster:1'),
+                         ['keystone/1'])
+        self.assertEqual(snapshot.get(unit='keystone/2', rid='cluster:1'),
+                         None)
+        self.assertEqual(snapshot.saved, 4)
+
+        snapshot.load()
+        self.assertEqual(len(self.tools), snapshot.calls)
+
+    def test_reads_served_from_snapshot(self):
+        hookenv.relation_snapshot()
+        self.assertEqual(hookenv.relation_get('b'), '2')
+        calls = len(self.tools)
+        self.assertEqual(hookenv.relation_ids('cluster'), ['cluster:1'])
+        self.assertEqual(hookenv.related_units('cluster:1'), ['keystone/1'])
+        self.assertEqual(hookenv.relation_get(unit='keystone/0',
+                                              rid='cluster:1'), {'a': '1'})
+        self.assertEqual(len(self.tools), calls)
+
+    def test_update(self):
+        snapshot = hookenv.relation_snapshot()
+        snapshot.load()
+        snapshot.update('cluster:1', {'a': None, 'c': '3'})
+        self.assertEqual(snapshot.get(unit='keystone/0', rid='cluster:1'),
+                         {'c': '3'})
+        # The settings loaded are not changed in place
+        self.assertEqual(self.settings[('cluster:1', 'keystone/0')],
+                         {'a': '1'})
+        snapshot.update('other:2', {'a': '1'})
+        self.assertFalse(('other:2', 'keystone/0') in snapshot.settings)
+
+    def test_report(self):
+        snapshot = hookenv.relation_snapshot()
+        snapshot.report()
+        self.log.assert_called_with("Relation snapshot: not loaded",
+                                    level=hookenv.DEBUG)
+        snapshot.get()
+        snapshot.report()
+        self.log.assert_called_with(
+            "Relation snapshot: 5 relation tool calls to load, 1 avoided",
+            level=hookenv.DEBUG)
+
+
+class TestRelationWrites(CharmTestCase):
+
+    def setUp(self):
+        super(TestRelationWrites, self).setUp(hookenv, TO_PATCH)
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.addCleanup(setattr, hookenv, '_relation_set_buffer', None)
+        for name in ('_atstart', '_atexit'):
+            _patch = patch.object(hookenv, name, [])
+            _patch.start()
+            self.addCleanup(_patch.stop)
+        self.local_unit.return_value = 'keystone/0'
+        self.relation_id.return_value = 'cluster:1'
+        self.remote_unit.return_value = 'keystone/1'
+        self.current = {}
+        self.patch_object('_relation_get', side_effect=self._relation_get)
+
+    def patch_object(self, name, **kwargs):
+        _patch = patch.object(hookenv, name, **kwargs)
+        mock = _patch.start()
+        self.addCleanup(_patch.stop)
+        return mock
+
+    def _relation_get(self, attribute=None, unit=None, rid=None):
+        return self.current.get(rid)
+
+    def test_writes_merged_per_relation(self):
+        _relation_set = self.patch_object('_relation_set')
+        hookenv.buffer_relation_writes()
+        hookenv.relation_set(a=1)
+        hookenv.relation_set(relation_id='cluster:1', b='2')
+        hookenv.relation_set(relation_id='cluster:1',
+                             relation_settings={'a': '3'})
+        hookenv.relation_set(relation_id='identity-service:2', c='4')
+        self.assertFalse(_relation_set.called)
+        self.assertEqual(hookenv.relation_get('a', unit='keystone/0'), '3')
+        self.assertEqual(hookenv.relation_get(unit='keystone/0'),
+                         {'a': '3', 'b': '2'})
+
+        self.current['cluster:1'] = {'b': '2'}
+        hookenv._run_atexit()
+        self.assertEqual(_relation_set.call_args_list,
+                         [call('cluster:1', {'a': '3'}),
+                          call('identity-service:2', {'c': '4'})])
+
+    def test_none_deletes_settings(self):
+        _relation_set = self.patch_object('_relation_set')
+        hookenv.buffer_relation_writes()
+        hookenv.relation_set(relation_id='cluster:1', a=None, b=None)
+        hookenv.relation_set(relation_id='cluster:1', c='3')
+        hookenv.relation_set(relation_id='cluster:1', c=None)
+        self.current['cluster:1'] = {'a': '1'}
+        self.assertEqual(hookenv.relation_get(unit='keystone/0'), {})
+        hookenv.flush_relation_writes()
+        _relation_set.assert_called_once_with('cluster:1', {'a': None})
+
+    def test_unchanged_settings_not_written(self):
+        _relation_set = self.patch_object('_relation_set')
+        hookenv.buffer_relation_writes()
+        hookenv.relation_set(relation_id='cluster:1', a='1')
+        self.current['cluster:1'] = {'a': '1'}
+        hookenv.flush_relation_writes()
+        self.assertFalse(_relation_set.called)
+
+    def test_writes_after_flush_not_buffered(self):
+        _relation_set = self.patch_object('_relation_set')
+        hookenv.buffer_relation_writes()
+        hookenv.flush_relation_writes()
+        hookenv.relation_set(relation_id='cluster:1', a='1')
+        _relation_set.assert_called_once_with('cluster:1', {'a': '1'})
+
+    @patch.object(hookenv.subprocess, 'check_call')
+    def test_relation_set_file(self, check_call):
+        self.patch_object('_relation_set_accepts_file', return_value=True)
+        written = []
+        check_call.side_effect = \
+            lambda args: written.append(yaml.safe_load(open(args[-1])))
+        hookenv.relation_set(relation_id='cluster:1', a='1', b=None)
+        args = check_call.call_args[0][0]
+        self.assertEqual(args[:4], ['relation-set', '-r', 'cluster:1',
+                                    '--file'])
+        self.assertEqual(written, [{'a': '1', 'b': None}])
+        self.assertFalse(os.path.exists(args[-1]))
+
+    @patch.object(hookenv.subprocess, 'check_call')
+    def test_relation_set_argv(self, check_call):
+        self.patch_object('_relation_set_accepts_file', return_value=False)
+        hookenv.relation_set(relation_id='cluster:1', a='1', b=None)
+        args = check_call.call_args[0][0]
+        self.assertEqual(args[:3], ['relation-set', '-r', 'cluster:1'])
+        self.assertEqual(sorted(args[3:]), ['a=1', 'b='])
+
+    @patch.object(host, 'service')
+    @patch.object(host, '_restart_db')
+    def test_writes_flushed_before_deferred_restarts(self, _restart_db,
+                                                     service):
+        self.addCleanup(setattr, host, '_deferred_restarts', None)
+        _restart_db.return_value.get.return_value = None
+        calls = MagicMock()
+        service.side_effect = calls.service
+        self.patch_object('_relation_set', side_effect=calls.relation_set)
+        hookenv.atstart(host.defer_restarts, ['keystone'])
+        hookenv.atstart(hookenv.buffer_relation_writes)
+        hookenv._run_atstart()
+        host.queue_restart('keystone')
+        hookenv.relation_set(relation_id='cluster:1', a='1')
+        hookenv._run_atexit()
+        self.assertEqual(calls.mock_calls,
+                         [call.relation_set('cluster:1', {'a': '1'}),
+                          call.service('restart', 'keystone')])
+
+
+class TestLogBuffer(CharmTestCase):
+
+    def setUp(self):
+        super(TestLogBuffer, self).setUp(hookenv, ['_juju_log', 'py_atexit'])
+        self.addCleanup(setattr, hookenv, '_log_buffer', None)
+        self.addCleanup(setattr, hookenv, '_log_threshold', None)
+        self.hooks = hookenv.Hooks()
+        for name in ('_atstart', '_atexit'):
+            _patch = patch.object(hookenv, name, [])
+            _patch.start()
+            self.addCleanup(_patch.stop)
+
+    def test_messages_batched_by_level(self):
+        hookenv.buffer_log()
+        self.py_atexit.register.assert_called_once_with(hookenv.flush_log)
+        hookenv.log('one', level=hookenv.INFO)
+        hookenv.log('two', level=hookenv.INFO)
+        hookenv.log('three', level=hookenv.WARNING)
+        hookenv.log('four', level=hookenv.INFO)
+        self.assertFalse(self._juju_log.called)
+        hookenv.flush_log()
+        self.assertEqual(self._juju_log.call_args_list,
+                         [call('one\ntwo', hookenv.INFO),
+                          call('three', hookenv.WARNING),
+                          call('four', hookenv.INFO)])
+        hookenv.flush_log()
+        self.assertEqual(self._juju_log.call_count, 3)
+
+    @patch.object(hookenv, 'LOG_BATCH_SIZE', 8)
+    def test_batch_size(self):
+        hookenv.buffer_log()
+        for message in ('one', 'two', 'three'):
+            hookenv.log(message, level=hookenv.INFO)
+        hookenv.flush_log()
+        self.assertEqual(self._juju_log.call_args_list,
+                         [call('one\ntwo', hookenv.INFO),
+                          call('three', hookenv.INFO)])
+
+    def test_debug_dropped(self):
+        hookenv.buffer_log(level=hookenv.INFO)
+        hookenv.log('debug', level=hookenv.DEBUG)
+        hookenv.log('info', level=hookenv.INFO)
+        hookenv.log('unleveled')
+        hookenv.flush_log()
+        self.assertEqual(self._juju_log.call_args_list,
+                         [call('info', hookenv.INFO),
+                          call('unleveled', None)])
+
+    def test_debug_kept(self):
+        hookenv.buffer_log(level=hookenv.DEBUG)
+        hookenv.log('debug', level=hookenv.DEBUG)
+        hookenv.flush_log()
+        self._juju_log.assert_called_once_with('debug', hookenv.DEBUG)
+
+    def test_flushed_on_success(self):
+        def install():
+            hookenv.log('installed', level=hookenv.INFO)
+        self.hooks.register('install', install)
+        hookenv.atstart(hookenv.buffer_log)
+        self.hooks.execute(['install'])
+        self._juju_log.assert_called_once_with('installed', hookenv.INFO)
+
+    def test_flushed_on_failure(self):
+        def install():
+            hookenv.log('installing', level=hookenv.INFO)
+            raise ValueError('failed')
+        self.hooks.register('install', install)
+        hookenv.atstart(hookenv.buffer_log)
+        self.assertRaises(ValueError, self.hooks.execute, ['install'])
+        self._juju_log.assert_called_once_with('installing', hookenv.INFO)
+
+
+class TestCache(CharmTestCase):
+
+    def setUp(self):
+        super(TestCache, self).setUp(hookenv, TO_PATCH)
+        hookenv.cache.clear()
+        self.addCleanup(hookenv.cache.clear)
+        self.local_unit.return_value = 'keystone/0'
+        self.relation_id.return_value = 'cluster:1'
+        self.remote_unit.return_value = 'keystone/1'
+        self.calls = []
+
+        @hookenv.cached
+        def settings(name):
+            self.calls.append(('settings', name))
+            hookenv.cache_tag(('settings', name))
+            return name.upper()
+
+        @hookenv.cached
+        def summary(*names):
+            self.calls.append(('summary', names))
+            return ' '.join(settings(name) for name in names)
+
+        self.settings = settings
+        self.summary = summary
+
+    def test_cached(self):
+        self.assertEqual(self.summary('a', 'b'), 'A B')
+        self.assertEqual(self.summary('a', 'b'), 'A B')
+        self.assertEqual(self.settings('a'), 'A')
+        self.assertEqual(self.calls, [('summary', ('a', 'b')),
+                                      ('settings', 'a'),
+                                      ('settings', 'b')])
+        self.assertEqual(hookenv.cache.hits[self.summary._wrapped], 1)
+        self.assertEqual(hookenv.cache.misses[self.settings._wrapped], 2)
+
+    def test_invalidate(self):
+        self.summary('a', 'b')
+        self.summary('c')
+        del self.calls[:]
+        hookenv.cache_invalidate(('settings', 'b'))
+        self.assertFalse(('settings', 'b') in hookenv.cache.tagged)
+        self.summary('a', 'b')
+        self.summary('c')
+        self.settings('a')
+        # Invalidating b drops it and the summary depending on it only
+        self.assertEqual(self.calls, [('summary', ('a', 'b')),
+                                      ('settings', 'b')])
+
+    def test_flush(self):
+        # flush() matches the repr of the function too, so use names which
+        # cannot appear in its address.
+        self.summary('alpha')
+        self.settings('beta')
+        hookenv.flush('beta')
+        self.assertEqual(hookenv.cache.tagged,
+                         {('settings', 'alpha'): set([
+                             (self.settings._wrapped, (('alpha',), ())),
+                             (self.summary._wrapped, (('alpha',), ()))])})
+        del self.calls[:]
+        self.settings('beta')
+        self.summary('alpha')
+        self.assertEqual(self.calls, [('settings', 'beta')])
+
+    @patch.object(hookenv, '_relation_set_accepts_file')
+    @patch.object(hookenv.subprocess, 'check_call')
+    @patch.object(hookenv.subprocess, 'check_output')
+    def test_relation_get_cached(self, check_output, check_call,
+                                 accepts_file):
+        accepts_file.return_value = False
+        check_output.return_value = b'{"a": "1"}'
+        self.assertEqual(hookenv.relation_get(), {'a': '1'})
+        self.assertEqual(hookenv.relation_get(unit='keystone/0'), {'a': '1'})
+        self.assertEqual(hookenv.relation_get(), {'a': '1'})
+        self.assertEqual(check_output.call_count, 2)
+
+        # Setting the local unit's settings drops only its cached settings
+        hookenv.relation_set(a='2')
+        check_output.return_value = b'{"a": "2"}'
+        self.assertEqual(hookenv.relation_get(unit='keystone/0'), {'a': '2'})
+        self.assertEqual(hookenv.relation_get(), {'a': '1'})
+        self.assertEqual(check_output.call_count, 3)
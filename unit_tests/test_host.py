@@ -0,0 +1,285 @@
+import grp
+import os
+import pwd
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+
+from charmhelpers.core import host
+
+
+class TestWriteFileAtomic(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(host.invalidate_file_hash)
+        _patch = patch.object(host, 'log')
+        _patch.start()
+        self.addCleanup(_patch.stop)
+        self.path = os.path.join(self.tmpdir, 'test.conf')
+        self.owner = pwd.getpwuid(os.getuid()).pw_name
+        self.group = grp.getgrgid(os.getgid()).gr_name
+
+    def write(self, content, perms=None):
+        return host.write_file_atomic(self.path, content, owner=self.owner,
+                                      group=self.group, perms=perms)
+
+    def test_write_new_file(self):
+        self.assertTrue(self.write(u'one', perms=0o600))
+        self.assertEqual(open(self.path).read(), 'one')
+        self.assertEqual(os.stat(self.path).st_mode & 0o7777, 0o600)
+        self.assertEqual(os.listdir(self.tmpdir), ['test.conf'])
+
+    def test_unchanged_not_rewritten(self):
+        self.write('one', perms=0o600)
+        inode = os.stat(self.path).st_ino
+        self.assertFalse(self.write('one'))
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+        # Permissions are corrected in place
+        self.assertFalse(self.write('one', perms=0o640))
+        self.assertEqual(os.stat(self.path).st_ino, inode)
+        self.assertEqual(os.stat(self.path).st_mode & 0o7777, 0o640)
+
+    def test_changed_replaced_keeping_perms(self):
+        self.write('one', perms=0o600)
+        inode = os.stat(self.path).st_ino
+        self.assertTrue(self.write('two'))
+        self.assertEqual(open(self.path).read(), 'two')
+        self.assertNotEqual(os.stat(self.path).st_ino, inode)
+        self.assertEqual(os.stat(self.path).st_mode & 0o7777, 0o600)
+
+    def test_symlink_written_through(self):
+        target = os.path.join(self.tmpdir, 'target.conf')
+        with open(target, 'w') as f:
+            f.write('one')
+        os.symlink(target, self.path)
+        self.assertEqual(host.file_hash(self.path),
+                         host.file_hash(target))
+        self.assertTrue(self.write('two'))
+        self.assertTrue(os.path.islink(self.path))
+        self.assertEqual(open(target).read(), 'two')
+        self.assertEqual(host.file_hash(self.path),
+                         host.file_hash(target))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['target.conf', 'test.conf'])
+
+    @patch.object(host.os, 'fsync')
+    def test_failed_write_cleaned_up(self, fsync):
+        self.write('one')
+        fsync.side_effect = OSError('disk full')
+        self.assertRaises(OSError, self.write, 'two')
+        self.assertEqual(open(self.path).read(), 'one')
+        self.assertEqual(os.listdir(self.tmpdir), ['test.conf'])
+
+
+class TestFileHash(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(host.invalidate_file_hash)
+        self.path = os.path.join(self.tmpdir, 'test.conf')
+        with open(self.path, 'w') as f:
+            f.write('one')
+        # Old enough for its hash to be kept
+        os.utime(self.path, (1000000000, 1000000000))
+
+    def test_missing(self):
+        self.assertEqual(host.file_hash(self.path + '.missing'), None)
+
+    @patch.object(host.hashlib, 'md5', wraps=host.hashlib.md5)
+    def test_hash_reused_while_unchanged(self, md5):
+        digest = host.file_hash(self.path)
+        self.assertEqual(host.file_hash(self.path), digest)
+        self.assertEqual(md5.call_count, 1)
+        self.assertNotEqual(host.file_hash(self.path, 'sha256'), digest)
+
+        with open(self.path, 'w') as f:
+            f.write('two')
+        os.utime(self.path, (1000000001, 1000000001))
+        self.assertNotEqual(host.file_hash(self.path), digest)
+        self.assertEqual(md5.call_count, 2)
+
+        host.invalidate_file_hash(self.path)
+        host.file_hash(self.path)
+        self.assertEqual(md5.call_count, 3)
+
+    @patch.object(host.hashlib, 'md5', wraps=host.hashlib.md5)
+    def test_recently_modified_not_kept(self, md5):
+        os.utime(self.path, None)
+        host.file_hash(self.path)
+        host.file_hash(self.path)
+        self.assertEqual(md5.call_count, 2)
+
+
+class TestRestartOnChange(unittest.TestCase):
+
+    def setUp(self):
+        for name in ('path_hash', 'service', 'service_reload',
+                     'queue_restart', 'queue_reload'):
+            _patch = patch.object(host, name)
+            setattr(self, name, _patch.start())
+            self.addCleanup(_patch.stop)
+        self.addCleanup(setattr, host, '_deferred_restarts', None)
+        self.hashes = {'/etc/haproxy/haproxy.cfg': 'a',
+                       '/etc/apache2/sites-available/openstack_https_frontend':
+                       'b',
+                       '/etc/keystone/keystone.conf': 'c'}
+        self.path_hash.side_effect = self.hashes.get
+        self.restart_map = {
+            '/etc/haproxy/haproxy.cfg': ['haproxy'],
+            '/etc/apache2/sites-available/openstack_https_frontend':
+            ['apache2'],
+            '/etc/keystone/keystone.conf': ['keystone', 'apache2'],
+        }
+        self.reload_map = {
+            '/etc/haproxy/haproxy.cfg': ['haproxy'],
+            '/etc/apache2/sites-available/openstack_https_frontend':
+            ['apache2'],
+        }
+
+    def change(self, *paths):
+        @host.restart_on_change(self.restart_map,
+                                reload_map=self.reload_map)
+        def hook():
+            for path in paths:
+                self.hashes[path] += 'x'
+        hook()
+
+    def test_reload_only(self):
+        self.change('/etc/haproxy/haproxy.cfg',
+                    '/etc/apache2/sites-available/openstack_https_frontend')
+        self.assertEqual(sorted(self.service_reload.call_args_list),
+                         [(('apache2',), {'restart_on_failure': True}),
+                          (('haproxy',), {'restart_on_failure': True})])
+        self.assertFalse(self.service.called)
+
+    def test_restart_replaces_reload(self):
+        self.change('/etc/apache2/sites-available/openstack_https_frontend',
+                    '/etc/keystone/keystone.conf')
+        self.assertEqual(sorted(self.service.call_args_list),
+                         [(('restart', 'apache2'),),
+                          (('restart', 'keystone'),)])
+        self.assertFalse(self.service_reload.called)
+
+    def test_deferred(self):
+        host._deferred_restarts = {}
+        self.change('/etc/haproxy/haproxy.cfg',
+                    '/etc/keystone/keystone.conf')
+        self.assertEqual(sorted(self.queue_restart.call_args_list),
+                         [(('apache2',), {'stopstart': False}),
+                          (('keystone',), {'stopstart': False})])
+        self.queue_reload.assert_called_once_with('haproxy')
+        self.assertFalse(self.service.called)
+        self.assertFalse(self.service_reload.called)
+
+
+class TestDeferredRestarts(unittest.TestCase):
+
+    def setUp(self):
+        for name in ('log', 'service', 'service_reload'):
+            _patch = patch.object(host, name)
+            setattr(self, name, _patch.start())
+            self.addCleanup(_patch.stop)
+        _patch = patch.object(host.hookenv, 'atexit')
+        self.atexit = _patch.start()
+        self.addCleanup(_patch.stop)
+        _patch = patch.object(host.unitdata, 'kv')
+        self.kv = _patch.start()
+        self.addCleanup(_patch.stop)
+        self.addCleanup(setattr, host, '_deferred_restarts', None)
+        self.addCleanup(setattr, host, '_restart_storage', None)
+        host._restart_storage = host.unitdata.Storage(':memory:')
+        self.actions = []
+        self.service.side_effect = \
+            lambda action, name: self.actions.append((action, name))
+        self.service_reload.side_effect = \
+            lambda name, **kwargs: self.actions.append(('reload', name))
+
+    def test_not_deferred(self):
+        host.queue_restart('keystone')
+        host.queue_restart('apache2', stopstart=True)
+        host.queue_reload('haproxy')
+        self.assertEqual(self.actions, [('restart', 'keystone'),
+                                        ('stop', 'apache2'),
+                                        ('start', 'apache2'),
+                                        ('reload', 'haproxy')])
+
+    def test_queue_collapsed(self):
+        host.defer_restarts(['keystone', 'apache2'])
+        self.atexit.assert_called_once_with(host.run_deferred_restarts)
+        host.queue_reload('memcached')
+        host.queue_reload('apache2')
+        host.queue_restart('apache2')
+        host.queue_reload('apache2')
+        host.queue_restart('keystone')
+        host.queue_restart('keystone', stopstart=True)
+        host.queue_restart('keystone')
+        host.queue_reload('haproxy')
+        self.assertEqual(self.actions, [])
+        host.run_deferred_restarts()
+        self.assertEqual(self.actions, [('stop', 'keystone'),
+                                        ('start', 'keystone'),
+                                        ('restart', 'apache2'),
+                                        ('reload', 'memcached'),
+                                        ('reload', 'haproxy')])
+        del self.actions[:]
+        host.run_deferred_restarts()
+        self.assertEqual(self.actions, [])
+
+    def test_callbacks(self):
+        pre_restart = MagicMock()
+        post_restart = MagicMock()
+        host.defer_restarts(['keystone'], pre_restart=pre_restart,
+                            post_restart=post_restart)
+        host.run_deferred_restarts()
+        # Reloads are not coordinated
+        host.queue_reload('apache2')
+        host.run_deferred_restarts()
+        self.assertFalse(pre_restart.called)
+        self.assertFalse(post_restart.called)
+        host.queue_reload('apache2')
+        host.queue_restart('keystone')
+        host.run_deferred_restarts()
+        pre_restart.assert_called_once_with(['keystone'])
+        post_restart.assert_called_once_with(['keystone'])
+
+    def test_restarts_held_back(self):
+        pre_restart = MagicMock(return_value=False)
+        host.defer_restarts(['keystone'], pre_restart=pre_restart)
+        host.queue_reload('apache2')
+        host.queue_restart('keystone')
+        host.run_deferred_restarts()
+        self.assertEqual(self.actions, [('reload', 'apache2')])
+        self.assertEqual(host._deferred_restarts, {'keystone': 'restart'})
+        pre_restart.return_value = None
+        host.run_deferred_restarts()
+        self.assertEqual(self.actions, [('reload', 'apache2'),
+                                        ('restart', 'keystone')])
+        self.assertEqual(host._deferred_restarts, {})
+
+    def test_failed_check_keeps_queue(self):
+        post_restart = MagicMock(side_effect=ValueError('not healthy'))
+        host.defer_restarts(post_restart=post_restart)
+        host.queue_restart('keystone')
+        self.assertRaises(ValueError, host.run_deferred_restarts)
+        host._deferred_restarts = None
+        host.defer_restarts()
+        self.assertEqual(host._deferred_restarts, {'keystone': 'restart'})
+
+    def test_queue_kept_for_next_hook(self):
+        host.defer_restarts()
+        host.queue_restart('keystone')
+        # The hook fails, so the deferred restarts are not run.
+        host._deferred_restarts = None
+        host.defer_restarts()
+        host.run_deferred_restarts()
+        self.assertEqual(self.actions, [('restart', 'keystone')])
+        host._deferred_restarts = None
+        host.defer_restarts()
+        self.assertEqual(host._deferred_restarts, {})
+        # The unit's kv store, and pending writes to it, are left alone
+        self.assertFalse(self.kv.called)
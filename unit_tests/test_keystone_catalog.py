@@ -0,0 +1,216 @@
+from mock import MagicMock
+
+import keystone_catalog as catalog
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'log',
+]
+
+
+class TestKeystoneCatalog(CharmTestCase):
+
+    def setUp(self):
+        super(TestKeystoneCatalog, self).setUp(catalog, TO_PATCH)
+        self.ids = {
+            'tenant': {'admin': 't1', 'services': 't2'},
+            'role': {'Admin': 'r1'},
+            'user': {'admin': 'u1', 'nova': 'u2'},
+            'service': {'keystone': 's1', 'nova': 's2', 'quantum': 's3'},
+        }
+        self.grants = {('u1', 't1'): set(['r1']), ('u2', 't2'): set(['r1'])}
+        self.endpoints = {
+            ('s1', 'RegionOne'): {'id': 'e1',
+                                  'publicurl': 'http://10.0.0.1:5000/v2.0',
+                                  'adminurl': 'http://10.0.0.1:35357/v2.0',
+                                  'internalurl': 'http://10.0.0.1:5000/v2.0'},
+        }
+        self.manager = MagicMock()
+        for kind in self.ids:
+            resolve = getattr(self.manager, 'resolve_%s_id' % kind)
+            resolve.side_effect = (lambda name, service_type=None, kind=kind:
+                                   self.ids[kind].get(name))
+
+        self.manager.roles_for_user.side_effect = (
+            lambda user_id, tenant_id: self.grants[(user_id, tenant_id)])
+        self.manager.find_endpoint.side_effect = (
+            lambda service_id, region: self.endpoints.get((service_id,
+                                                           region)))
+        # Create the child mocks up front, MagicMock creates them lazily and
+        # not thread safely when plans are applied concurrently.
+        for method in ['create_tenant', 'create_role', 'create_service',
+                       'delete_service', 'create_user', 'update_user_password',
+                       'add_user_role', 'create_endpoint', 'update_endpoint']:
+            getattr(self.manager, method)
+        self.passwords = {'admin': catalog.password_digest('secret', 'key'),
+                          'nova': catalog.password_digest('novapass', 'key')}
+
+    def _catalog(self):
+        desired = catalog.KeystoneCatalog()
+        desired.add_tenant('admin', 'Created by Juju')
+        desired.add_tenant('services', 'Created by Juju')
+        desired.add_role('Admin')
+        desired.add_user('admin', 'secret', 'admin')
+        desired.add_grant('admin', 'Admin', 'admin')
+        desired.add_service('keystone', 'identity', 'Keystone')
+        desired.add_endpoint('keystone', 'RegionOne',
+                             publicurl='http://10.0.0.1:5000/v2.0',
+                             adminurl='http://10.0.0.1:35357/v2.0',
+                             internalurl='http://10.0.0.1:5000/v2.0')
+        return desired
+
+    def test_reconcile_up_to_date(self):
+        plan = catalog.reconcile(self.manager, self._catalog(),
+                                 passwords=self.passwords, key='key')
+        self.assertEqual(len(plan), 0)
+        plan.apply(self.manager, passwords=self.passwords)
+        self.assertFalse(self.manager.create_tenant.called)
+        self.assertFalse(self.manager.update_user_password.called)
+        self.assertFalse(self.manager.create_endpoint.called)
+
+    def test_reconcile_creates_in_order(self):
+        desired = self._catalog()
+        desired.add_role('ResellerAdmin')
+        desired.add_service('swift', 'object-store', 'Swift')
+        desired.add_user('swift', 'swiftpass', 'services')
+        desired.add_grant('swift', 'ResellerAdmin', 'services')
+        desired.add_endpoint('swift', 'RegionOne', publicurl='p',
+                             adminurl='a', internalurl='i')
+        plan = catalog.reconcile(self.manager, desired,
+                                 passwords=self.passwords, key='key')
+        self.assertEqual([(a.action, a.kind, a.name) for a in plan.actions],
+                         [('create', 'role', 'ResellerAdmin'),
+                          ('create', 'service', 'swift'),
+                          ('create', 'user', 'swift'),
+                          ('create', 'grant',
+                           ('swift', 'ResellerAdmin', 'services')),
+                          ('create', 'endpoint', ('swift', 'RegionOne'))])
+
+        def create(kind, _id):
+            def _create(name, *args, **kwargs):
+                self.ids[kind][name] = _id
+            return _create
+
+        self.manager.create_role.side_effect = create('role', 'r2')
+        self.manager.create_service.side_effect = create('service', 's4')
+        self.manager.create_user.side_effect = create('user', 'u3')
+        plan.apply(self.manager, passwords=self.passwords)
+        self.manager.create_user.assert_called_with('swift', 'swiftpass',
+                                                    'juju@localhost', 't2')
+        self.manager.add_user_role.assert_called_with('u3', 'r2', 't2')
+        self.manager.create_endpoint.assert_called_with(
+            'RegionOne', 's4', publicurl='p', adminurl='a', internalurl='i')
+        self.assertEqual(self.passwords['swift'],
+                         catalog.password_digest('swiftpass', 'key'))
+
+    def test_reconcile_password_changed(self):
+        desired = catalog.KeystoneCatalog()
+        desired.add_user('admin', 'secret', 'admin')
+        desired.add_user('nova', 'newpass', 'services')
+        plan = catalog.reconcile(self.manager, desired,
+                                 passwords=self.passwords, key='key')
+        self.assertEqual([(a.action, a.kind, a.name) for a in plan.actions],
+                         [('update', 'user', 'nova')])
+        plan.apply(self.manager, passwords=self.passwords)
+        self.manager.update_user_password.assert_called_with('u2', 'newpass')
+        self.assertEqual(self.passwords['nova'],
+                         catalog.password_digest('newpass', 'key'))
+
+    def test_password_digest_keyed(self):
+        self.assertNotEqual(catalog.password_digest('secret', 'key'),
+                            catalog.password_digest('secret', 'other'))
+        desired = catalog.KeystoneCatalog()
+        desired.add_user('admin', 'secret', 'admin')
+        plan = catalog.reconcile(self.manager, desired,
+                                 passwords=self.passwords, key='other')
+        self.assertEqual([(a.action, a.kind, a.name) for a in plan.actions],
+                         [('update', 'user', 'admin')])
+
+    def test_reconcile_endpoint_changed(self):
+        desired = catalog.KeystoneCatalog()
+        desired.add_endpoint('keystone', 'RegionOne',
+                             publicurl='http://10.0.0.2:5000/v2.0',
+                             adminurl='http://10.0.0.1:35357/v2.0',
+                             internalurl='http://10.0.0.1:5000/v2.0')
+        plan = catalog.reconcile(self.manager, desired)
+        plan.apply(self.manager)
+        self.assertFalse(self.manager.delete_endpoint.called)
+        self.manager.update_endpoint.assert_called_with(
+            'e1', 'RegionOne', 's1', publicurl='http://10.0.0.2:5000/v2.0',
+            adminurl='http://10.0.0.1:35357/v2.0',
+            internalurl='http://10.0.0.1:5000/v2.0')
+
+    def test_reconcile_remove_service(self):
+        desired = catalog.KeystoneCatalog()
+        desired.remove_service('quantum', 'network')
+        desired.remove_service('ceilometer', 'metering')
+        plan = catalog.reconcile(self.manager, desired)
+        plan.apply(self.manager)
+        self.manager.delete_service.assert_called_once_with('s3')
+
+    def test_plan_dry_run(self):
+        desired = catalog.KeystoneCatalog()
+        desired.add_user('nova', 'newpass', 'services')
+        plan = catalog.reconcile(self.manager, desired,
+                                 passwords=self.passwords, key='key')
+        plan.apply(self.manager, passwords=self.passwords, dry_run=True)
+        self.assertFalse(self.manager.update_user_password.called)
+        self.assertEqual(self.passwords['nova'],
+                         catalog.password_digest('novapass', 'key'))
+        self.assertIn('update user nova', str(plan))
+        self.assertNotIn('newpass', str(plan))
+
+    def test_plan_apply_creates_before_deletes(self):
+        desired = catalog.KeystoneCatalog()
+        desired.add_service('swift', 'object-store', 'Swift')
+        desired.add_service('glance', 'image', 'Glance')
+        desired.remove_service('quantum', 'network')
+        desired.remove_service('nova', 'compute')
+        plan = catalog.reconcile(self.manager, desired)
+        self.manager.delete_service.side_effect = (
+            lambda _id: self.assertEqual(
+                self.manager.create_service.call_count, 2))
+        plan.apply(self.manager)
+        self.assertEqual(self.manager.delete_service.call_count, 2)
+
+    def test_catalog_update(self):
+        desired = catalog.KeystoneCatalog()
+        desired.add_tenant('admin')
+        other = self._catalog()
+        other.add_user('admin', 'changed', 'admin')
+        desired.update(other)
+        self.assertEqual(list(desired.tenants), ['admin', 'services'])
+        self.assertEqual(desired.users['admin'], ('changed', 'admin'))
+        self.assertEqual(desired.endpoints, other.endpoints)
+
+    def test_plan_apply_concurrent(self):
+        desired = catalog.KeystoneCatalog()
+        for service in ['keystone', 'nova', 'quantum']:
+            desired.add_endpoint(service, 'RegionTwo', publicurl='p',
+                                 adminurl='a', internalurl='i')
+        plan = catalog.reconcile(self.manager, desired)
+        self.assertEqual(len(plan), 3)
+        plan.apply(self.manager)
+        self.assertEqual(sorted(c[0][1] for c in
+                                self.manager.create_endpoint.call_args_list),
+                         ['s1', 's2', 's3'])
+
+    def test_worker_pool_shared(self):
+        pool = catalog.worker_pool()
+        self.assertTrue(catalog.worker_pool() is pool)
+        self.assertEqual(pool._processes, catalog.MAX_WORKERS)
+
+    def test_plan_apply_concurrent_error(self):
+        desired = catalog.KeystoneCatalog()
+        desired.add_endpoint('nova', 'RegionTwo', publicurl='p',
+                             adminurl='a', internalurl='i')
+        desired.add_endpoint('swift', 'RegionTwo', publicurl='p',
+                             adminurl='a', internalurl='i')
+        plan = catalog.reconcile(self.manager, desired)
+        with self.assertRaises(catalog.UnresolvedNameError) as cm:
+            plan.apply(self.manager)
+        self.assertEqual((cm.exception.kind, cm.exception.name),
+                         ('service', 'swift'))
+        self.manager.create_endpoint.assert_called_once_with(
+            'RegionTwo', 's2', publicurl='p', adminurl='a', internalurl='i')
@@ -82,6 +82,7 @@ class TestKeystoneContexts(CharmTestCase):
         self.assertTrue(mock_https.called)
         mock_unit_get.assert_called_with('private-address')
 
+    @patch('keystone_utils.draining_units')
     @patch('keystone_utils.api_port')
     @patch('charmhelpers.contrib.openstack.context.get_netmask_for_address')
     @patch('charmhelpers.contrib.openstack.context.get_address_in_network')
@@ -97,7 +98,7 @@ class TestKeystoneContexts(CharmTestCase):
         self, mock_open, mock_kv, mock_log, mock_relation_get,
             mock_related_units, mock_unit_get, mock_relation_ids, mock_config,
             mock_get_address_in_network, mock_get_netmask_for_address,
-            mock_api_port):
+            mock_api_port, mock_draining_units):
         os.environ['JUJU_UNIT_NAME'] = 'keystone'
 
         mock_relation_ids.return_value = ['identity-service:0', ]
@@ -109,6 +110,7 @@ class TestKeystoneContexts(CharmTestCase):
         mock_get_netmask_for_address.return_value = '255.255.255.0'
         self.determine_apache_port.return_value = '34'
         mock_api_port.return_value = '12'
+        mock_draining_units.return_value = []
         mock_kv().get.return_value = 'abcdefghijklmnopqrstuvwxyz123456'
 
         ctxt = context.HAProxyContext()
@@ -135,6 +137,46 @@ class TestKeystoneContexts(CharmTestCase):
              }
         )
 
+    @patch('keystone_utils.draining_units')
+    @patch('keystone_utils.api_port')
+    @patch('charmhelpers.contrib.openstack.context.get_netmask_for_address')
+    @patch('charmhelpers.contrib.openstack.context.get_address_in_network')
+    @patch('charmhelpers.contrib.openstack.context.config')
+    @patch('charmhelpers.contrib.openstack.context.relation_ids')
+    @patch('charmhelpers.contrib.openstack.context.unit_get')
+    @patch('charmhelpers.contrib.openstack.context.related_units')
+    @patch('charmhelpers.contrib.openstack.context.relation_get')
+    @patch('charmhelpers.contrib.openstack.context.log')
+    @patch('charmhelpers.contrib.openstack.context.kv')
+    @patch('__builtin__.open')
+    def test_haproxy_context_draining(
+        self, mock_open, mock_kv, mock_log, mock_relation_get,
+            mock_related_units, mock_unit_get, mock_relation_ids, mock_config,
+            mock_get_address_in_network, mock_get_netmask_for_address,
+            mock_api_port, mock_draining_units):
+        os.environ['JUJU_UNIT_NAME'] = 'keystone'
+
+        mock_relation_ids.return_value = ['identity-service:0', ]
+        mock_unit_get.return_value = '1.2.3.4'
+        mock_relation_get.return_value = '10.0.0.0'
+        mock_related_units.return_value = ['unit/0', ]
+        mock_config.return_value = None
+        mock_get_address_in_network.return_value = None
+        mock_get_netmask_for_address.return_value = '255.255.255.0'
+        self.determine_apache_port.return_value = '34'
+        mock_api_port.return_value = '12'
+        mock_draining_units.return_value = ['unit/0']
+        mock_kv().get.return_value = 'abcdefghijklmnopqrstuvwxyz123456'
+
+        ctxt = context.HAProxyContext()
+
+        self.assertEquals(ctxt()['frontends']['1.2.3.4']['backends'],
+                          {'keystone': '1.2.3.4'})
+        # The last backend is kept
+        mock_draining_units.return_value = ['unit/0', 'keystone']
+        self.assertEquals(ctxt()['frontends']['1.2.3.4']['backends'],
+                          {'keystone': '1.2.3.4', 'unit-0': '10.0.0.0'})
+
     @patch('charmhelpers.contrib.openstack.context.log')
     @patch('charmhelpers.contrib.openstack.context.config')
     @patch('charmhelpers.contrib.openstack.context.unit_get')
@@ -13,15 +13,19 @@ with patch('charmhelpers.core.hookenv.config') as config:
 
 _reg = utils.register_configs
 _map = utils.restart_map
+_reload_map = utils.reload_map
 
 utils.register_configs = MagicMock()
 utils.restart_map = MagicMock()
+utils.reload_map = MagicMock()
 
 import keystone_hooks as hooks
 from charmhelpers.contrib import unison
+from charmhelpers.core import hookenv, host
 
 utils.register_configs = _reg
 utils.restart_map = _map
+utils.reload_map = _reload_map
 
 TO_PATCH = [
     # charmhelpers.core.hookenv
@@ -56,6 +60,7 @@ TO_PATCH = [
     'save_script_rc',
     'migrate_database',
     'ensure_initial_admin',
+    'get_requested_catalog',
     'add_service_to_keystone',
     'synchronize_ca_if_changed',
     'update_nrpe_config',
@@ -83,6 +88,9 @@ class KeystoneRelationTests(CharmTestCase):
         self.config.side_effect = self.test_config.get
         self.ssh_user = 'juju_keystone'
 
+    def test_log_buffered_without_threshold(self):
+        self.assertTrue((hookenv.buffer_log, (), {}) in hookenv._atstart)
+
     @patch.object(utils, 'git_install_requested')
     @patch.object(unison, 'ensure_user')
     def test_install_hook(self, ensure_user, git_requested):
@@ -683,9 +691,24 @@ class KeystoneRelationTests(CharmTestCase):
             user=self.ssh_user, group='juju_keystone',
             peer_interface='cluster', ensure_local_user=True)
 
+    @patch.object(hooks, 'local_unit')
+    @patch.object(hooks, 'peer_units')
+    @patch.object(unison, 'ensure_user')
+    @patch.object(unison, 'ssh_authorized_peers')
+    def test_cluster_joined_payload_transport(self, ssh_authorized_peers,
+                                              ensure_user, mock_peer_units,
+                                              mock_local_unit):
+        self.test_config.set('ssl-sync-transport', 'relation')
+        mock_local_unit.return_value = 'unit/0'
+        mock_peer_units.return_value = ['unit/0']
+        hooks.cluster_joined()
+        self.assertFalse(ssh_authorized_peers.called)
+        ensure_user.assert_called_with(user=self.ssh_user,
+                                       group='juju_keystone')
+
     @patch.object(hooks, 'initialise_pki')
     @patch.object(hooks, 'update_all_identity_relation_units')
-    @patch.object(hooks, 'get_ssl_sync_request_units')
+    @patch.object(hooks, 'ssl_sync_required_units')
     @patch.object(hooks, 'is_ssl_cert_master')
     @patch.object(hooks, 'peer_units')
     @patch('keystone_utils.relation_ids')
@@ -702,7 +725,7 @@ class KeystoneRelationTests(CharmTestCase):
                              mock_log, mock_config, mock_relation_ids,
                              mock_peer_units,
                              mock_is_ssl_cert_master,
-                             mock_get_ssl_sync_request_units,
+                             mock_ssl_sync_required_units,
                              mock_update_all_identity_relation_units,
                              mock_initialise_pki):
 
@@ -914,12 +937,12 @@ class KeystoneRelationTests(CharmTestCase):
     @patch('keystone_utils.relation_ids')
     @patch('keystone_utils.is_elected_leader')
     @patch('keystone_utils.ensure_ssl_cert_master')
-    @patch('keystone_utils.update_hash_from_path')
+    @patch('keystone_utils.ssl_manifest')
     @patch('keystone_utils.synchronize_ca')
     @patch.object(unison, 'ssh_authorized_peers')
     def test_upgrade_charm_leader(self, ssh_authorized_peers,
                                   mock_synchronize_ca,
-                                  mock_update_hash_from_path,
+                                  mock_ssl_manifest,
                                   mock_ensure_ssl_cert_master,
                                   mock_is_elected_leader,
                                   mock_relation_ids,
@@ -933,8 +956,8 @@ class KeystoneRelationTests(CharmTestCase):
         mock_relation_ids.return_value = []
         mock_ensure_ssl_cert_master.return_value = True
         # Ensure always returns diff
-        mock_update_hash_from_path.side_effect = \
-            lambda hash, *args, **kwargs: hash.update(str(uuid.uuid4()))
+        mock_ssl_manifest.side_effect = \
+            lambda: {str(uuid.uuid4()): [1, 1, 1, str(uuid.uuid4())]}
 
         self.is_elected_leader.return_value = True
         self.filter_installed_packages.return_value = []
@@ -953,26 +976,43 @@ class KeystoneRelationTests(CharmTestCase):
     @patch('keystone_utils.log')
     @patch('keystone_utils.relation_ids')
     @patch('keystone_utils.ensure_ssl_cert_master')
-    @patch('keystone_utils.update_hash_from_path')
+    @patch('keystone_utils.ssl_manifest')
     @patch.object(unison, 'ssh_authorized_peers')
     def test_upgrade_charm_not_leader(self, ssh_authorized_peers,
-                                      mock_update_hash_from_path,
+                                      mock_ssl_manifest,
                                       mock_ensure_ssl_cert_master,
                                       mock_relation_ids,
                                       mock_log, git_requested):
         mock_relation_ids.return_value = []
         mock_ensure_ssl_cert_master.return_value = False
         # Ensure always returns diff
-        mock_update_hash_from_path.side_effect = \
-            lambda hash, *args, **kwargs: hash.update(str(uuid.uuid4()))
+        mock_ssl_manifest.side_effect = \
+            lambda: {str(uuid.uuid4()): [1, 1, 1, str(uuid.uuid4())]}
 
         self.is_elected_leader.return_value = False
         self.filter_installed_packages.return_value = []
         git_requested.return_value = False
         hooks.upgrade_charm()
         self.assertTrue(self.apt_install.called)
+        self.assertTrue(hooks.CONFIGS.clear_template_cache.called)
         ssh_authorized_peers.assert_called_with(
             user=self.ssh_user, group='juju_keystone',
             peer_interface='cluster', ensure_local_user=True)
         self.assertTrue(self.log.called)
         self.assertFalse(self.ensure_initial_admin.called)
+
+    @patch.object(hooks, 'kv')
+    def test_unit_data_committed_last(self, kv):
+        # Callbacks registered at import run after those added by the
+        # atstart callbacks, as atexit callbacks run in reverse order.
+        self.assertTrue((hooks.commit_unit_data, (), {}) in hookenv._atexit)
+        hooks.commit_unit_data()
+        kv.return_value.flush.assert_called_once_with()
+
+    def test_relation_writes_flushed_before_restarts(self):
+        # atexit callbacks run in reverse order, so buffered relation
+        # settings are only written before deferred restarts when
+        # buffer_relation_writes is registered after defer_restarts.
+        callbacks = [callback for callback, _, _ in hookenv._atstart]
+        self.assertTrue(callbacks.index(host.defer_restarts) <
+                        callbacks.index(hookenv.buffer_relation_writes))
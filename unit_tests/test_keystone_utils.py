@@ -1,7 +1,14 @@
-from mock import patch, call, MagicMock, Mock
+from mock import patch, call, MagicMock, Mock, ANY
 from test_utils import CharmTestCase
+import grp
+import json
 import os
+import pwd
+import shutil
+import tarfile
+import tempfile
 import manager
+from keystone_catalog import KeystoneCatalog
 
 os.environ['JUJU_UNIT_NAME'] = 'keystone'
 with patch('charmhelpers.core.hookenv.config') as config:
@@ -13,7 +20,6 @@ with patch.object(utils, 'register_configs'):
 TO_PATCH = [
     'api_port',
     'config',
-    'create_user',
     'os_release',
     'log',
     'get_ca',
@@ -41,6 +47,7 @@ TO_PATCH = [
     'related_units',
     'https',
     'is_relation_made',
+    'kv',
     'peer_store',
     'pip_install',
     # generic
@@ -67,6 +74,11 @@ class TestKeystoneUtils(CharmTestCase):
     def setUp(self):
         super(TestKeystoneUtils, self).setUp(utils, TO_PATCH)
         self.config.side_effect = self.test_config.get
+        # Each test builds its own shared KeystoneManager
+        del manager.MANAGER_SINGLETON[:]
+        self.os_release.return_value = 'icehouse'
+        self.kv.return_value.get.return_value = None
+        self.pwgen.return_value = 'secret'
 
         self.ctxt = MagicMock()
         self.rsc_map = {
@@ -110,6 +122,25 @@ class TestKeystoneUtils(CharmTestCase):
         ]
         self.assertEquals(fake_renderer.register.call_args_list, ex_reg)
 
+    @patch('os.path.exists')
+    def test_resource_map_shares_contexts(self, exists):
+        exists.return_value = True
+        rsc_map = utils.resource_map()
+        haproxy = [c for c in rsc_map[utils.HAPROXY_CONF]['contexts']
+                   if c in rsc_map[utils.KEYSTONE_CONF]['contexts']]
+        self.assertEquals(len(haproxy), 1)
+        self.assertIsInstance(haproxy[0],
+                              utils.keystone_context.HAProxyContext)
+
+    @patch('os.path.exists')
+    def test_reload_map(self, exists):
+        exists.return_value = True
+        self.assertEquals(utils.reload_map(),
+                          {utils.HAPROXY_CONF: ['haproxy'],
+                           utils.APACHE_24_CONF: ['apache2']})
+        self.assertEquals(utils.restart_map()[utils.KEYSTONE_CONF],
+                          ['keystone'])
+
     def test_determine_ports(self):
         self.test_config.set('admin-port', '80')
         self.test_config.set('service-port', '81')
@@ -164,13 +195,506 @@ class TestKeystoneUtils(CharmTestCase):
         self.assertTrue(configs.write_all.called)
         self.assertTrue(migrate_database.called)
 
-    def test_migrate_database(self):
+    @patch.object(utils.os, 'execl')
+    @patch.object(utils, 'flush_log')
+    @patch.object(utils, 'flush_relation_writes')
+    @patch.object(utils, 'do_openstack_upgrade')
+    def test_openstack_upgrade_reexec(self, do_openstack_upgrade,
+                                      flush_relation_writes, flush_log,
+                                      execl):
+        calls = []
+        flush_relation_writes.side_effect = \
+            lambda: calls.append('flush_relation_writes')
+        flush_log.side_effect = lambda: calls.append('flush_log')
+        execl.side_effect = lambda *args: calls.append('execl')
+        configs = MagicMock()
+        utils.do_openstack_upgrade_reexec(configs)
+        do_openstack_upgrade.assert_called_with(configs)
+        execl.assert_called_with('./hooks/config-changed-postupgrade', '')
+        self.assertEqual(calls,
+                         ['flush_relation_writes', 'flush_log', 'execl'])
+
+    @patch.object(utils, 'wait_for_keystone_ready')
+    def test_migrate_database(self, wait_for_keystone_ready):
+        wait_for_keystone_ready.return_value = 1.5
         utils.migrate_database()
 
         self.service_stop.assert_called_with('keystone')
         cmd = ['sudo', '-u', 'keystone', 'keystone-manage', 'db_sync']
         self.subprocess.check_output.assert_called_with(cmd)
         self.service_start.assert_called_with('keystone')
+        self.assertTrue(wait_for_keystone_ready.called)
+        self.assertFalse(self.time.sleep.called)
+        self.peer_store.assert_called_with('db-initialised', 'True')
+
+    @patch.object(utils, 'urllib2')
+    @patch.object(utils, 'socket')
+    def test_wait_for_keystone_ready(self, socket, urllib2):
+        socket.error = IOError
+        urllib2.URLError = IOError
+        urllib2.HTTPError = type('HTTPError', (IOError,), {})
+        socket.create_connection.side_effect = [IOError('refused'),
+                                                IOError('refused'),
+                                                MagicMock()]
+        self.time.time.side_effect = [0, 0, 0.1, 0.1, 0.3, 0.3, 0.7]
+        self.assertEqual(utils.wait_for_keystone_ready(
+            'http://localhost:35357/v2.0/'), 0.7)
+        socket.create_connection.assert_called_with(('localhost', 35357),
+                                                    timeout=5)
+        urllib2.ProxyHandler.assert_called_with({})
+        urllib2.build_opener.assert_called_with(urllib2.ProxyHandler())
+        urllib2.build_opener().open.assert_called_once_with(
+            'http://localhost:35357/v2.0/', timeout=5)
+        self.assertEqual(self.time.sleep.call_args_list,
+                         [call(0.1), call(0.2)])
+
+    @patch.object(utils, 'urllib2')
+    @patch.object(utils, 'socket')
+    def test_wait_for_keystone_ready_timeout(self, socket, urllib2):
+        socket.error = IOError
+        urllib2.URLError = IOError
+        urllib2.HTTPError = type('HTTPError', (IOError,), {})
+        socket.create_connection.side_effect = IOError('refused')
+        self.time.time.side_effect = [0, 0, 30, 30, 61]
+        self.assertRaises(utils.KeystoneNotReadyError,
+                          utils.wait_for_keystone_ready,
+                          'http://localhost:35357/v2.0/')
+        self.assertEqual(self.time.sleep.call_args_list, [call(0.1)])
+
+    def test_scan_manifest(self):
+        self.time.time.return_value = 100
+        ssl_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ssl_dir)
+        os.mkdir(os.path.join(ssl_dir, 'pki'))
+        for name, content in [('ca.crt', 'ca'), ('pki/signing.crt', 'cert')]:
+            with open(os.path.join(ssl_dir, name), 'w') as f:
+                f.write(content)
+            os.utime(os.path.join(ssl_dir, name), (1, 1))
+
+        before = utils.scan_manifest([ssl_dir])
+        self.assertEqual(sorted(before),
+                         [os.path.join(ssl_dir, 'ca.crt'),
+                          os.path.join(ssl_dir, 'pki/signing.crt')])
+        with patch.object(utils, 'file_hash') as file_hash:
+            self.assertEqual(utils.scan_manifest([ssl_dir], before), before)
+            self.assertFalse(file_hash.called)
+
+        os.unlink(os.path.join(ssl_dir, 'ca.crt'))
+        with open(os.path.join(ssl_dir, 'pki/signing.crt'), 'w') as f:
+            f.write('new cert')
+        after = utils.scan_manifest([ssl_dir], before)
+        self.assertEqual(utils.manifest_changes(before, after),
+                         [os.path.join(ssl_dir, 'ca.crt'),
+                          os.path.join(ssl_dir, 'pki/signing.crt')])
+        self.assertNotEqual(utils.manifest_digest(before),
+                            utils.manifest_digest(after))
+        self.assertEqual(
+            utils.manifest_digest(before, [os.path.join(ssl_dir, 'pki')]),
+            utils.manifest_digest({
+                os.path.join(ssl_dir, 'pki/signing.crt'):
+                before[os.path.join(ssl_dir, 'pki/signing.crt')]}))
+
+    @patch.object(utils, 'scan_manifest')
+    def test_ssl_manifest(self, scan_manifest):
+        db = self.kv.return_value
+        db.get.return_value = {'/a': 1}
+        scan_manifest.return_value = {'/a': 2}
+        self.assertEqual(utils.ssl_manifest(), {'/a': 2})
+        scan_manifest.assert_called_with(utils.SSL_DIRS, {'/a': 1})
+        db.set.assert_called_once_with(utils.SSL_MANIFEST_KEY, {'/a': 2})
+
+        db.reset_mock()
+        db.get.return_value = {'/a': 2}
+        self.assertEqual(utils.ssl_manifest(), {'/a': 2})
+        self.assertFalse(db.set.called)
+
+    @patch.object(utils, 'ensure_permissions')
+    @patch.object(utils, 'ensure_ssl_dirs')
+    @patch.object(utils, 'ssl_manifest')
+    def test_stage_and_apply_sync_archive(self, ssl_manifest, ensure_ssl_dirs,
+                                          ensure_permissions):
+        self.time.time.return_value = 100
+        ssl_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, ssl_dir)
+        sync_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sync_dir, True)
+        archive = os.path.join(sync_dir, 'juju-ssl-sync.tar')
+        ensure_ssl_dirs.side_effect = lambda: os.mkdir(sync_dir)
+        ssl_manifest.side_effect = lambda: utils.scan_manifest([ssl_dir])
+        store = {}
+        self.kv.return_value.get.side_effect = store.get
+        self.kv.return_value.set.side_effect = store.__setitem__
+        self.relation_ids.return_value = ['cluster:1']
+        self.related_units.return_value = ['keystone/1']
+        self.relation_get.return_value = None
+
+        ca = os.path.join(ssl_dir, 'ca.crt')
+        cert = os.path.join(ssl_dir, 'pki', 'signing.crt')
+        os.mkdir(os.path.dirname(cert))
+        for path, content in [(ca, 'ca'), (cert, 'cert')]:
+            with open(path, 'w') as f:
+                f.write(content)
+
+        def read(path):
+            with open(path) as f:
+                return f.read()
+
+        def apply_sync_archive():
+            return utils.apply_sync_archive(
+                archive, user=pwd.getpwuid(os.getuid()).pw_name,
+                group=grp.getgrgid(os.getgid()).gr_name)
+
+        def members():
+            with tarfile.open(archive) as fd:
+                return sorted(m.name for m in fd.getmembers())
+
+        with patch.object(utils, 'SYNC_DIR', sync_dir), \
+                patch.object(utils, 'SSL_SYNC_ARCHIVE', archive):
+            # Nothing applied by peers yet, every file is staged
+            full = utils.stage_paths_for_sync([ssl_dir])
+            self.assertEqual(members(), [utils.SSL_SYNC_MANIFEST_MEMBER,
+                                         ca.lstrip('/'), cert.lstrip('/')])
+            os.unlink(ca)
+            self.assertEqual(apply_sync_archive(), full)
+            self.assertEqual(read(ca), 'ca')
+
+            # Peers have applied the last archive, only changes are staged
+            self.relation_get.return_value = full
+            os.unlink(ca)
+            with open(cert, 'w') as f:
+                f.write('new cert')
+            delta = utils.stage_paths_for_sync([ssl_dir])
+            self.assertNotEqual(delta, full)
+            self.assertEqual(members(), [utils.SSL_SYNC_MANIFEST_MEMBER,
+                                         cert.lstrip('/')])
+
+            # A peer which did not apply the base is left alone
+            with open(ca, 'w') as f:
+                f.write('ca')
+            store[utils.SSL_APPLIED_DIGEST_KEY] = 'other'
+            self.assertEqual(apply_sync_archive(), 'other')
+            self.assertTrue(os.path.exists(ca))
+
+            store[utils.SSL_APPLIED_DIGEST_KEY] = full
+            self.assertEqual(apply_sync_archive(), delta)
+            self.assertFalse(os.path.exists(ca))
+            self.assertEqual(read(cert), 'new cert')
+            self.assertEqual(os.stat(cert).st_mode & 0o777, 0o744)
+            self.assertEqual(os.listdir(os.path.dirname(cert)),
+                             ['signing.crt'])
+
+            # Archives without a manifest are applied as they are
+            with tarfile.open(archive, 'w') as fd:
+                fd.add(ssl_dir)
+            os.unlink(cert)
+            self.assertEqual(apply_sync_archive(), None)
+            self.assertEqual(read(cert), 'new cert')
+            self.assertEqual(os.stat(os.path.dirname(cert)).st_mode & 0o777,
+                             0o744)
+
+    @patch.object(utils, 'SSL_SYNC_CHUNK_SIZE', 4)
+    @patch.object(utils, 'write_file')
+    @patch.object(utils, 'ensure_ssl_dirs')
+    @patch.object(utils, 'leader_set')
+    @patch.object(utils, 'is_leader')
+    def test_publish_and_fetch_sync_payload(self, is_leader, leader_set,
+                                            ensure_ssl_dirs, write_file):
+        archive = tempfile.NamedTemporaryFile()
+        archive.write('0123456789')
+        archive.flush()
+        self.local_unit.return_value = 'keystone/0'
+        self.relation_ids.return_value = ['cluster:1']
+        self.relation_get.return_value = {}
+        self.time.time.return_value = 10
+        is_leader.return_value = False
+        settings = utils.publish_sync_payload(archive.name, 'd1',
+                                              ['flag'], 'leader')
+        self.assertFalse(leader_set.called)
+        self.assertEqual(len(settings), 4)
+
+        # Only changed chunks are published again
+        archive.seek(0)
+        archive.write('0123456799')
+        archive.flush()
+        self.relation_get.return_value = settings
+        self.time.time.return_value = 20
+        update = utils.publish_sync_payload(archive.name, 'd2', ['flag'],
+                                            'relation')
+        stale = set(settings) - set(update)
+        self.assertEqual(len(stale), 2)
+        self.assertEqual([k for k, v in update.items() if v is None],
+                         [json.loads(settings['ssl-sync-payload'])
+                          ['chunks'][2]])
+        settings.update(update)
+
+        # Peers reassemble the archive from the master's settings
+        self.test_config.set('ssl-sync-transport', 'relation')
+        self.related_units.return_value = ['keystone/0']
+        settings['ssl-cert-master'] = 'keystone/0'
+        self.relation_get.side_effect = lambda rid, unit: dict(settings)
+        self.kv.return_value.get.return_value = 'd1'
+        self.assertEqual(utils.fetch_sync_payload(), utils.SSL_SYNC_ARCHIVE)
+        write_file.assert_has_calls([
+            call(utils.SSL_SYNC_ARCHIVE, content='0123456799',
+                 owner=utils.SSH_USER, group='keystone', perms=0o644),
+            call(os.path.join(utils.SYNC_FLAGS_DIR, 'flag'), content='',
+                 owner=utils.SSH_USER, group='keystone', perms=0o744)])
+
+        write_file.reset_mock()
+        self.kv.return_value.get.return_value = 'd2'
+        self.assertEqual(utils.fetch_sync_payload(), None)
+        self.assertFalse(write_file.called)
+
+    def publish_payload(self, content, digest, published, transport,
+                        unit='keystone/1', current=None):
+        archive = tempfile.NamedTemporaryFile()
+        archive.write(content)
+        archive.flush()
+        self.local_unit.return_value = unit
+        self.relation_ids.return_value = ['cluster:1']
+        self.relation_get.return_value = current or {}
+        self.time.time.return_value = published
+        with patch.object(utils, 'is_leader', return_value=True), \
+                patch.object(utils, 'leader_get', return_value={}), \
+                patch.object(utils, 'leader_set') as leader_set:
+            settings = utils.publish_sync_payload(archive.name, digest, [],
+                                                  transport)
+        if transport == 'leader':
+            return leader_set.call_args[0][0], settings
+        return settings
+
+    def fetch_payload(self, transport, leader, units, applied):
+        self.test_config.set('ssl-sync-transport', transport)
+        self.local_unit.return_value = 'keystone/0'
+        self.related_units.return_value = sorted(units)
+        self.relation_get.side_effect = lambda rid, unit: dict(units[unit])
+        self.kv.return_value.get.return_value = applied
+        with patch.object(utils, 'leader_get', return_value=leader), \
+                patch.object(utils, 'write_file') as write_file, \
+                patch.object(utils, 'ensure_ssl_dirs'):
+            if utils.fetch_sync_payload():
+                return write_file.call_args_list[0][1]['content']
+
+    @patch.object(utils, 'SSL_SYNC_CHUNK_SIZE', 4)
+    def test_fetch_sync_payload_newest_from_master(self):
+        leader, _ = self.publish_payload('old certs', 'd1', 10, 'leader')
+        relation = self.publish_payload('new certs', 'd2', 20, 'relation')
+        relation['ssl-cert-master'] = 'keystone/1'
+        other = self.publish_payload('other certs', 'd3', 30, 'relation',
+                                     unit='keystone/2')
+        other['ssl-cert-master'] = 'keystone/1'
+        units = {'keystone/1': relation, 'keystone/2': other}
+        # The leader settings payload was applied, the newer one published
+        # on the relation after losing leadership is still found, while the
+        # payload of a unit which is not ssl-cert-master is ignored.
+        self.assertEqual(self.fetch_payload('leader', leader, units, 'd1'),
+                         'new certs')
+        self.assertEqual(self.fetch_payload('leader', leader, units, 'd2'),
+                         None)
+        self.assertEqual(self.fetch_payload('relation', {}, units, 'd0'),
+                         'new certs')
+        # A payload copied into another unit's settings is not trusted
+        units['keystone/2'] = dict(relation, **{'ssl-cert-master':
+                                                'keystone/1'})
+        units['keystone/1'] = {'ssl-cert-master': 'keystone/1'}
+        self.assertEqual(self.fetch_payload('relation', {}, units, 'd0'),
+                         None)
+
+    @patch.object(utils, 'SSL_SYNC_CHUNK_SIZE', 4)
+    def test_fetch_sync_payload_after_step_down(self):
+        # The master hands over its certs as it steps down, with the last
+        # payload going out in the same settings as ssl-cert-master=unknown
+        stepped_down = self.publish_payload('final certs', 'd2', 20,
+                                            'relation')
+        stepped_down['ssl-cert-master'] = 'unknown'
+        older = self.publish_payload('old certs', 'd1', 10, 'relation',
+                                     unit='keystone/2')
+        older['ssl-cert-master'] = 'unknown'
+        units = {'keystone/1': stepped_down, 'keystone/2': older}
+        self.assertEqual(self.fetch_payload('relation', {}, units, 'd0'),
+                         'final certs')
+        self.assertEqual(self.fetch_payload('relation', {}, units, 'd2'),
+                         None)
+        # Once a new master is elected only its payloads count
+        units['keystone/2']['ssl-cert-master'] = 'keystone/2'
+        self.assertEqual(self.fetch_payload('relation', {}, units, 'd0'),
+                         'old certs')
+
+    @patch.object(utils, 'SSL_SYNC_CHUNK_SIZE', 4)
+    def test_publish_sync_payload_leader_clears_relation(self):
+        relation = self.publish_payload('old certs', 'd1', 10, 'relation')
+        leader, settings = self.publish_payload('new certs', 'd2', 20,
+                                                'leader', current=relation)
+        self.assertEqual(settings, dict((key, None) for key in relation))
+        self.assertEqual(json.loads(leader['ssl-sync-payload'])['publisher'],
+                         'keystone/1')
+
+    @patch.object(utils, 'get_ssl_sync_request_units')
+    def test_ssl_sync_required_units(self, get_ssl_sync_request_units):
+        self.kv.return_value.get.return_value = {'digest': 'd2'}
+        self.relation_ids.return_value = ['cluster:1']
+        self.related_units.return_value = ['keystone/1', 'keystone/2',
+                                           'keystone/3', 'keystone/4']
+        applied = {'keystone/1': 'd2', 'keystone/2': 'd1'}
+        synced = json.dumps(['keystone-4'])
+
+        def fake_relation_get(attribute=None, rid=None, unit=None):
+            if attribute == 'ssl-synced-units':
+                return synced
+            return applied.get(unit)
+
+        self.relation_get.side_effect = fake_relation_get
+        get_ssl_sync_request_units.return_value = ['keystone-3', 'keystone-4']
+        self.assertEqual(utils.ssl_sync_status(),
+                         {'digest': 'd2', 'synced': ['keystone/1'],
+                          'pending': ['keystone/2', 'keystone/3',
+                                      'keystone/4']})
+        self.assertEqual(utils.ssl_sync_required_units(),
+                         ['keystone/2', 'keystone/3'])
+
+        # Once every peer acknowledged the digest nothing is synced again
+        applied.update({'keystone/2': 'd2', 'keystone/3': 'd2',
+                        'keystone/4': 'd2'})
+        self.assertEqual(utils.ssl_sync_required_units(), [])
+        self.assertEqual(utils.ssl_sync_status()['pending'], [])
+
+        # Units other than the ssl-cert-master have nothing to sync
+        applied['keystone/2'] = 'd1'
+        self.is_ssl_cert_master.return_value = False
+        self.assertEqual(utils.ssl_sync_status(), None)
+        self.assertEqual(utils.ssl_sync_required_units(), [])
+
+    def setup_rolling_restart(self):
+        self.test_config.set('rolling-restart-concurrency', 1)
+        self.local_unit.return_value = 'keystone/10'
+        self.relation_ids.return_value = ['cluster:1']
+        self.related_units.return_value = ['keystone/2', 'keystone/9']
+        self.time.time.return_value = 1.5
+        peers = {'keystone/2': {}, 'keystone/9': {}, 'keystone/10': {}}
+        leader = {}
+
+        def _relation_get(attribute, unit, rid):
+            return peers[unit].get(attribute)
+
+        def _relation_set(relation_id, relation_settings):
+            peers['keystone/10'].update(relation_settings)
+
+        def _leader_set(settings):
+            leader.update(settings)
+
+        self.relation_get.side_effect = _relation_get
+        self.relation_set.side_effect = _relation_set
+        for name, kwargs in [('is_leader', {'return_value': False}),
+                             ('leader_get', {'side_effect': leader.get}),
+                             ('leader_set', {'side_effect': _leader_set})]:
+            _patch = patch.object(utils, name, **kwargs)
+            _patch.start()
+            self.addCleanup(_patch.stop)
+        return peers, leader
+
+    def test_rolling_restart_disabled(self):
+        self.relation_ids.return_value = ['cluster:1']
+        self.related_units.return_value = ['keystone/2']
+        self.assertEqual(utils.rolling_restart_peers(), (None, []))
+        self.assertTrue(utils.claim_restart_slot(['keystone']))
+        self.test_config.set('rolling-restart-concurrency', 1)
+        self.related_units.return_value = []
+        self.assertTrue(utils.claim_restart_slot(['keystone']))
+        self.assertFalse(self.relation_set.called)
+
+    def test_grant_restart_slots(self):
+        peers, leader = self.setup_rolling_restart()
+        utils.is_leader.return_value = True
+        peers['keystone/9']['restart-request'] = '1'
+        peers['keystone/10']['restart-request'] = '2'
+        self.assertEqual(utils.grant_restart_slots(), {'keystone/9': '1'})
+        self.assertEqual(json.loads(leader['restart-slots']),
+                         {'keystone/9': '1'})
+        # The slot is held until released, however many units ask
+        peers['keystone/2']['restart-request'] = '3'
+        self.assertEqual(utils.grant_restart_slots(), {'keystone/9': '1'})
+        # and goes to the lowest unit number waiting once released
+        peers['keystone/9']['restart-request'] = None
+        self.assertEqual(utils.grant_restart_slots(), {'keystone/2': '3'})
+        self.test_config.set('rolling-restart-concurrency', 2)
+        self.assertEqual(utils.grant_restart_slots(),
+                         {'keystone/2': '3', 'keystone/10': '2'})
+        peers['keystone/2']['restart-request'] = None
+        peers['keystone/10']['restart-request'] = None
+        self.assertEqual(utils.grant_restart_slots(), {})
+        self.assertEqual(leader['restart-slots'], None)
+
+    def test_grant_restart_slots_not_leader(self):
+        peers, leader = self.setup_rolling_restart()
+        peers['keystone/9']['restart-request'] = '1'
+        leader['restart-slots'] = '{"keystone/2": "3"}'
+        self.assertEqual(utils.grant_restart_slots(), {'keystone/2': '3'})
+        self.assertEqual(leader['restart-slots'], '{"keystone/2": "3"}')
+
+    def test_claim_restart_slot(self):
+        peers, leader = self.setup_rolling_restart()
+        # The unit asks for a slot and waits for the leader to grant it
+        self.assertFalse(utils.claim_restart_slot(['keystone']))
+        self.assertEqual(peers['keystone/10'],
+                         {'restart-request': '1.500000'})
+        leader['restart-slots'] = '{"keystone/10": "1.500000"}'
+        # then for every peer to drain it
+        peers['keystone/2']['restart-drained'] = 'keystone/10=1.500000'
+        peers['keystone/9']['restart-drained'] = 'keystone/10=1.000000'
+        self.time.time.return_value = 3
+        self.assertFalse(utils.claim_restart_slot(['keystone']))
+        peers['keystone/9']['restart-drained'] = \
+            'keystone/10=1.500000 keystone/11=2'
+        self.assertTrue(utils.claim_restart_slot(['keystone']))
+        self.assertEqual(peers['keystone/10'],
+                         {'restart-request': '1.500000'})
+
+    def test_claim_restart_slot_leader(self):
+        peers, leader = self.setup_rolling_restart()
+        utils.is_leader.return_value = True
+        peers['keystone/2'] = {'restart-drained': 'keystone/10=1.500000'}
+        peers['keystone/9'] = {'restart-drained': 'keystone/10=1.500000'}
+        self.assertTrue(utils.claim_restart_slot(['keystone']))
+        self.assertEqual(json.loads(leader['restart-slots']),
+                         {'keystone/10': '1.500000'})
+
+    @patch.object(utils, 'HAPROXY_CONF', 'haproxy.cfg')
+    def test_update_restart_slots(self):
+        peers, leader = self.setup_rolling_restart()
+        configs = MagicMock()
+        leader['restart-slots'] = '{"keystone/2": "3", "keystone/10": "2"}'
+        self.assertEqual(utils.draining_units(), ['keystone/2'])
+        utils.update_restart_slots(configs)
+        configs.write.assert_called_once_with('haproxy.cfg')
+        self.assertEqual(peers['keystone/10'],
+                         {'restart-drained': 'keystone/2=3'})
+        self.relation_set.reset_mock()
+        utils.update_restart_slots(configs)
+        self.assertFalse(self.relation_set.called)
+        leader['restart-slots'] = None
+        self.assertEqual(utils.draining_units(), [])
+        utils.update_restart_slots(configs)
+        self.assertEqual(peers['keystone/10'], {'restart-drained': None})
+
+    @patch.object(utils, 'wait_for_keystone_ready')
+    def test_check_restarted(self, wait_for_keystone_ready):
+        peers, leader = self.setup_rolling_restart()
+        peers['keystone/10']['restart-request'] = '2'
+        wait_for_keystone_ready.return_value = 1.0
+        utils.check_restarted(['haproxy'])
+        self.assertFalse(wait_for_keystone_ready.called)
+        self.assertEqual(peers['keystone/10'], {'restart-request': None})
+
+        peers['keystone/10']['restart-request'] = '2'
+        wait_for_keystone_ready.side_effect = \
+            utils.KeystoneNotReadyError('not ready')
+        self.assertRaises(utils.KeystoneNotReadyError,
+                          utils.check_restarted, ['keystone', 'haproxy'])
+        # The slot is kept while keystone is down
+        self.assertEqual(peers['keystone/10'], {'restart-request': '2'})
+        wait_for_keystone_ready.side_effect = None
+        utils.check_restarted(['keystone', 'haproxy'])
+        self.assertEqual(peers['keystone/10'], {'restart-request': None})
 
     @patch.object(utils, 'resolve_address')
     @patch.object(utils, 'b64encode')
@@ -235,6 +759,7 @@ class TestKeystoneUtils(CharmTestCase):
 
         mock_keystone = MagicMock()
         mock_keystone.resolve_tenant_id.return_value = 'tenant_id'
+        mock_keystone.resolve_user_id.return_value = None
         KeystoneManager.return_value = mock_keystone
 
         self.relation_get.return_value = {'service': 'keystone',
@@ -250,12 +775,17 @@ class TestKeystoneUtils(CharmTestCase):
         add_endpoint.assert_called_with(region='RegionOne', service='keystone',
                                         publicurl='10.0.0.1',
                                         adminurl='10.0.0.2',
-                                        internalurl='192.168.1.2')
+                                        internalurl='192.168.1.2',
+                                        catalog=ANY)
         self.assertTrue(self.get_admin_token.called)
         self.get_service_password.assert_called_with('keystone')
-        self.create_user.assert_called_with('keystone', 'password', 'tenant')
-        self.grant_role.assert_called_with('keystone', 'admin', 'tenant')
-        self.create_role.assert_called_with('role1', 'keystone', 'tenant')
+        self.grant_role.assert_called_with('keystone', 'admin', 'tenant',
+                                           catalog=ANY)
+        self.create_role.assert_called_with('role1', 'keystone', 'tenant',
+                                            catalog=ANY)
+        mock_keystone.create_user.assert_called_with('keystone', 'password',
+                                                     'juju@localhost',
+                                                     'tenant_id')
 
         relation_data = {'auth_host': '10.0.0.3', 'service_host': '10.0.0.3',
                          'admin_token': 'token', 'service_port': 81,
@@ -297,6 +827,7 @@ class TestKeystoneUtils(CharmTestCase):
                                           'ec2_admin_url': '10.0.0.2',
                                           'ec2_internal_url': '192.168.1.2'}
         self.get_local_endpoint.return_value = 'http://localhost:80/v2.0/'
+        self.get_service_password.return_value = 'password'
         KeystoneManager.resolve_tenant_id.return_value = 'tenant_id'
 
         utils.add_service_to_keystone(
@@ -306,52 +837,76 @@ class TestKeystoneUtils(CharmTestCase):
         add_endpoint.assert_called_with(region='RegionOne', service='nova',
                                         publicurl='10.0.0.1',
                                         adminurl='10.0.0.2',
-                                        internalurl='192.168.1.2')
-
-    @patch.object(utils, 'user_exists')
-    @patch.object(utils, 'grant_role')
-    @patch.object(utils, 'create_role')
-    @patch.object(utils, 'create_user')
-    def test_create_user_credentials_no_roles(self, mock_create_user,
-                                              mock_create_role,
-                                              mock_grant_role,
-                                              mock_user_exists):
-        mock_user_exists.return_value = False
-        utils.create_user_credentials('userA', 'tenantA', 'passA')
-        mock_create_user.assert_has_calls([call('userA', 'passA', 'tenantA')])
-        mock_create_role.assert_has_calls([])
-        mock_grant_role.assert_has_calls([])
-
-    @patch.object(utils, 'user_exists')
-    @patch.object(utils, 'grant_role')
-    @patch.object(utils, 'create_role')
-    @patch.object(utils, 'create_user')
-    def test_create_user_credentials(self, mock_create_user, mock_create_role,
-                                     mock_grant_role, mock_user_exists):
-        mock_user_exists.return_value = False
+                                        internalurl='192.168.1.2',
+                                        catalog=ANY)
+
+    def test_create_user_credentials_no_roles(self):
+        catalog = KeystoneCatalog()
         utils.create_user_credentials('userA', 'tenantA', 'passA',
-                                      grants=['roleA'], new_roles=['roleB'])
-        mock_create_user.assert_has_calls([call('userA', 'passA', 'tenantA')])
-        mock_create_role.assert_has_calls([call('roleB', 'userA', 'tenantA')])
-        mock_grant_role.assert_has_calls([call('userA', 'roleA', 'tenantA')])
-
-    @patch.object(utils, 'update_user_password')
-    @patch.object(utils, 'user_exists')
-    @patch.object(utils, 'grant_role')
-    @patch.object(utils, 'create_role')
-    @patch.object(utils, 'create_user')
-    def test_create_user_credentials_user_exists(self, mock_create_user,
-                                                 mock_create_role,
-                                                 mock_grant_role,
-                                                 mock_user_exists,
-                                                 mock_update_user_password):
-        mock_user_exists.return_value = True
+                                      catalog=catalog)
+        self.assertEqual(catalog.users, {'userA': ('passA', 'tenantA')})
+        self.assertFalse(self.create_role.called)
+        self.assertFalse(self.grant_role.called)
+
+    def test_create_user_credentials(self):
+        catalog = KeystoneCatalog()
         utils.create_user_credentials('userA', 'tenantA', 'passA',
-                                      grants=['roleA'], new_roles=['roleB'])
-        mock_create_user.assert_has_calls([])
-        mock_create_role.assert_has_calls([call('roleB', 'userA', 'tenantA')])
-        mock_grant_role.assert_has_calls([call('userA', 'roleA', 'tenantA')])
-        mock_update_user_password.assert_has_calls([call('userA', 'passA')])
+                                      grants=['roleA'], new_roles=['roleB'],
+                                      catalog=catalog)
+        self.assertEqual(catalog.users, {'userA': ('passA', 'tenantA')})
+        self.create_role.assert_has_calls([call('roleB', 'userA', 'tenantA',
+                                                catalog=catalog)])
+        self.grant_role.assert_has_calls([call('userA', 'roleA', 'tenantA',
+                                               catalog=catalog)])
+
+    @patch.object(manager, 'KeystoneManager')
+    def test_create_user_credentials_user_exists(self, KeystoneManager):
+        mock_keystone = MagicMock()
+        mock_keystone.resolve_user_id.return_value = 'uid1'
+        KeystoneManager.return_value = mock_keystone
+        self.kv().get.return_value = {}
+        utils.create_user_credentials('userA', 'tenantA', 'passA')
+        self.assertFalse(mock_keystone.create_user.called)
+        mock_keystone.update_user_password.assert_called_with('uid1', 'passA')
+
+    @patch.object(utils, 'peer_retrieve')
+    def test_get_requested_catalog(self, peer_retrieve):
+        settings = {
+            'nova/0': {'service': 'nova', 'region': 'RegionOne',
+                       'public_url': '10.0.0.1', 'admin_url': '10.0.0.1',
+                       'internal_url': '10.0.0.1'},
+            'bogus/0': {'service': 'bogus', 'region': 'RegionOne',
+                        'public_url': '10.0.0.2', 'admin_url': '10.0.0.2',
+                        'internal_url': '10.0.0.2'},
+            'openstack-dashboard/0': {'service': 'None', 'region': 'None',
+                                      'public_url': 'None',
+                                      'admin_url': 'None',
+                                      'internal_url': 'None',
+                                      'requested_roles': 'Member'},
+        }
+        self.relation_ids.return_value = ['identity-service:0']
+        self.related_units.return_value = sorted(settings)
+        self.relation_get.side_effect = lambda rid, unit: settings[unit]
+        self.get_requested_roles.side_effect = (
+            lambda s: s.get('requested_roles', '').split(',') if
+            s.get('requested_roles') else [])
+        passwords = {'nova_passwd': 'passwd'}
+        peer_retrieve.side_effect = passwords.get
+        catalog = utils.get_requested_catalog()
+        self.assertEqual(catalog.users, {'nova': ('passwd', 'services')})
+        self.assertFalse(self.get_service_password.called)
+        self.assertFalse(self.peer_store.called)
+        self.assertFalse(self.relation_set.called)
+        self.create_endpoint_template.assert_called_with(
+            region='RegionOne', service='nova', publicurl='10.0.0.1',
+            adminurl='10.0.0.1', internalurl='10.0.0.1', catalog=catalog)
+        self.create_role.assert_called_with('Member', catalog=catalog)
+        self.grant_role.assert_called_with('nova', 'Admin', 'services',
+                                           catalog=catalog)
+
+        # Credentials are left to the relation requesting them
+        del passwords['nova_passwd']
+        self.assertEqual(utils.get_requested_catalog().users, {})
 
     @patch.object(utils, 'get_service_password')
     @patch.object(utils, 'create_user_credentials')
@@ -361,10 +916,21 @@ class TestKeystoneUtils(CharmTestCase):
         cfg = {'service-tenant': 'tenantA', 'admin-role': 'Admin'}
         self.config.side_effect = lambda key: cfg.get(key, None)
         calls = [call('serviceA', 'tenantA', 'passA', grants=['Admin'],
-                      new_roles=None)]
+                      new_roles=None, catalog=None)]
         utils.create_service_credentials('serviceA')
         mock_create_user_credentials.assert_has_calls(calls)
 
+    @patch.object(utils, 'worker_pool', wraps=utils.worker_pool)
+    def test_get_certs_and_keys(self, worker_pool):
+        ca = MagicMock()
+        ca.get_cert_and_key.side_effect = (
+            lambda common_name: ('crt-' + common_name, 'key-' + common_name))
+        cns = ['10.0.0.%d' % i for i in range(8)]
+        self.assertEqual(utils.get_certs_and_keys(ca, cns),
+                         [('crt-' + cn, 'key-' + cn) for cn in cns])
+        self.assertEqual(ca.get_cert_and_key.call_count, 8)
+        worker_pool.assert_called_once_with()
+
     def test_ensure_valid_service_incorrect(self):
         utils.ensure_valid_service('fakeservice')
         self.log.assert_called_with("Invalid service requested: 'fakeservice'")
@@ -374,20 +940,23 @@ class TestKeystoneUtils(CharmTestCase):
         publicurl = '10.0.0.1'
         adminurl = '10.0.0.2'
         internalurl = '10.0.0.3'
+        catalog = KeystoneCatalog()
         utils.add_endpoint(
             'RegionOne',
             'nova',
             publicurl,
             adminurl,
-            internalurl)
+            internalurl,
+            catalog=catalog)
         self.create_service_entry.assert_called_with(
             'nova',
             'compute',
-            'Nova Compute Service')
-        self.create_endpoint_template.asssert_called_with(
+            'Nova Compute Service',
+            catalog=catalog)
+        self.create_endpoint_template.assert_called_with(
             region='RegionOne', service='nova',
             publicurl=publicurl, adminurl=adminurl,
-            internalurl=internalurl)
+            internalurl=internalurl, catalog=catalog)
 
     @patch.object(utils, 'uuid')
     @patch.object(utils, 'relation_set')
@@ -568,6 +1137,8 @@ class TestKeystoneUtils(CharmTestCase):
         self.assertFalse(utils.ensure_ssl_cert_master())
         self.assertFalse(self.relation_set.called)
 
+    @patch.object(utils, 'wait_for_keystone_ready')
+    @patch.object(manager, 'KeystoneManager')
     @patch('charmhelpers.contrib.openstack.ip.unit_get')
     @patch('charmhelpers.contrib.openstack.ip.is_clustered')
     @patch('charmhelpers.contrib.openstack.ip.config')
@@ -582,7 +1153,9 @@ class TestKeystoneUtils(CharmTestCase):
                                               _create_keystone_endpoint,
                                               _ip_config,
                                               _is_clustered,
-                                              _unit_get):
+                                              _unit_get,
+                                              _KeystoneManager,
+                                              _wait_for_keystone_ready):
         _is_clustered.return_value = False
         _ip_config.side_effect = self.test_config.get
         _unit_get.return_value = '10.0.0.1'
@@ -594,7 +1167,8 @@ class TestKeystoneUtils(CharmTestCase):
             internal_ip='10.0.0.1',
             admin_ip='10.0.0.1',
             auth_port=35357,
-            region='RegionOne'
+            region='RegionOne',
+            catalog=ANY
         )
 
     @patch.object(utils, 'peer_units')
@@ -704,6 +1278,25 @@ class TestKeystoneUtils(CharmTestCase):
         self.assertEquals(render.call_args_list, expected)
         service_restart.assert_called_with('keystone')
 
+    @patch.object(manager, 'KeystoneManager')
+    def test_get_manager_shared(self, KeystoneManager):
+        self.get_local_endpoint.return_value = 'http://localhost:35357/v2.0/'
+        self.get_admin_token.return_value = 'token'
+        km = utils.get_manager()
+        self.assertEqual(utils.get_manager(), km)
+        KeystoneManager.assert_called_once_with(
+            endpoint='http://localhost:35357/v2.0/', token='token')
+        self.assertEqual(self.get_admin_token.call_count, 1)
+
+    @patch.object(manager, 'KeystoneManager3')
+    def test_get_manager_v3(self, KeystoneManager3):
+        self.os_release.return_value = 'kilo'
+        self.get_local_endpoint.return_value = 'http://localhost:35357/v2.0/'
+        self.get_admin_token.return_value = 'token'
+        self.assertEqual(utils.get_manager(), KeystoneManager3.return_value)
+        KeystoneManager3.assert_called_once_with(
+            endpoint='http://localhost:35357/v2.0/', token='token')
+
     @patch.object(manager, 'KeystoneManager')
     def test_is_service_present(self, KeystoneManager):
         mock_keystone = MagicMock()
@@ -724,7 +1317,24 @@ class TestKeystoneUtils(CharmTestCase):
         mock_keystone.resolve_service_id.return_value = 'sid1'
         KeystoneManager.return_value = mock_keystone
         utils.delete_service_entry('bob', 'bill')
-        mock_keystone.api.services.delete.assert_called_with('sid1')
+        mock_keystone.delete_service.assert_called_with('sid1')
+
+    @patch.object(manager, 'KeystoneManager')
+    def test_create_tenant(self, KeystoneManager):
+        mock_keystone = MagicMock()
+        mock_keystone.resolve_tenant_id.return_value = None
+        KeystoneManager.return_value = mock_keystone
+        utils.create_tenant('services')
+        mock_keystone.create_tenant.assert_called_with(
+            'services', description='Created by Juju')
+
+    @patch.object(manager, 'KeystoneManager')
+    def test_create_tenant_exists(self, KeystoneManager):
+        mock_keystone = MagicMock()
+        mock_keystone.resolve_tenant_id.return_value = 'tid1'
+        KeystoneManager.return_value = mock_keystone
+        utils.create_tenant('services')
+        self.assertFalse(mock_keystone.create_tenant.called)
 
     @patch.object(utils, 'HookData')
     @patch.object(utils, 'kv')
@@ -0,0 +1,277 @@
+from mock import MagicMock, patch
+
+import manager
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'client',
+    'client_v3',
+]
+
+
+def _resource(**info):
+    resource = MagicMock()
+    resource._info = info
+    for attr, value in info.items():
+        setattr(resource, attr, value)
+    return resource
+
+
+class TestKeystoneManager(CharmTestCase):
+
+    def setUp(self):
+        super(TestKeystoneManager, self).setUp(manager, TO_PATCH)
+        manager.SNAPSHOTS.clear()
+        self.addCleanup(manager.SNAPSHOTS.clear)
+        self.api = MagicMock()
+        self.client.Client.return_value = self.api
+        self.api.tenants.list.return_value = [
+            _resource(id='t1', name='admin'),
+            _resource(id='t2', name='services'),
+        ]
+        self.api.users.list.return_value = [
+            _resource(id='u1', name='admin'),
+        ]
+        self.api.services.list.return_value = [
+            _resource(id='s1', name='keystone', type='identity'),
+            _resource(id='s2', name='quantum', type='network'),
+        ]
+        self.api.endpoints.list.return_value = [
+            _resource(id='e1', service_id='s1', region='RegionOne',
+                      publicurl='http://10.0.0.1:5000/v2.0',
+                      adminurl='http://10.0.0.1:35357/v2.0',
+                      internalurl='http://10.0.0.1:5000/v2.0'),
+            _resource(id='e2', service_id='s1', region='RegionTwo',
+                      publicurl='http://10.0.1.1:5000/v2.0',
+                      adminurl='http://10.0.1.1:35357/v2.0',
+                      internalurl='http://10.0.1.1:5000/v2.0'),
+        ]
+        self.api_v3 = MagicMock()
+        self.client_v3.Client.return_value = self.api_v3
+
+    def test_resolve_lists_once_per_hook(self):
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertEqual(km.resolve_tenant_id('admin'), 't1')
+        self.assertEqual(km.resolve_tenant_id('services'), 't2')
+        self.assertEqual(km.resolve_tenant_id('missing'), None)
+        # A second manager on the same endpoint shares the snapshot
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertEqual(km.resolve_tenant_id('admin'), 't1')
+        self.assertEqual(self.api.tenants.list.call_count, 1)
+        self.assertFalse(self.api.users.list.called)
+
+    def test_resolve_service_id(self):
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertEqual(km.resolve_service_id('quantum'), 's2')
+        self.assertEqual(km.resolve_service_id('quantum', 'network'), 's2')
+        self.assertEqual(km.resolve_service_id('quantum', 'identity'), None)
+        self.assertEqual(km.resolve_service_id_by_type('identity'), 's1')
+        self.assertEqual(self.api.services.list.call_count, 1)
+
+    def test_create_updates_snapshot(self):
+        self.api.users.create.return_value = _resource(id='u2', name='nova')
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertEqual(km.resolve_user_id('nova'), None)
+        km.create_user('nova', 'passwd', 'juju@localhost', 't2')
+        self.api.users.create.assert_called_with(name='nova',
+                                                 password='passwd',
+                                                 email='juju@localhost',
+                                                 tenant_id='t2')
+        self.assertEqual(km.resolve_user_id('nova'), 'u2')
+        self.assertEqual(self.api.users.list.call_count, 1)
+
+    def test_create_before_load_does_not_list(self):
+        self.api.roles.create.return_value = _resource(id='r1', name='Admin')
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        km.create_role('Admin')
+        self.assertFalse(self.api.roles.list.called)
+
+    def test_delete_service_updates_snapshot(self):
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertEqual(km.resolve_service_id('quantum'), 's2')
+        km.delete_service('s2')
+        self.api.services.delete.assert_called_with('s2')
+        self.assertEqual(km.resolve_service_id('quantum'), None)
+        self.assertEqual(km.resolve_service_id_by_type('network'), None)
+        self.assertEqual(km.resolve_service_id('keystone'), 's1')
+        self.assertEqual(self.api.services.list.call_count, 1)
+
+    def test_listed_collections_keep_no_lookups(self):
+        self.api.tenants.create.return_value = _resource(id='t3', name='new')
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertEqual(km.resolve_tenant_id('admin'), 't1')
+        km.create_tenant('new')
+        self.assertEqual(km.resolve_tenant_id('new'), 't3')
+        self.assertEqual(km.snapshot.lookups, {})
+
+    def test_remove_keeps_first_match(self):
+        self.api.services.list.return_value.append(
+            _resource(id='s3', name='quantum', type='network'))
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertEqual(km.resolve_service_id('quantum'), 's2')
+        with patch.object(km.snapshot, 'load') as load:
+            km.delete_service('s2')
+            self.assertFalse(load.called)
+        self.assertEqual(km.resolve_service_id('quantum'), 's3')
+        self.assertEqual(km.resolve_service_id_by_type('network'), 's3')
+
+    def test_grants_cached(self):
+        self.api.roles.roles_for_user.return_value = [_resource(id='r1')]
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertEqual(km.roles_for_user('u1', 't1'), set(['r1']))
+        km.add_user_role('u1', 'r2', 't1')
+        self.api.roles.add_user_role.assert_called_with(user='u1', role='r2',
+                                                        tenant='t1')
+        self.assertEqual(km.roles_for_user('u1', 't1'), set(['r1', 'r2']))
+        self.assertEqual(self.api.roles.roles_for_user.call_count, 1)
+
+    def test_find_endpoint(self):
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertEqual(km.find_endpoint('s1', 'RegionTwo')['id'], 'e2')
+        self.assertEqual(km.find_endpoint('s1', 'RegionThree'), None)
+        self.assertEqual(km.find_endpoint('s2', 'RegionOne'), None)
+        self.assertEqual(self.api.endpoints.list.call_count, 1)
+
+    def _v3_endpoint(self, interface, url, legacy_endpoint_id='e1'):
+        endpoint = MagicMock()
+        endpoint.interface = interface
+        endpoint.url = url
+        endpoint.legacy_endpoint_id = legacy_endpoint_id
+        return endpoint
+
+    def test_update_endpoint_v3(self):
+        public = self._v3_endpoint('public', 'http://10.0.0.1:5000/v2.0')
+        admin = self._v3_endpoint('admin', 'http://10.0.0.1:35357/v2.0')
+        internal = self._v3_endpoint('internal', 'http://10.0.0.1:5000/v2.0')
+        other = self._v3_endpoint('public', 'http://10.0.1.1:5000/v2.0',
+                                  legacy_endpoint_id='e2')
+        self.api_v3.endpoints.list.return_value = [public, admin, internal,
+                                                   other]
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertEqual(km.find_endpoint('s1', 'RegionOne')['id'], 'e1')
+        km.update_endpoint('e1', 'RegionOne', 's1',
+                           publicurl='http://10.0.0.9:5000/v2.0',
+                           adminurl='http://10.0.0.1:35357/v2.0',
+                           internalurl='http://10.0.0.1:5000/v2.0')
+        self.client_v3.Client.assert_called_with(
+            session=km.session, endpoint_override='http://localhost:35357/v3')
+        self.api_v3.endpoints.update.assert_called_once_with(
+            public, url='http://10.0.0.9:5000/v2.0')
+        self.assertFalse(self.api.endpoints.create.called)
+        self.assertFalse(self.api.endpoints.delete.called)
+        self.assertEqual(km.find_endpoint('s1', 'RegionOne')['publicurl'],
+                         'http://10.0.0.9:5000/v2.0')
+
+    def test_update_endpoint_v2_replace(self):
+        self.api_v3.endpoints.list.side_effect = \
+            manager.exceptions.NotFound()
+        self.api.endpoints.create.return_value = _resource(
+            id='e3', service_id='s1', region='RegionOne',
+            publicurl='http://10.0.0.9:5000/v2.0',
+            adminurl='http://10.0.0.1:35357/v2.0',
+            internalurl='http://10.0.0.1:5000/v2.0')
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertEqual(km.find_endpoint('s1', 'RegionOne')['id'], 'e1')
+        km.update_endpoint('e1', 'RegionOne', 's1',
+                           publicurl='http://10.0.0.9:5000/v2.0',
+                           adminurl='http://10.0.0.1:35357/v2.0',
+                           internalurl='http://10.0.0.1:5000/v2.0')
+        # The replacement is created before the old endpoint goes away
+        self.assertEqual([c[0] for c in self.api.endpoints.method_calls],
+                         ['list', 'create', 'delete'])
+        self.api.endpoints.delete.assert_called_with('e1')
+        self.assertEqual(km.find_endpoint('s1', 'RegionOne')['id'], 'e3')
+
+    def test_update_endpoint_create_fails(self):
+        self.api_v3.endpoints.list.return_value = []
+        self.api.endpoints.create.side_effect = \
+            manager.exceptions.ClientException()
+        km = manager.KeystoneManager('http://localhost:35357/v2.0/', 'token')
+        self.assertRaises(manager.exceptions.ClientException,
+                          km.update_endpoint, 'e1', 'RegionOne', 's1',
+                          publicurl='http://10.0.0.9:5000/v2.0',
+                          adminurl='http://10.0.0.1:35357/v2.0',
+                          internalurl='http://10.0.0.1:5000/v2.0')
+        self.assertFalse(self.api.endpoints.delete.called)
+
+
+class TestKeystoneManager3(CharmTestCase):
+
+    def setUp(self):
+        super(TestKeystoneManager3, self).setUp(manager, TO_PATCH)
+        manager.SNAPSHOTS.clear()
+        self.addCleanup(manager.SNAPSHOTS.clear)
+        self.api = MagicMock()
+        self.client.Client.return_value = self.api
+        self.api_v3 = MagicMock()
+        self.client_v3.Client.return_value = self.api_v3
+        self.api_v3.users.list.side_effect = (
+            lambda name, domain: [_resource(id='u1', name=name)]
+            if name == 'admin' else [])
+        self.api_v3.services.list.return_value = [
+            _resource(id='s2', name='quantum', type='network'),
+            _resource(id='s3', name='neutron', type='network'),
+        ]
+        self.km = manager.KeystoneManager3('http://localhost:35357/v2.0/',
+                                           'token')
+
+    def test_resolve_user_id_filtered(self):
+        self.assertEqual(self.km.resolve_user_id('admin'), 'u1')
+        self.assertEqual(self.km.resolve_user_id('admin'), 'u1')
+        self.assertEqual(self.km.resolve_user_id('nova'), None)
+        self.api_v3.users.list.assert_called_with(name='nova',
+                                                  domain='default')
+        self.assertEqual(self.api_v3.users.list.call_count, 2)
+        self.assertFalse(self.api.users.list.called)
+
+    def test_create_user_recorded(self):
+        self.api.users.create.return_value = _resource(id='u2', name='nova')
+        self.assertEqual(self.km.resolve_user_id('nova'), None)
+        self.km.create_user('nova', 'passwd', 'juju@localhost', 't2')
+        self.assertEqual(self.km.resolve_user_id('nova'), 'u2')
+        self.assertEqual(self.api_v3.users.list.call_count, 1)
+
+    def test_delete_service_forgets_lookups(self):
+        self.assertEqual(self.km.resolve_service_id('neutron', 'network'),
+                         's3')
+        self.km.delete_service('s3')
+        self.assertEqual(self.km.snapshot.lookup('services', 'name-type',
+                                                 ('neutron', 'network')),
+                         (True, None))
+        self.assertEqual(self.km.snapshot.lookup_ids, {})
+
+    def test_resolve_tenant_id_filtered(self):
+        self.api_v3.projects.list.return_value = [_resource(id='t2',
+                                                            name='services')]
+        self.assertEqual(self.km.resolve_tenant_id('services'), 't2')
+        self.api_v3.projects.list.assert_called_with(name='services',
+                                                     domain='default')
+        self.assertFalse(self.api.tenants.list.called)
+
+    def test_resolve_service_id(self):
+        self.assertEqual(self.km.resolve_service_id_by_type('network'), 's2')
+        self.assertEqual(self.km.resolve_service_id('neutron', 'network'),
+                         's3')
+        self.api_v3.services.list.assert_called_with(type='network')
+        self.km.delete_service('s3')
+        self.assertEqual(self.km.resolve_service_id('neutron', 'network'),
+                         None)
+        # Lookups by name alone list the (small) collection
+        self.api.services.list.return_value = [
+            _resource(id='s1', name='keystone', type='identity'),
+        ]
+        self.assertEqual(self.km.resolve_service_id('keystone'), 's1')
+        self.assertEqual(self.api_v3.services.list.call_count, 2)
+
+    def test_roles_for_user(self):
+        assignment = MagicMock()
+        assignment.role = {'id': 'r1'}
+        self.api_v3.role_assignments.list.return_value = [assignment]
+        self.assertEqual(self.km.roles_for_user('u1', 't1'), set(['r1']))
+        self.km.add_user_role('u1', 'r2', 't1')
+        self.assertEqual(self.km.roles_for_user('u1', 't1'),
+                         set(['r1', 'r2']))
+        self.api_v3.role_assignments.list.assert_called_once_with(
+            user='u1', project='t1')
+        self.assertFalse(self.api.roles.roles_for_user.called)
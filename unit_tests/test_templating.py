@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+
+from charmhelpers.contrib.openstack import templating
+
+
+class FakeContext(object):
+    # Generators called, kept off the instances as they are memoized by
+    # their attributes.
+    called = []
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+        self.interfaces = []
+
+    def __call__(self):
+        self.called.append(self)
+        return {self.name: self.value}
+
+    @property
+    def calls(self):
+        return len([c for c in self.called if c is self])
+
+
+class TestOSConfigRenderer(unittest.TestCase):
+
+    def setUp(self):
+        self.templates_dir = tempfile.mkdtemp()
+        self.target_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.templates_dir)
+        self.addCleanup(shutil.rmtree, self.target_dir)
+        self.addCleanup(setattr, FakeContext, 'called', [])
+        for name in ('a.conf', 'b.conf'):
+            with open(os.path.join(self.templates_dir, name), 'w') as f:
+                f.write('{{ a }} {{ b }}')
+        for name in ('log', 'write_file_atomic'):
+            _patch = patch.object(templating, name)
+            setattr(self, name, _patch.start())
+            self.addCleanup(_patch.stop)
+        self.write_file_atomic.side_effect = self._write
+        self.renderer = templating.OSConfigRenderer(
+            templates_dir=self.templates_dir, openstack_release='liberty',
+            cache_dir=os.path.join(self.templates_dir, 'cache'))
+        self.a_conf = os.path.join(self.target_dir, 'a.conf')
+        self.b_conf = os.path.join(self.target_dir, 'b.conf')
+
+    def _write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+        return True
+
+    def test_write_skipped_for_unchanged_context(self):
+        context = FakeContext('a', '1')
+        self.renderer.register(self.a_conf, [context])
+        self.assertTrue(self.renderer.write(self.a_conf))
+        self.assertFalse(self.renderer.write(self.a_conf))
+        self.assertEqual(self.write_file_atomic.call_count, 1)
+
+        context.value = '2'
+        self.assertTrue(self.renderer.write(self.a_conf))
+        self.write_file_atomic.assert_called_with(self.a_conf, '2 ')
+
+    def test_write_after_invalidate_or_removal(self):
+        self.renderer.register(self.a_conf, [FakeContext('a', '1')])
+        self.renderer.write(self.a_conf)
+        self.renderer.invalidate(self.a_conf)
+        self.renderer.write(self.a_conf)
+        os.unlink(self.a_conf)
+        self.renderer.write(self.a_conf)
+        self.renderer.set_release('mitaka')
+        self.renderer.write(self.a_conf)
+        self.assertEqual(self.write_file_atomic.call_count, 4)
+
+    def test_write_all_evaluates_contexts_once(self):
+        shared = FakeContext('a', '1')
+        b = FakeContext('b', '2')
+        equal_b = FakeContext('b', '2')
+        self.renderer.register(self.a_conf, [shared, b])
+        self.renderer.register(self.b_conf, [shared, equal_b])
+        self.assertEqual(sorted(self.renderer.write_all()),
+                         [self.a_conf, self.b_conf])
+        self.assertEqual((shared.calls, b.calls + equal_b.calls), (1, 1))
+        self.assertEqual(open(self.b_conf).read(), '1 2')
+
+        # Each pass evaluates generators afresh
+        self.renderer.invalidate()
+        self.renderer.write_all()
+        self.assertEqual((shared.calls, b.calls + equal_b.calls), (2, 2))
+
+    def test_write_all_memo_keyed_on_configuration(self):
+        a = FakeContext('a', '1')
+        b = FakeContext('a', '2')
+        side_effects = MagicMock(return_value={'b': '3'}, interfaces=[],
+                                 side_effects=True)
+        self.renderer.register(self.a_conf, [a, side_effects])
+        self.renderer.register(self.b_conf, [b, side_effects])
+        self.renderer.write_all()
+        self.assertEqual((a.calls, b.calls), (1, 1))
+        self.assertEqual(side_effects.call_count, 2)
+        self.assertEqual(open(self.a_conf).read(), '1 3')
+        self.assertEqual(open(self.b_conf).read(), '2 3')
@@ -0,0 +1,97 @@
+from mock import call, patch
+
+from charmhelpers.contrib import unison
+
+from test_utils import CharmTestCase
+
+TO_PATCH = [
+    'log',
+    'related_units',
+    'relation_get',
+    'relation_ids',
+    'run_as_user',
+    'unit_private_ip',
+]
+
+
+class TestUnison(CharmTestCase):
+
+    def setUp(self):
+        super(TestUnison, self).setUp(unison, TO_PATCH)
+        self.unit_private_ip.return_value = '10.0.0.1'
+        self.relation_ids.return_value = ['cluster:1']
+        self.related_units.return_value = ['keystone/1', 'keystone/2',
+                                           'keystone/3']
+        settings = {
+            'keystone/1': {'private-address': '10.0.0.2',
+                           'ssh_authorized_hosts': '10.0.0.1:10.0.0.3'},
+            'keystone/2': {'private-address': '10.0.0.3',
+                           'ssh_authorized_hosts': '10.0.0.1'},
+            'keystone/3': {'private-address': '10.0.0.4',
+                           'ssh_authorized_hosts': '10.0.0.2'},
+        }
+        self.relation_get.side_effect = \
+            lambda attribute, rid, unit: settings[unit].get(attribute)
+
+    def test_collect_authed_hosts(self):
+        self.assertEqual(unison.collect_authed_hosts('cluster'),
+                         ['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(unison.collect_authed_hosts(
+            'cluster', units=['keystone/2', 'keystone/3']), ['10.0.0.3'])
+
+    def test_sync_paths_to_host_single_path(self):
+        unison.sync_paths_to_host(['/var/lib/sync/'], '10.0.0.2', 'juju')
+        self.run_as_user.assert_called_once_with(
+            'juju', unison.BASE_CMD + [
+                '-silent', '/var/lib/sync',
+                'ssh://juju@10.0.0.2//var/lib/sync'], None)
+
+    def test_sync_paths_to_host_common_root(self):
+        unison.sync_paths_to_host(['/etc/ssl/ca', '/etc/ssl/ca/pki',
+                                   '/etc/sslx'], '10.0.0.2', 'juju',
+                                  verbose=True, gid=10)
+        self.run_as_user.assert_called_once_with(
+            'juju', unison.BASE_CMD + [
+                '/etc', 'ssh://juju@10.0.0.2//etc',
+                '-path', 'ssl/ca', '-path', 'ssl/ca/pki',
+                '-path', 'sslx'], 10)
+
+    @patch.object(unison, 'sync_paths_to_host')
+    def test_sync_to_peers_workers(self, sync_paths_to_host):
+        error = OSError('unreachable')
+
+        def _sync(paths, host, *args):
+            if host == '10.0.0.3':
+                raise error
+        sync_paths_to_host.side_effect = _sync
+
+        results = unison.sync_to_peers('cluster', 'juju', paths=['/a', '/b'],
+                                       workers=4)
+        self.assertEqual(results, {'10.0.0.2': None, '10.0.0.3': error})
+        self.assertEqual(
+            sorted(sync_paths_to_host.call_args_list),
+            [call(['/a', '/b'], '10.0.0.2', 'juju', False, None, None),
+             call(['/a', '/b'], '10.0.0.3', 'juju', False, None, None)])
+        self.assertRaises(OSError, unison.sync_to_peers, 'cluster', 'juju',
+                          paths=['/a'], workers=4, fatal=True)
+
+    @patch.object(unison, 'sync_paths_to_host')
+    def test_sync_to_peers_units(self, sync_paths_to_host):
+        results = unison.sync_to_peers('cluster', 'juju', paths=['/a'],
+                                       workers=2, units=['keystone/1'])
+        self.assertEqual(results, {'10.0.0.2': None})
+        sync_paths_to_host.assert_called_once_with(
+            ['/a'], '10.0.0.2', 'juju', False, None, None)
+        self.assertEqual(unison.sync_to_peers('cluster', 'juju',
+                                              paths=['/a'], workers=2,
+                                              units=[]), {})
+
+    @patch.object(unison, 'sync_to_peer')
+    def test_sync_to_peers_serial(self, sync_to_peer):
+        self.assertEqual(unison.sync_to_peers('cluster', 'juju',
+                                              paths=['/a']), None)
+        self.assertEqual(sync_to_peer.call_args_list,
+                         [call('10.0.0.2', 'juju', ['/a'], False, None, None,
+                               False),
+                          call('10.0.0.3', 'juju', ['/a'], False, None, None,
+                               False)])